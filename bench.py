@@ -0,0 +1,644 @@
+"""wallet-tracker 离线基准测试
+
+在本地启动一个替身 HTTP 服务器，用 bench_fixtures/ 中录制格式的 clearinghouseState、/ticker/price 与 /klines
+响应代替 RPC 与 Binance，直接运行 tracker.main() 的主循环 N 轮，按 tracker 自身的阶段计时报告每个阶段的耗时、
+每个接口的请求次数与峰值内存。可配置网络延迟，并按比例注入 429 / 418 / -1003 错误（只作用于 Binance 请求，
+注入错误时默认改用 PRICE_SOURCE=binance），用于在无网络环境下检查性能回归。
+
+使用方法：
+- python3 bench.py                          # 默认 20 轮、单地址
+- python3 bench.py -n 50 --wallets 200      # 多地址
+- python3 bench.py --latency 80 --jitter 40 --err-429 0.02 --err-418 0.01 --err-1003 0.005
+- python3 bench.py --churn 0.2              # 每轮以 20% 概率改动持仓，覆盖变更检测 / 历史 / 邮件路径
+- python3 bench.py --ticker-stream          # 行情走本地 !miniTicker@arr WebSocket 替身（需要 websocket-client）
+- python3 bench.py --stream-check           # 检查推送行情：帧解析、断流回退 REST、断线重连与补齐
+- python3 bench.py --record                 # 从线上接口重新录制 fixtures（需要网络）
+
+注意：基准运行时会把 SMTP_HOST 置空（不发送邮件），历史记录写入临时目录。
+"""
+
+import argparse
+import base64
+import copy
+import hashlib
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+import tracker
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+INTERVAL_MS = {"1m": 60000, "5m": 300000, "15m": 900000, "1h": 3600000, "4h": 14400000, "1d": 86400000}
+
+
+def load_fixtures(path: str) -> Dict[str, Any]:
+    def load(name):
+        with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    return {
+        "state": load("clearinghouse_state.json"),
+        "tickers": load("ticker_price.json"),
+        "klines": load("klines_1m.json"),
+    }
+
+
+def record_fixtures(path: str, address: str) -> None:
+    """从线上接口录制一份新的 fixtures（覆盖 path 下的文件）。"""
+    import requests
+
+    os.makedirs(path, exist_ok=True)
+    state = requests.post(tracker.rpc_endpoints()[0], json={"type": "clearinghouseState", "user": address, "dex": ""}, timeout=10).json()
+    tickers = requests.get(f"{tracker.BINANCE_API}/ticker/price", timeout=10).json()
+    klines = requests.get(f"{tracker.BINANCE_API}/klines", params={"symbol": "BTCUSDT", "interval": "1m", "limit": 120}, timeout=10).json()
+    for name, obj in (("clearinghouse_state.json", state), ("ticker_price.json", tickers), ("klines_1m.json", klines)):
+        with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+            json.dump(obj, f, separators=(",", ":"))
+    print(f"已录制 fixtures 到 {path}")
+
+
+class MockExchange:
+    """RPC / Binance 替身服务器：按 fixtures 应答，统计每个接口的请求数，并按配置注入延迟与错误。"""
+
+    def __init__(self, fixtures: Dict[str, Any], latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 err_429: float = 0.0, err_418: float = 0.0, err_1003: float = 0.0, churn: float = 0.0, seed: int = 1):
+        self.fixtures = fixtures
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.err = {"429": err_429, "418": err_418, "-1003": err_1003}
+        self.churn = churn
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.prices = {t["symbol"]: float(t["price"]) for t in fixtures["tickers"]}
+        # Binance 上没有交易对的币种（如 HYPE）按 fixtures 中的开仓价定价
+        self.entry_px = {w["position"]["coin"]: float(w["position"]["entryPx"]) for w in fixtures["state"].get("assetPositions", [])
+                         if w.get("position", {}).get("entryPx")}
+        closes = [float(k[4]) for k in fixtures["klines"]]
+        # K 线形状取自录制的 1m 序列（相对最后一根收盘价的比例），按各交易对现价缩放并对齐到当前时间
+        self.kline_shape = [c / closes[-1] for c in closes] if closes else [1.0]
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.fills: Dict[str, List[Dict[str, Any]]] = {}
+        self.tid = 0
+        self.server = None
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.counts.clear()
+            self.errors.clear()
+
+    def _count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _pick_error(self):
+        with self.lock:
+            roll = self.rand.random()
+            for name, rate in self.err.items():
+                if roll < rate:
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                    return name
+                roll -= rate
+        return None
+
+    def mid(self, coin: str) -> Any:
+        """Hyperliquid 中间价：跟随 fixtures 中对应交易对的 ticker 价格（按倍数换算），没有交易对时用开仓价；都没有返回 None。"""
+        sym, mult = self.coin_symbol(coin)
+        return self.prices[sym] * mult if sym else self.entry_px.get(coin)
+
+    def _churn(self, user: str) -> None:
+        """开启 churn 时按概率改动该地址一个持仓的大小，并记一笔对应的成交（调用方持有 self.lock）。"""
+        st = self.states.get(user)
+        if st is None:
+            self.states[user] = copy.deepcopy(self.fixtures["state"])
+            return
+        if not (self.churn and self.rand.random() < self.churn and st["assetPositions"]):
+            return
+        pos = self.rand.choice(st["assetPositions"])["position"]
+        old = float(pos["szi"])
+        new = float(f"{old * self.rand.uniform(0.5, 1.5):g}")
+        pos["szi"] = f"{new:g}"
+        if new == old:
+            return
+        px = self.mid(pos["coin"]) or 0.0
+        entry = tracker.safe_float(pos.get("entryPx")) or px
+        closing = abs(new) < abs(old)
+        pnl = (px - entry) * (old - new) if closing else 0.0
+        self.tid += 1
+        self.fills.setdefault(user, []).append({
+            "coin": pos["coin"], "px": f"{px:g}", "sz": f"{abs(new - old):g}", "side": "B" if new > old else "A",
+            "time": int(time.time() * 1000), "startPosition": f"{old:g}",
+            "dir": ("Close" if closing else "Open") + (" Long" if old > 0 else " Short"),
+            "closedPnl": f"{pnl:.6f}", "hash": f"0x{self.tid:064x}", "oid": self.tid, "crossed": True, "fee": "0.0", "tid": self.tid,
+        })
+
+    def state_for(self, user: str) -> Dict[str, Any]:
+        """每个地址一份独立的持仓副本；开启 churn 时按概率改动其中一个持仓的大小并记成交。"""
+        with self.lock:
+            self._churn(user)
+            return self.states[user]
+
+    def fills_for(self, user: str, start_time: int = None) -> List[Dict[str, Any]]:
+        """userFills / userFillsByTime 应答：churn 产生的成交，按时间升序，最多 2000 条。"""
+        with self.lock:
+            self._churn(user)
+            fills = [f for f in self.fills.get(user, []) if start_time is None or f["time"] >= start_time]
+        return fills[:2000] if start_time is not None else fills[-2000:]
+
+    def mini_tickers(self, n: int = 100) -> List[Dict[str, Any]]:
+        """一帧 !miniTicker@arr：随机挑 n 个交易对让价格小幅波动，只推送这些有变化的交易对（与 Binance 一致）。"""
+        now = int(time.time() * 1000)
+        out = []
+        with self.lock:
+            for sym in self.rand.sample(list(self.prices), min(n, len(self.prices))):
+                px = self.prices[sym] = self.prices[sym] * self.rand.uniform(0.9995, 1.0005)
+                out.append({"e": "24hrMiniTicker", "E": now, "s": sym, "c": f"{px:.8f}", "o": f"{px:.8f}",
+                            "h": f"{px:.8f}", "l": f"{px:.8f}", "v": "1.0", "q": f"{px:.8f}"})
+        return out
+
+    def klines(self, symbol: str, interval: str, limit: int, start_time: int = None) -> List[List[Any]]:
+        """symbol 必须在 fixtures 的 ticker 中（调用方先检查）。"""
+        return self._series(self.prices[symbol], interval, limit, start_time)
+
+    def _series(self, price: float, interval: str, limit: int, start_time: int = None) -> List[List[Any]]:
+        step = INTERVAL_MS.get(interval, 60000)
+        now = int(time.time() * 1000)
+        if start_time is None:
+            first = (now // step - limit + 1) * step
+        else:
+            first = start_time // step * step
+        out = []
+        t = first
+        shape = self.kline_shape
+        while t <= now and len(out) < limit:
+            c = price * shape[(t // step) % len(shape)]
+            out.append([t, f"{c:.8f}", f"{c:.8f}", f"{c:.8f}", f"{c:.8f}", "1.0", t + step - 1, f"{c:.8f}", 1, "0.5", f"{c / 2:.8f}", "0"])
+            t += step
+        return out
+
+    def coin_symbol(self, coin: str) -> Tuple[Any, float]:
+        """Hyperliquid 币种对应的 fixtures 交易对与价格倍数，与 tracker.resolve_pair 的规则一致：
+        kPEPE 优先映射到 1000PEPEUSDT，没有时映射到 PEPEUSDT 并乘以 1000；找不到返回 (None, 1.0)。"""
+        candidates = [(f"{coin}USDT", 1.0)]
+        if coin.startswith("k") and len(coin) > 1:
+            candidates += [(f"1000{coin[1:]}USDT", 1.0), (f"{coin[1:]}USDT", 1000.0)]
+        for sym, mult in candidates:
+            if sym in self.prices:
+                return sym, mult
+        return None, 1.0
+
+    def candles(self, coin: str, interval: str, start_time: int, end_time: int) -> List[Dict[str, Any]]:
+        """candleSnapshot 应答：与同一交易对的 klines 同形状，价格与 allMids 同源；没有价格的币种返回空列表。"""
+        price = self.mid(coin)
+        if price is None:
+            return []
+        step = INTERVAL_MS.get(interval, 60000)
+        limit = max(1, (end_time - start_time) // step + 1)
+        out = []
+        for k in self._series(price, interval, limit, start_time):
+            out.append({"t": k[0], "T": k[6], "s": coin, "i": interval, "o": k[1], "c": k[4], "h": k[2], "l": k[3], "v": k[5], "n": k[8]})
+        return out
+
+    def start(self) -> int:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 头与正文分两次写，keep-alive 下开着 Nagle 会被延迟 ACK 拖住约 40ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, obj, status=200, headers=None):
+                body = json.dumps(obj, separators=(",", ":")).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _delay(self):
+                if mock.latency or mock.jitter:
+                    time.sleep(max(0.0, mock.latency + mock.rand.uniform(-mock.jitter, mock.jitter)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    req = json.loads(self.rfile.read(length) or b"{}")
+                except Exception:
+                    req = {}
+                kind = req.get("type") or "unknown"
+                mock._count(f"POST /info {kind}")
+                self._delay()
+                if kind == "clearinghouseState":
+                    return self._send(mock.state_for(str(req.get("user"))))
+                if kind == "allMids":
+                    mids = {}
+                    for w in mock.fixtures["state"].get("assetPositions", []):
+                        coin = w["position"]["coin"]
+                        px = mock.mid(coin)
+                        if px is not None:
+                            mids[coin] = f"{px:g}"
+                    return self._send(mids)
+                if kind in ("userFills", "userFillsByTime"):
+                    start = int(req["startTime"]) if kind == "userFillsByTime" and "startTime" in req else None
+                    return self._send(mock.fills_for(str(req.get("user")), start))
+                if kind == "candleSnapshot":
+                    r = req.get("req") or {}
+                    now = int(time.time() * 1000)
+                    return self._send(mock.candles(str(r.get("coin")), str(r.get("interval")), int(r.get("startTime", now)), int(r.get("endTime", now))))
+                return self._send({"error": f"unsupported type {kind}"}, status=422)
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                q = {k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+                path = parsed.path
+                key = f"GET {path}" + (" (single)" if path.endswith("/ticker/price") and "symbol" in q else "")
+                mock._count(key)
+                self._delay()
+                err = mock._pick_error()
+                if err == "429":
+                    return self._send({"code": -1015, "msg": "Too many requests"}, status=429, headers={"Retry-After": "1"})
+                if err == "418":
+                    return self._send({"code": -1003, "msg": "IP banned"}, status=418, headers={"Retry-After": "2"})
+                if err == "-1003":
+                    until = int((time.time() + 2) * 1000)
+                    return self._send({"code": -1003, "msg": f"Way too much request weight used; IP banned until {until}."}, status=418)
+                used = {"X-MBX-USED-WEIGHT-1M": str(sum(mock.counts.values()))}
+                if path.endswith("/ticker/price"):
+                    if "symbol" in q:
+                        sym = q["symbol"]
+                        if sym not in mock.prices:
+                            return self._send({"code": -1121, "msg": "Invalid symbol."}, status=400, headers=used)
+                        return self._send({"symbol": sym, "price": f"{mock.prices[sym]:.8f}"}, headers=used)
+                    with mock.lock:
+                        table = [{"symbol": sym, "price": f"{px:.8f}"} for sym, px in mock.prices.items()]
+                    return self._send(table, headers=used)
+                if path.endswith("/klines"):
+                    if q.get("symbol") not in mock.prices:
+                        return self._send({"code": -1121, "msg": "Invalid symbol."}, status=400, headers=used)
+                    start = int(q["startTime"]) if "startTime" in q else None
+                    return self._send(mock.klines(q.get("symbol", ""), q.get("interval", "1m"), int(q.get("limit", 500)), start), headers=used)
+                return self._send({"code": -1, "msg": "not found"}, status=404)
+
+        class Server(ThreadingHTTPServer):
+            # 多地址并发时同时建立大量连接，默认 backlog=5 会导致 SYN 重传（约 1 秒）而扭曲计时
+            request_queue_size = 1024
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def _ws_frame(payload: bytes) -> bytes:
+    """服务器到客户端的 WebSocket 文本帧（不加掩码）。"""
+    n = len(payload)
+    if n < 126:
+        head = bytes([0x81, n])
+    elif n < 65536:
+        head = bytes([0x81, 126]) + n.to_bytes(2, "big")
+    else:
+        head = bytes([0x81, 127]) + n.to_bytes(8, "big")
+    return head + payload
+
+
+class MockTickerStream:
+    """Binance 行情推送替身：本地 WebSocket 服务器，向连上 /ws/!miniTicker@arr 的客户端每 period 秒推送一帧。
+
+    paused=True 时保持连接但不推送（模拟断流），drop() 断开当前所有连接（模拟服务器断线）。
+    """
+
+    def __init__(self, mock: MockExchange, period: float = 0.2):
+        self.mock = mock
+        self.period = period
+        self.paused = False
+        self.lock = threading.Lock()
+        self.conns: List[socket.socket] = []
+        self.sock = None
+
+    def start(self) -> int:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self.sock.getsockname()[1]
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: socket.socket) -> None:
+        try:
+            data = b""
+            while b"\r\n\r\n" not in data:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            lines = data.decode("latin-1").split("\r\n")
+            path = lines[0].split(" ")[1] if len(lines[0].split(" ")) > 1 else ""
+            key = next((ln.split(":", 1)[1].strip() for ln in lines[1:] if ln.lower().startswith("sec-websocket-key:")), "")
+            if not path.endswith("/ws/!miniTicker@arr") or not key:
+                conn.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                return
+            accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+            conn.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+            self.mock._count("WS /ws/!miniTicker@arr")
+            with self.lock:
+                self.conns.append(conn)
+            while True:
+                if not self.paused:
+                    frame = _ws_frame(json.dumps(self.mock.mini_tickers(), separators=(",", ":")).encode())
+                    conn.sendall(frame)
+                    self.mock._count("WS frame !miniTicker@arr")
+                time.sleep(self.period)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if conn in self.conns:
+                    self.conns.remove(conn)
+            conn.close()
+
+    def drop(self) -> None:
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+        self.drop()
+
+
+class StageTimer:
+    """包装 tracker 模块内的函数统计累计耗时；模块内部按全局名调用，因此替换模块属性即可生效。"""
+
+    def __init__(self):
+        self.current: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+
+    def wrap(self, name: str, label: str = None) -> None:
+        label = label or name
+        fn = getattr(tracker, name)
+        timer = self
+
+        def wrapped(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timer.current[label] = timer.current.get(label, 0.0) + time.perf_counter() - t0
+                timer.calls[label] = timer.calls.get(label, 0) + 1
+
+        setattr(tracker, name, wrapped)
+
+    def take(self) -> Dict[str, float]:
+        out = self.current
+        self.current = {}
+        return out
+
+
+def configure_tracker(port: int, workdir: str) -> None:
+    base = f"http://127.0.0.1:{port}"
+    tracker.RPC_API = f"{base}/info"
+    tracker.BINANCE_API = f"{base}/api/v3"
+    tracker.HISTORY_FILE = os.path.join(workdir, "position_changes.log")
+    tracker.HISTORY_DB = os.path.join(workdir, "position_changes.db")
+    tracker.SMTP_HOST = ""
+
+
+class _BenchDone(BaseException):
+    """跑满指定轮数后从 tracker 的主循环中退出（BaseException，不会被主循环的 except Exception 吞掉）。"""
+
+
+class _NullWriter(io.TextIOBase):
+    """丢弃主循环渲染的画面，只计时不输出。"""
+
+    def write(self, s: str) -> int:
+        return len(s)
+
+
+def run(args) -> Dict[str, Any]:
+    """在替身服务器上运行 tracker.main() 的主循环 args.iterations 轮；每轮的阶段耗时取自 tracker 的 stage 计时（TICK_TRACE）。"""
+    fixtures = load_fixtures(args.fixtures)
+    mock = MockExchange(fixtures, args.latency, args.jitter, args.err_429, args.err_418, args.err_1003, args.churn, args.seed)
+    port = mock.start()
+    workdir = tempfile.mkdtemp(prefix="wallet-bench-")
+    configure_tracker(port, workdir)
+    # 错误只注入到 Binance 请求；默认的 hyperliquid 价格源不请求 Binance，注入错误时改用 binance 才能覆盖限流保护
+    price_source = args.price_source or ("binance" if args.err_429 or args.err_418 or args.err_1003 else None)
+    if price_source:
+        tracker.PRICE_SOURCE = price_source
+    stream = None
+    if args.ticker_stream:
+        stream = MockTickerStream(mock)
+        tracker.BINANCE_WS_API = f"ws://127.0.0.1:{stream.start()}"
+        tracker.TICKER_STREAM = True
+
+    timer = StageTimer()
+    for name in ("fetch_all_tickers", "fetch_position_prices", "safe_get", "detect_changes", "append_history", "read_last_history", "send_email"):
+        if hasattr(tracker, name):
+            timer.wrap(name)
+
+    addresses = [f"0x{i:040x}" for i in range(1, args.wallets + 1)]
+    if len(addresses) > 1:
+        tracker.TARGET_ADDRESSES = ",".join(addresses)
+    else:
+        tracker.TARGET, tracker.TARGET_ADDRESSES = addresses[0], ""
+    tracker.TARGET_FILE = ""
+    tracker.POLL_INTERVAL = args.interval
+
+    rows: List[Dict[str, float]] = []
+    real_trace, real_wait = tracker.write_tick_trace, tracker.wait_next_tick
+    prefix = "stage{stage="
+
+    def trace(iteration: int, **extra) -> None:
+        with tracker.METRICS_LOCK:
+            stages = dict(tracker.TICK_TRACE["stages"])
+        row = {k[len(prefix):-1]: v for k, v in stages.items() if k.startswith(prefix)}
+        row.update(timer.take())
+        rows.append(row)
+        real_trace(iteration, **extra)
+
+    def wait(timeout: float) -> set:
+        if len(rows) >= args.iterations:
+            raise _BenchDone()
+        return real_wait(timeout)
+
+    tracker.write_tick_trace, tracker.wait_next_tick = trace, wait
+    tracemalloc.start()
+    real_stdout = sys.stdout
+    sys.stdout = _NullWriter()
+    try:
+        tracker.main()
+    except _BenchDone:
+        pass
+    finally:
+        sys.stdout = real_stdout
+        tracker.write_tick_trace, tracker.wait_next_tick = real_trace, real_wait
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if stream is not None:
+            stream.stop()
+        mock.stop()
+
+    return {"rows": rows, "counts": dict(mock.counts), "errors": dict(mock.errors), "calls": dict(timer.calls), "peak": peak,
+            "args": vars(args), "price_source": tracker.PRICE_SOURCE}
+
+
+def _wait_for(cond, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.05)
+    return cond()
+
+
+def stream_check(args) -> bool:
+    """驱动推送行情路径：连接后 REST 补齐、解析 !miniTicker@arr 帧、断流回退 REST、服务器断线后重连并再次补齐。"""
+    mock = MockExchange(load_fixtures(args.fixtures), seed=args.seed)
+    port = mock.start()
+    configure_tracker(port, tempfile.mkdtemp(prefix="wallet-bench-"))
+    stream = MockTickerStream(mock, period=0.1)
+    tracker.BINANCE_WS_API = f"ws://127.0.0.1:{stream.start()}"
+    tracker.TICKER_STREAM = True
+    tracker.TICKER_STREAM_STALE = 1.0  # 缩短断流判定，检查在几秒内完成
+    st = tracker.TICKER_STREAM_STATE
+    rest = lambda: mock.counts.get("GET /api/v3/ticker/price", 0)
+    fixture = {t["symbol"]: float(t["price"]) for t in mock.fixtures["tickers"]}
+    results = []
+
+    def check(name: str, ok: bool) -> None:
+        results.append(ok)
+        print(("通过  " if ok else "失败  ") + name)
+
+    try:
+        tracker.start_ticker_stream()
+        check("连接推送并用一次 REST 全量补齐", _wait_for(tracker.ticker_stream_healthy, 5) and rest() == 1)
+        time.sleep(0.5)
+        table = tracker.fetch_all_tickers(force=True)
+        moved = sum(1 for sym, px in fixture.items() if table.get(sym) is not None and abs(table.get(sym) - px) > 1e-12)
+        check(f"解析 miniTicker 帧并原地更新 ticker 表（{moved} 个交易对有变化）", moved > 0)
+        check("推送健康时 fetch_all_tickers(force=True) 不发 REST 请求", rest() == 1)
+        stream.paused = True
+        check("断流超过 TICKER_STREAM_STALE 后判为不健康", _wait_for(lambda: not tracker.ticker_stream_healthy(), 3))
+        before = rest()
+        tracker.fetch_all_tickers(force=True)
+        check("断流期间 fetch_all_tickers 回退到 REST", rest() > before)
+        stream.paused = False
+        check("恢复推送后重新连上", _wait_for(tracker.ticker_stream_healthy, 10))
+        reconnects, before = st["reconnects"], rest()
+        stream.drop()
+        check("服务器断线后重连", _wait_for(lambda: st["reconnects"] > reconnects and tracker.ticker_stream_healthy(), 10))
+        check("重连后用 REST 补齐缺口", rest() > before)
+    finally:
+        stream.stop()
+        mock.stop()
+    return all(results)
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[idx]
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    rows = result["rows"]
+    args = result["args"]
+    lines = [
+        f"wallet-tracker 基准: {args['iterations']} 轮, {args['wallets']} 个地址, 延迟 {args['latency']}±{args['jitter']}ms, "
+        f"注入 429={args['err_429']} 418={args['err_418']} -1003={args['err_1003']}, churn={args['churn']}, 价格源={result['price_source']}",
+        "",
+        f"{'阶段':<32}{'首轮(ms)':>10}{'均值(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'总计(ms)':>11}{'调用数':>8}",
+    ]
+    stages = []
+    for r in rows:
+        for k in r:
+            if k not in stages:
+                stages.append(k)
+    for name in stages:
+        vals = [r.get(name, 0.0) * 1000 for r in rows]
+        warm = vals[1:] or vals
+        lines.append(f"{name:<32}{vals[0]:>10.2f}{statistics.mean(warm):>10.2f}{_pct(warm, 50):>10.2f}{_pct(warm, 95):>10.2f}{sum(vals):>11.1f}{result['calls'].get(name, len(rows)):>8}")
+    lines.append("")
+    lines.append("每个接口的请求数（总计 / 每轮）:")
+    for k, v in sorted(result["counts"].items()):
+        lines.append(f"  {k:<44}{v:>8}{v / max(1, len(rows)):>10.1f}")
+    if result["errors"]:
+        lines.append("注入的错误: " + ", ".join(f"{k}={v}" for k, v in sorted(result["errors"].items())))
+    lines.append(f"峰值内存(tracemalloc): {result['peak'] / 1024 / 1024:.2f} MiB")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="wallet-tracker 离线基准测试")
+    ap.add_argument("-n", "--iterations", type=int, default=20)
+    ap.add_argument("--wallets", type=int, default=1, help="模拟的地址数量（>1 时走多地址并发路径）")
+    ap.add_argument("--latency", type=float, default=0.0, help="每个请求的基础延迟（毫秒）")
+    ap.add_argument("--jitter", type=float, default=0.0, help="延迟抖动（毫秒，均匀分布）")
+    ap.add_argument("--price-source", choices=("hyperliquid", "binance"), help="PRICE_SOURCE；默认沿用 tracker 的设置，注入错误时为 binance")
+    ap.add_argument("--err-429", type=float, default=0.0, help="Binance 请求返回 429 的比例")
+    ap.add_argument("--err-418", type=float, default=0.0, help="Binance 请求返回 418 的比例")
+    ap.add_argument("--err-1003", type=float, default=0.0, help="Binance 请求返回 -1003 封禁的比例")
+    ap.add_argument("--churn", type=float, default=0.0, help="每次拉取时改动一个持仓的概率")
+    ap.add_argument("--interval", type=float, default=0.0, help="两轮之间的间隔（秒）")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--fixtures", default=FIXTURES_DIR)
+    ap.add_argument("--json", action="store_true", help="以 JSON 输出原始结果")
+    ap.add_argument("--out", help="同时把报告写入该文件")
+    ap.add_argument("--record", action="store_true", help="从线上接口重新录制 fixtures 后退出")
+    ap.add_argument("--ticker-stream", action="store_true", help="行情走本地 WebSocket 推送替身（TICKER_STREAM=1）")
+    ap.add_argument("--stream-check", action="store_true", help="检查推送行情的解析、断流回退与重连后退出")
+    args = ap.parse_args(argv)
+
+    if args.record:
+        record_fixtures(args.fixtures, tracker.TARGET)
+        return
+    if args.stream_check:
+        sys.exit(0 if stream_check(args) else 1)
+    result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,12 @@ import time
 import requests
 import smtplib
 from email.message import EmailMessage
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeout, wait as futures_wait
+import threading
+from collections import deque
+from collections.abc import Mapping
+from array import array
 import math
 import math
 import json
@@ -26,14 +31,72 @@ import io
 import sys
 import datetime
 import re
+import sqlite3
+import atexit
+import queue
+import shutil
+import functools
+import contextlib
+import types
+import stat
+import ast
+import random
+import socket
+import heapq
+import multiprocessing
+from multiprocessing.connection import wait as connection_wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from colorama import init as colorama_init, Fore, Style
 import unicodedata
 
+try:
+    import websocket  # websocket-client，仅推送模式（行情 / 账户）需要
+except ImportError:
+    websocket = None
+
+try:
+    import numpy as np  # 可选：批量持仓计算的列式实现，未安装时回退到纯 Python
+except ImportError:
+    np = None
+
 colorama_init(autoreset=True)
 
 
-def print_kv(label: str, *values, indent: int = 4, label_width: int = 10, label_color=Fore.YELLOW, value_color=None, end="\n"):
+@functools.lru_cache(maxsize=4096)
+def _display_width(s: str) -> int:
+    """终端显示宽度：'W'(wide) 与 'F'(fullwidth) 字符占 2 列，其余占 1 列。结果按字符串缓存。"""
+    w = 0
+    for ch in s:
+        w += 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+    return w
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_label(label: str, label_width: int) -> str:
+    """把标签截断/补齐到 label_width 个显示列并加上冒号；标签种类有限，结果缓存复用。"""
+    if not label_width or label_width <= 0:
+        return label
+    desired = int(label_width)
+    core_w = _display_width(label)
+    if core_w < desired:
+        # 不足则补空格
+        return label + " " * (desired - core_w) + ":"
+    cur_w = 0
+    out_chars = []
+    for ch in label:
+        ch_w = _display_width(ch)
+        if cur_w + ch_w > desired:
+            break
+        out_chars.append(ch)
+        cur_w += ch_w
+    # 如果不足宽度则填充空格
+    if cur_w < desired:
+        out_chars.append(" " * (desired - cur_w))
+    return "".join(out_chars) + ":"
+
+
+def print_kv(label: str, *values, indent: int = 4, label_width: int = 10, label_color=Fore.YELLOW, value_color=None, end="\n", file=None):
     """统一的键值打印，保证左端对齐与冒号对齐。
 
     - label: 字段名（不包含冒号）
@@ -41,70 +104,181 @@ def print_kv(label: str, *values, indent: int = 4, label_width: int = 10, label_
     - indent: 左侧缩进空格数
     - label_width: 标签字段宽度（用于冒号对齐）
     - label_color/value_color: colorama 前缀（可为 None）
+    - file: 输出目标，默认为当前的 sys.stdout
     """
     try:
-
-        def _display_width(s: str) -> int:
-            w = 0
-            for ch in s:
-                ea = unicodedata.east_asian_width(ch)
-                # 'W' (wide) and 'F' (fullwidth) -> width 2, others -> width 1
-                w += 2 if ea in ("W", "F") else 1
-            return w
-
-        def _truncate_or_pad_to_width(s: str, width: int) -> str:
-            cur_w = 0
-            out_chars = []
-            for ch in s:
-                ch_w = 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
-                if cur_w + ch_w > width:
-                    break
-                out_chars.append(ch)
-                cur_w += ch_w
-            # 如果不足宽度则填充空格
-            if cur_w < width:
-                out_chars.append(" " * (width - cur_w))
-            return "".join(out_chars)
-
         prefix = " " * indent
         # 合并值为单一字符串
-        val_parts = []
-        for v in values:
-            if v is None:
-                val_parts.append("N/A")
-            else:
-                val_parts.append(str(v))
-        val_str = " ".join(val_parts)
-        lbl_core = f"{label}"
-        if label_width and label_width > 0:
-            # 使用显示宽度（考虑中文等全角字符）
-            desired = int(label_width)
-            core_w = _display_width(lbl_core)
-            if core_w >= desired:
-                lbl_body = _truncate_or_pad_to_width(lbl_core, desired)
-            else:
-                # 不足则补空格
-                lbl_body = lbl_core + " " * (desired - core_w)
-            lbl = lbl_body + ":"
-        else:
-            lbl = lbl_core
+        val_str = " ".join("N/A" if v is None else str(v) for v in values)
+        # 使用显示宽度（考虑中文等全角字符）
+        lbl = _format_label(f"{label}", label_width)
         if value_color:
-            print(prefix + (label_color or "") + lbl + " " + value_color + val_str, end=end)
+            print(prefix + (label_color or "") + lbl + " " + value_color + val_str, end=end, file=file)
         else:
-            print(prefix + (label_color or "") + lbl + " " + val_str, end=end)
+            print(prefix + (label_color or "") + lbl + " " + val_str, end=end, file=file)
     except Exception:
         # 回退到简单打印，避免因为格式化失败导致中断
-        print(label + ":", " ".join([str(v) for v in values]))
+        print(label + ":", " ".join([str(v) for v in values]), file=file)
+
+
+# 增量终端渲染：保存上一帧的各行，只用 ANSI 光标定位重写发生变化的行，取代每轮 os.system('clear') 全屏重绘。
+# 帧高度超过终端时只显示能容纳的部分并提示省略行数；输出不是终端（重定向到文件/管道）时直接打印整帧。
+RENDER_STATE = {"lines": None, "size": None, "frames": 0}
+RENDER_FULL_EVERY = 120  # 每隔多少帧强制全屏重绘一次，清除其它线程意外打印到屏幕上的内容
+_SGR_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def _sgr_slot(code: str) -> str:
+    """SGR 参数所属的类别：前景色 / 背景色 / 亮度，同类后出现的覆盖先出现的。"""
+    n = int(code) if code.isdigit() else 0
+    if 30 <= n <= 39 or 90 <= n <= 97:
+        return "fg"
+    if 40 <= n <= 49 or 100 <= n <= 107:
+        return "bg"
+    return "style"
+
+
+@functools.lru_cache(maxsize=8192)
+def _line_sgr_effect(line: str) -> Tuple[bool, Tuple[Tuple[str, str], ...]]:
+    """一行文本对颜色状态的净影响：(是否出现过重置, 最后一次重置之后各类别生效的 SGR 序列)。按行缓存，帧间重复的行不再扫描。"""
+    reset = False
+    effects: Dict[str, str] = {}
+    for code in _SGR_RE.findall(line):
+        params = code[2:-1]
+        if params in ("", "0"):
+            reset = True
+            effects.clear()
+        else:
+            effects[_sgr_slot(params.split(";")[0])] = code
+    return reset, tuple(effects.items())
+
+
+def _carry_colors(lines: List[str]) -> List[str]:
+    """把上一行结束时仍生效的颜色前缀补到下一行开头，使每行都能单独重绘且颜色与整帧打印一致。"""
+    out = []
+    active: Dict[str, str] = {}
+    for line in lines:
+        out.append("".join(active.values()) + line if active else line)
+        reset, effects = _line_sgr_effect(line)
+        if reset:
+            active.clear()
+        for slot, code in effects:
+            active[slot] = code
+    return out
+
+
+def render_frame(text: str) -> None:
+    """把一整帧文本输出到终端，只重写与上一帧不同的行。"""
+    out = sys.stdout
+    try:
+        is_tty = out.isatty()
+    except Exception:
+        is_tty = False
+    if not is_tty:
+        out.write(text)
+        out.flush()
+        return
+
+    size = shutil.get_terminal_size()
+    lines = _carry_colors(text.rstrip("\n").split("\n"))
+    if len(lines) >= size.lines:
+        hidden = len(lines) - (size.lines - 2)
+        lines = lines[: size.lines - 2] + [Fore.YELLOW + f"... 省略 {hidden} 行（终端高度不足）"]
+
+    prev = RENDER_STATE["lines"]
+    # 关闭自动换行，保证每条逻辑行只占一行屏幕，行号与屏幕行一一对应
+    parts = ["\x1b[?7l"]
+    RENDER_STATE["frames"] += 1
+    if prev is None or size != RENDER_STATE["size"] or RENDER_STATE["frames"] % RENDER_FULL_EVERY == 0:
+        parts.append("\x1b[H\x1b[2J")
+        prev = []
+    for i, line in enumerate(lines):
+        if i >= len(prev) or prev[i] != line:
+            parts.append(f"\x1b[{i + 1};1H\x1b[0m{line}\x1b[0m\x1b[K")
+    if len(lines) < len(prev):
+        parts.append(f"\x1b[{len(lines) + 1};1H\x1b[J")
+    parts.append(f"\x1b[{len(lines) + 1};1H\x1b[?7h")
+    out.write("".join(parts))
+    out.flush()
+    RENDER_STATE["lines"] = lines
+    RENDER_STATE["size"] = size
+
 
 # 配置
+# RPC_API 可以是逗号分隔的多个端点（主节点 + 自建镜像）：每次请求发给近期延迟最低的健康端点，
+# 超过该端点延迟的 RPC_HEDGE_PERCENTILE 分位仍未返回时再向下一个端点发一份对冲请求，先返回的为准；
+# 出错的端点被摘除 RPC_EJECT_SECONDS 秒（连续失败时翻倍，最多 RPC_EJECT_MAX 秒）。
 RPC_API = os.getenv("RPC_API", "https://api.hyperliquid.xyz/info")
+RPC_HEDGE_PERCENTILE = float(os.getenv("RPC_HEDGE_PERCENTILE", "0.9"))
+RPC_HEDGE_DELAY = 1.0  # 样本不足时的对冲等待秒数
+RPC_HEDGE_MIN = 0.05
+RPC_EJECT_SECONDS = float(os.getenv("RPC_EJECT_SECONDS", "30"))
+RPC_EJECT_MAX = 300.0
+# RPC 客户端：独立的连接池会话（keep-alive 复用 TLS 连接），连接/读取分别超时，
+# 网络错误、超时、429 与 5xx 按带抖动的指数退避重试 RPC_RETRIES 次；其它 4xx（如 422）不重试。
+RPC_POOL_SIZE = int(os.getenv("RPC_POOL_SIZE", "32"))
+RPC_CONNECT_TIMEOUT = float(os.getenv("RPC_CONNECT_TIMEOUT", "3.05"))
+RPC_READ_TIMEOUT = float(os.getenv("RPC_READ_TIMEOUT", "10"))
+RPC_RETRIES = int(os.getenv("RPC_RETRIES", "2"))
+RPC_BACKOFF = 0.25  # 首次重试前的等待秒数，之后翻倍，每次乘以 0.5~1.5 的随机抖动
+RPC_MAX_BACKOFF = 5.0
 TARGET = os.getenv("TARGET_ADDRESS", "0xc2a30212a8DdAc9e123944d6e29FADdCe994E5f2").lower()
 #TARGET = os.getenv("TARGET_ADDRESS", "0xa650cbd841d3930df5adc53b9a35422fc558083b").lower()
 
-
+# 多地址监控：TARGET_ADDRESSES 为逗号分隔的地址列表，TARGET_FILE 为每行一个地址的文本文件（# 开头为注释）。
+# 两者都未配置时只监控 TARGET；配置了多个地址时 main() 进入多地址模式，并发拉取所有账户状态。
+TARGET_ADDRESSES = os.getenv("TARGET_ADDRESSES", "")
+TARGET_FILE = os.getenv("TARGET_FILE", "")
+# 多地址模式下并发拉取账户状态的线程数
+WALLET_WORKERS = int(os.getenv("WALLET_WORKERS", "32"))
+# 分片模式：SHARD_WORKERS>1 时把地址轮流分给多个常驻子进程，每个子进程对自己的分片做
+# fetch_state -> build_position_summary -> detect_changes，只把变更事件回传；主进程（协调者）负责
+# 合并事件、渲染、邮件与历史记录。用于上万地址、单进程受 GIL 限制的场景。子进程以 spawn 方式启动，
+# 配置通过环境变量继承。分片模式不使用推送与成交增量模式，也不求值 position 告警规则。
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_TIMEOUT = float(os.getenv("SHARD_TIMEOUT", "120"))  # 秒，分片超过该时间未回复则本轮记为失败
 
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))  # 秒
 
+# 自适应轮询（多地址模式）：POLL_ADAPTIVE=1 时每个地址有自己的下次拉取时间，按到期时间放在优先队列里。
+# 持仓刚变化或接近强平价（相对距离 POLL_LIQ_DISTANCE 以内）的地址按 POLL_MIN_INTERVAL 拉取，持仓没变的地址
+# 每次间隔翻倍，最长 POLL_MAX_INTERVAL。全部地址合计的拉取速率不超过 POLL_BUDGET 次/秒（0 表示
+# 地址数/POLL_INTERVAL，即不超过固定间隔轮询的负载），超出预算的到期地址顺延，接近强平与活跃的地址优先。
+POLL_ADAPTIVE = os.getenv("POLL_ADAPTIVE", "0") == "1"
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "5"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "600"))
+POLL_BUDGET = float(os.getenv("POLL_BUDGET", "0"))
+POLL_LIQ_DISTANCE = float(os.getenv("POLL_LIQ_DISTANCE", "0.1"))
+
+# 现价来源：hyperliquid（默认）每轮用一次 allMids 请求取得全部币种的中间价，各周期收盘价（ROI/价格变动）
+# 取自 Hyperliquid candleSnapshot，现价与收盘价同源；Hyperliquid 没有中间价的币种整体回退到 Binance
+# （现价与收盘价都来自 Binance）。binance 则只使用 Binance ticker 与 K 线。
+PRICE_SOURCE = os.getenv("PRICE_SOURCE", "hyperliquid").lower()
+HL_MIDS_TTL = float(os.getenv("HL_MIDS_TTL", "2"))  # 秒，同一轮内多次取价只请求一次
+# 每轮行情数据规划：先汇总本轮需要的全部 (交易对, 周期) 并去重，再用 MARKET_WORKERS 个线程并发拉取，
+# 得到一份只读的行情快照，持仓渲染与变更通知共用，同一币种一轮只取一次。
+MARKET_WORKERS = int(os.getenv("MARKET_WORKERS", "8"))
+
+# 成交增量模式：FILLS_MODE=1 时每轮用 userFillsByTime 从各地址持久化的游标（startTime）起只拉取新成交，
+# 按币种聚合为新增/平仓/变动事件（带精确成交价与时间），替代两次快照之间按持仓大小推断的比对；
+# 先开后平、部分成交相互抵消等快照比对看不到的交易也会被通知。游标保存在 FILLS_CURSOR_FILE，重启后从上次位置继续。
+# 该模式下只有出现新成交的地址才重新拉取 clearinghouseState，其余地址沿用上次的状态，每 STATE_RECONCILE_INTERVAL 秒对账一次。
+FILLS_MODE = os.getenv("FILLS_MODE", "0") == "1"
+FILLS_CURSOR_FILE = os.getenv("FILLS_CURSOR_FILE", "fills_cursor.json")
+FILLS_PAGE_LIMIT = 2000  # userFillsByTime 单次最多返回的条数
+FILLS_MAX_PAGES = 5
+
+# 账户推送模式：STATE_STREAM=1 时通过 RPC 的 WebSocket 订阅 webData2，持仓一变化立即触发解析/通知；
+# 完整的 clearinghouseState 请求只在每 STATE_RECONCILE_INTERVAL 秒对账一次。需要安装 websocket-client。
+# Hyperliquid 限制单 IP 最多订阅 10 个不同用户，超出 STATE_STREAM_MAX_USERS 的地址继续按 POLL_INTERVAL 轮询。
+STATE_STREAM = os.getenv("STATE_STREAM", "0") == "1"
+RPC_WS_API = os.getenv("RPC_WS_API", "")  # 为空时由 RPC_API 推导（https://.../info -> wss://.../ws）
+STATE_RECONCILE_INTERVAL = int(os.getenv("STATE_RECONCILE_INTERVAL", "300"))
+STATE_STREAM_MAX_USERS = int(os.getenv("STATE_STREAM_MAX_USERS", "10"))
+STATE_STREAM_STALE = 60  # 超过该秒数未收到任何消息视为断流并重连
+STATE_STREAM_PING = 30  # 空闲多少秒发送一次 ping（服务端约 60 秒无消息会断开）
+STATE_STREAM_DEBOUNCE = 1.0  # 收到持仓变化后再等待的秒数，合并同一笔交易的连续推送
+
 # SMTP / 邮件相关（可直接在此处配置，或使用环境变量覆盖）。
 # 注意：163 邮箱需要使用 SMTP 授权码，请使用授权码而非登录密码；生产环境建议使用环境变量或密钥管理服务来保存凭据。
 SMTP_HOST = "smtp.163.com"
@@ -124,6 +298,208 @@ SMTP_USE_SSL = True
 # EMAIL_FROM = os.getenv("EMAIL_FROM", EMAIL_FROM)
 # EMAIL_TO = os.getenv("EMAIL_TO", EMAIL_TO)
 
+# 邮件由后台线程发送，不阻塞轮询：EMAIL_BATCH_WINDOW 秒内到达的多条通知合并为一封摘要邮件；
+# 登录后的 SMTP 连接在空闲时用 NOOP 保活并复用，空闲超过 EMAIL_IDLE_CLOSE 秒后断开；发送失败按指数退避重试 EMAIL_MAX_RETRIES 次。
+EMAIL_BATCH_WINDOW = float(os.getenv("EMAIL_BATCH_WINDOW", "10"))
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "5"))
+EMAIL_KEEPALIVE = 60
+EMAIL_IDLE_CLOSE = 300
+
+# 告警规则：ALERT_RULES_FILE 为 JSON 规则列表，为空时保持原行为（任何持仓变更都发邮件）。
+# 每条规则形如 {"name": "...", "wallet": "0x..."|"*", "coin": "BTC"|"*", "on": "change"|"position", "when": "ratio_total > 0.05"}，
+# when 表达式在加载时编译一次，并按 (wallet, coin) 建索引；详见 load_alert_rules。
+ALERT_RULES_FILE = os.getenv("ALERT_RULES_FILE", "")
+
+# 跨地址聚合敞口（多地址模式）：按持仓变更增量维护每个币种的多/空名义价值与持仓地址数，
+# 并在 EXPOSURE_WINDOWS 各滑动窗口内累计净流入；终端显示 EXPOSURE_WINDOW 窗口内净流入绝对值最大的 EXPOSURE_TOP_N 个币种。
+EXPOSURE_WINDOWS = [w.strip() for w in os.getenv("EXPOSURE_WINDOWS", "5m,1h,24h").split(",") if w.strip()]
+EXPOSURE_WINDOW = os.getenv("EXPOSURE_WINDOW", "1h")
+EXPOSURE_TOP_N = int(os.getenv("EXPOSURE_TOP_N", "10"))
+
+
+def _rpc_session() -> requests.Session:
+    sess = requests.Session()
+    sess.headers.update({"User-Agent": "wallet-tracker/1.0", "Content-Type": "application/json"})
+    # 连接数与并发拉取线程数对齐；pool_block=True 时超出的请求排队等待空闲连接，而不是新建后丢弃
+    size = max(RPC_POOL_SIZE, WALLET_WORKERS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=size, pool_block=True)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+
+RPC_SESSION = _rpc_session()
+# 响应时间统计：ewma 为平滑后的成功请求耗时（秒），不区分端点
+RPC_STATS = {"ewma": None, "last": None, "errors": 0, "retries": 0, "hedges": 0}
+# 各端点状态：url -> {"lat": 最近成功耗时, "ewma", "fails": 连续失败次数, "ejected_until"}
+RPC_ENDPOINT_STATS: Dict[str, Dict[str, Any]] = {}
+RPC_LOCK = threading.Lock()
+RPC_HEDGE_POOL: Dict[str, Any] = {"pool": None}
+
+
+def rpc_endpoints() -> List[str]:
+    """RPC_API 中配置的端点列表（保持配置顺序）。"""
+    return [u.strip() for u in RPC_API.split(",") if u.strip()]
+
+
+def _endpoint_stats(url: str) -> Dict[str, Any]:
+    st = RPC_ENDPOINT_STATS.get(url)
+    if st is None:
+        st = RPC_ENDPOINT_STATS[url] = {"lat": deque(maxlen=64), "ewma": None, "fails": 0, "ejected_until": 0.0}
+    return st
+
+
+def _rpc_track(url: str, elapsed: float) -> None:
+    with RPC_LOCK:
+        RPC_STATS["last"] = elapsed
+        ewma = RPC_STATS["ewma"]
+        RPC_STATS["ewma"] = elapsed if ewma is None else ewma * 0.8 + elapsed * 0.2
+        st = _endpoint_stats(url)
+        st["lat"].append(elapsed)
+        st["ewma"] = elapsed if st["ewma"] is None else st["ewma"] * 0.8 + elapsed * 0.2
+        st["fails"] = 0
+        st["ejected_until"] = 0.0
+
+
+def _rpc_eject(url: str) -> None:
+    with RPC_LOCK:
+        RPC_STATS["errors"] += 1
+        st = _endpoint_stats(url)
+        st["fails"] += 1
+        if len(rpc_endpoints()) > 1:
+            st["ejected_until"] = time.time() + min(RPC_EJECT_SECONDS * 2 ** (st["fails"] - 1), RPC_EJECT_MAX)
+            inc("rpc_ejections", url=url)
+
+
+def _rpc_order() -> List[str]:
+    """按近期延迟排序的候选端点：健康端点在前（还没有样本的视为最快，以便尽快探测），全部被摘除时按恢复时间排序。"""
+    urls = rpc_endpoints()
+    if len(urls) <= 1:
+        return urls
+    now = time.time()
+    with RPC_LOCK:
+        stats = {u: _endpoint_stats(u) for u in urls}
+        healthy = [u for u in urls if stats[u]["ejected_until"] <= now]
+        if not healthy:
+            return sorted(urls, key=lambda u: stats[u]["ejected_until"])
+        healthy.sort(key=lambda u: stats[u]["ewma"] or 0.0)
+        ejected = sorted((u for u in urls if u not in healthy), key=lambda u: stats[u]["ejected_until"])
+    return healthy + ejected
+
+
+def _hedge_deadline(url: str) -> float:
+    with RPC_LOCK:
+        lat = sorted(_endpoint_stats(url)["lat"])
+    if len(lat) < 8:
+        return RPC_HEDGE_DELAY
+    return max(RPC_HEDGE_MIN, lat[int(RPC_HEDGE_PERCENTILE * (len(lat) - 1))])
+
+
+def _rpc_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    resp = getattr(exc, "response", None)
+    return resp is not None and (resp.status_code == 429 or resp.status_code >= 500)
+
+
+def _rpc_post(url: str, body: Dict[str, Any], endpoint: str) -> Any:
+    """向单个端点发送一次请求；失败时抛出异常，可重试的失败（网络、超时、429、5xx）会摘除该端点。"""
+    t0 = time.perf_counter()
+    try:
+        resp = RPC_SESSION.post(url, json=body, timeout=(RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        observe("http_request", time.perf_counter() - t0, service="rpc", endpoint=endpoint)
+        inc("http_requests", service="rpc", endpoint=endpoint, status="timeout" if isinstance(e, requests.Timeout) else "error")
+        _rpc_eject(url)
+        raise
+    elapsed = time.perf_counter() - t0
+    observe("http_request", elapsed, service="rpc", endpoint=endpoint)
+    inc("http_requests", service="rpc", endpoint=endpoint, status=resp.status_code)
+    if resp.status_code == 200:
+        _rpc_track(url, elapsed)
+        return resp.json()
+    if resp.status_code == 429 or resp.status_code >= 500:
+        _rpc_eject(url)
+    else:
+        with RPC_LOCK:
+            RPC_STATS["errors"] += 1
+    resp.raise_for_status()
+    raise requests.HTTPError(f"{resp.status_code} for {url}", response=resp)
+
+
+def _rpc_post_started(started: threading.Event, url: str, body: Dict[str, Any], endpoint: str) -> Any:
+    started.set()
+    return _rpc_post(url, body, endpoint)
+
+
+def _rpc_hedged(body: Dict[str, Any], endpoint: str) -> Any:
+    """发给最快的端点；超过其延迟分位仍未返回（或已可重试地失败）时向下一个端点发对冲请求，取先成功的结果。
+
+    对冲等待从主请求真正开始执行时计时，不把在对冲线程池里排队的时间算进去。
+    """
+    urls = _rpc_order()
+    if len(urls) == 1:
+        return _rpc_post(urls[0], body, endpoint)
+    if RPC_HEDGE_POOL["pool"] is None:
+        RPC_HEDGE_POOL["pool"] = ThreadPoolExecutor(max_workers=2 * max(RPC_POOL_SIZE, WALLET_WORKERS), thread_name_prefix="rpc-hedge")
+    pool = RPC_HEDGE_POOL["pool"]
+    started = threading.Event()
+    primary = pool.submit(_rpc_post_started, started, urls[0], body, endpoint)
+    pending = {primary}
+    try:
+        started.wait()
+        return primary.result(timeout=_hedge_deadline(urls[0]))
+    except FutureTimeout:
+        with RPC_LOCK:
+            RPC_STATS["hedges"] += 1
+        inc("rpc_hedges", endpoint=endpoint)
+    except Exception as e:
+        if not _rpc_retryable(e):
+            raise
+        pending = set()
+    pending.add(pool.submit(_rpc_post, urls[1], body, endpoint))
+    error = None
+    while pending:
+        done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            exc = fut.exception()
+            if exc is None:
+                return fut.result()
+            error = error or exc
+    raise error
+
+
+def rpc_info(body: Dict[str, Any], retries: int = None) -> Any:
+    """向 RPC_API 发送一次 info 请求并返回解析后的 JSON，按请求类型记录耗时与状态码。
+
+    使用连接池会话 RPC_SESSION，(连接, 读取) 超时为 (RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT)；
+    配置了多个端点时按 _rpc_hedged 选择端点并对冲。网络错误、超时、429、5xx 最多重试
+    retries（默认 RPC_RETRIES）次，出错的端点已被摘除，重试会落到其它端点；重试间隔带随机抖动。
+    最后一次仍失败时抛出异常。
+    """
+    endpoint = body.get("type", "unknown")
+    attempts = (RPC_RETRIES if retries is None else retries) + 1
+    delay = RPC_BACKOFF
+    for attempt in range(attempts):
+        if attempt:
+            with RPC_LOCK:
+                RPC_STATS["retries"] += 1
+            inc("http_retries", service="rpc", endpoint=endpoint)
+        try:
+            return _rpc_hedged(body, endpoint)
+        except Exception as e:
+            if attempt == attempts - 1 or not _rpc_retryable(e):
+                raise
+            resp = getattr(e, "response", None)
+            wait = (safe_float(resp.headers.get("Retry-After")) if resp is not None else None) or delay
+        # 还有其它健康端点时立即切换，不必等待退避
+        if len(rpc_endpoints()) > 1 and any(_endpoint_stats(u)["ejected_until"] <= time.time() for u in rpc_endpoints()):
+            wait = 0.0
+        if wait:
+            inc("http_backoff_seconds", wait, service="rpc")
+            time.sleep(min(wait, RPC_MAX_BACKOFF) * random.uniform(0.5, 1.5))
+        delay *= 2
+
 
 def fetch_state(user_address: str) -> Dict[str, Any]:
     body = {
@@ -131,19 +507,601 @@ def fetch_state(user_address: str) -> Dict[str, Any]:
         "user": user_address,
         "dex": ""
     }
-    resp = requests.post(RPC_API, json=body)
-    resp.raise_for_status()
-    return resp.json()
+    return rpc_info(body)
+
+
+# Hyperliquid 全部币种中间价缓存：{"ts": 拉取时间, "data": coin -> mid}
+HL_MIDS_CACHE: Dict[str, Any] = {"ts": 0.0, "data": {}}
+HL_MIDS_LOCK = threading.Lock()
+
+
+def fetch_hl_mids(force: bool = False) -> Dict[str, float]:
+    """一次 allMids 请求取得全部币种的中间价（HL_MIDS_TTL 内复用），失败时返回上一次的数据。"""
+    with HL_MIDS_LOCK:
+        if not force and time.time() - HL_MIDS_CACHE["ts"] < HL_MIDS_TTL:
+            return HL_MIDS_CACHE["data"]
+        try:
+            raw = rpc_info({"type": "allMids"})
+            mids = {}
+            for coin, px in (raw or {}).items():
+                v = safe_float(px)
+                if v:
+                    mids[coin] = v
+            HL_MIDS_CACHE["data"] = mids
+        except Exception as e:
+            warn_once("hl_mids_failed", f"[价格] allMids 拉取失败，回退到 Binance: {e}")
+        # 失败时同样等到 TTL 之后再试，避免在同一轮内反复请求
+        HL_MIDS_CACHE["ts"] = time.time()
+        return HL_MIDS_CACHE["data"]
+
+
+# Hyperliquid K 线缓存：(coin, 周期) -> {"close": 上一根已收盘价, "expires": 下一根 K 线收盘时间}
+HL_CANDLE_CACHE: Dict[Tuple[str, str], Dict[str, float]] = {}
+HL_CANDLE_LOCK = threading.Lock()
+
+
+def get_hl_last_closed_close(coin: str, interval: str) -> Any:
+    """Hyperliquid candleSnapshot 上该币种最近一根已收盘 K 线的收盘价（与 allMids 同源），缓存到下一根收盘；失败返回 None。"""
+    sec = INTERVAL_SECONDS.get(interval)
+    if not coin or not sec:
+        return None
+    now = time.time()
+    with HL_CANDLE_LOCK:
+        hit = HL_CANDLE_CACHE.get((coin, interval))
+    if hit and now < hit["expires"]:
+        return hit["close"]
+    now_ms = int(now * 1000)
+    try:
+        data = rpc_info({"type": "candleSnapshot", "req": {"coin": coin, "interval": interval, "startTime": now_ms - 3 * sec * 1000, "endTime": now_ms}})
+    except Exception as e:
+        warn_once(f"hl_candle_failed:{coin}", f"[价格] candleSnapshot 拉取失败 {coin} {interval}: {e}")
+        return None
+    # T 为 K 线的收盘时间（ms，含），尚未收盘的最后一根不取
+    closed = [c for c in data or [] if isinstance(c, dict) and int(c.get("T", 0)) < now_ms]
+    if not closed:
+        return None
+    last = max(closed, key=lambda c: int(c.get("t", 0)))
+    close = safe_float(last.get("c"))
+    if close is not None:
+        with HL_CANDLE_LOCK:
+            HL_CANDLE_CACHE[(coin, interval)] = {"close": close, "expires": (int(last["T"]) + 1) / 1000.0 + sec}
+    return close
+
+
+def get_current_price(coin: str, mids: Dict[str, float] = None) -> Any:
+    """币种现价：PRICE_SOURCE=hyperliquid 时优先取 Hyperliquid 中间价，缺失时回退到 Binance ticker（按价格倍数换算）。"""
+    if PRICE_SOURCE == "hyperliquid":
+        if mids is None:
+            mids = fetch_hl_mids()
+        px = mids.get(coin)
+        if px is not None:
+            return px
+    pair, mult = resolve_pair(coin)
+    if not pair:
+        return None
+    px = fetch_all_tickers().get(pair)
+    return px * mult if px is not None else None
+
+
+# 推送模式的运行状态：STREAM_STATES 为 address -> {"ts", "data", "key"}，key 为持仓大小的指纹；
+# 持仓指纹变化的地址放入 STREAM_DIRTY 并唤醒主循环（STREAM_EVENT）。
+STATE_STREAM_STATE = {"thread": None, "connected": False, "last_msg": 0.0, "reconnects": 0, "users": []}
+STREAM_STATES: Dict[str, Dict[str, Any]] = {}
+STREAM_DIRTY = set()
+STREAM_EVENT = threading.Event()
+STREAM_LOCK = threading.Lock()
+# 每个地址最近一次可用的状态与最近一次 RPC 对账时间，供 collect_states 复用
+LAST_STATES: Dict[str, Dict[str, Any]] = {}
+LAST_RECONCILE: Dict[str, float] = {}
+
+
+def _rpc_ws_url() -> str:
+    if RPC_WS_API:
+        return RPC_WS_API
+    url = rpc_endpoints()[0].replace("https://", "wss://").replace("http://", "ws://").rstrip("/")
+    if url.endswith("/info"):
+        url = url[: -len("/info")]
+    return url + "/ws"
+
+
+def _position_sizes_key(state: Dict[str, Any]) -> Tuple:
+    """仅由 (coin, szi) 组成的持仓指纹，用于判断推送的状态是否涉及持仓变化（忽略浮动盈亏等字段）。"""
+    out = []
+    for w in state.get("assetPositions") or []:
+        pos = w.get("position") or {}
+        out.append((pos.get("coin"), pos.get("szi")))
+    return tuple(sorted(out, key=lambda x: str(x[0])))
+
+
+def _on_stream_state(user: str, state: Dict[str, Any]) -> None:
+    key = _position_sizes_key(state)
+    with STREAM_LOCK:
+        prev = STREAM_STATES.get(user)
+        STREAM_STATES[user] = {"ts": time.time(), "data": state, "key": key}
+        if prev is None or prev["key"] != key:
+            STREAM_DIRTY.add(user)
+            STREAM_EVENT.set()
+
+
+def _state_stream_loop(users: List[str]) -> None:
+    """后台线程：订阅各地址的 webData2 推送，断线指数退避重连；重连后服务端会先推送一次完整状态，断线期间的变化由此补齐。"""
+    st = STATE_STREAM_STATE
+    delay = 1.0
+    while True:
+        ws = None
+        try:
+            ws = websocket.create_connection(_rpc_ws_url(), timeout=STATE_STREAM_PING)
+            for u in users:
+                ws.send(json.dumps({"method": "subscribe", "subscription": {"type": "webData2", "user": u}}))
+            st["connected"] = True
+            st["last_msg"] = time.time()
+            delay = 1.0
+            while True:
+                try:
+                    msg = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    if time.time() - st["last_msg"] > STATE_STREAM_STALE:
+                        raise
+                    ws.send(json.dumps({"method": "ping"}))
+                    continue
+                st["last_msg"] = time.time()
+                if not msg:
+                    continue
+                payload = json.loads(msg)
+                if not isinstance(payload, dict) or payload.get("channel") != "webData2":
+                    continue
+                data = payload.get("data") or {}
+                user = str(data.get("user") or "").lower()
+                chs = data.get("clearinghouseState")
+                if user and isinstance(chs, dict):
+                    _on_stream_state(user, chs)
+        except Exception as e:
+            warn_once("state_stream_error", f"[推送] 账户推送断开，{delay:.0f}s 后重连: {e}")
+        finally:
+            st["connected"] = False
+            if ws is not None:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+        st["reconnects"] += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)
+
+
+def start_state_stream(addresses: List[str]) -> None:
+    """在 STATE_STREAM 开启时为前 STATE_STREAM_MAX_USERS 个地址启动推送线程（只启动一次）。"""
+    global STATE_STREAM
+    if not STATE_STREAM or STATE_STREAM_STATE["thread"] is not None:
+        return
+    if websocket is None:
+        print(Fore.YELLOW + "[推送] 未安装 websocket-client，账户推送模式不可用，继续轮询 clearinghouseState")
+        STATE_STREAM = False
+        return
+    users = addresses[:STATE_STREAM_MAX_USERS]
+    if len(addresses) > len(users):
+        print(Fore.YELLOW + f"[推送] 仅订阅前 {len(users)} 个地址，其余 {len(addresses) - len(users)} 个继续轮询")
+    STATE_STREAM_STATE["users"] = users
+    t = threading.Thread(target=_state_stream_loop, args=(users,), name="state-stream", daemon=True)
+    STATE_STREAM_STATE["thread"] = t
+    t.start()
+
+
+def get_stream_state(address: str) -> Dict[str, Any]:
+    """返回该地址最近一次推送的 clearinghouseState；推送未连接或数据不新鲜时返回 None。"""
+    if not (STATE_STREAM and STATE_STREAM_STATE["connected"]):
+        return None
+    with STREAM_LOCK:
+        rec = STREAM_STATES.get(address)
+    if not rec or time.time() - rec["ts"] > STATE_STREAM_STALE:
+        return None
+    return rec["data"]
+
+
+def wait_next_tick(timeout: float) -> set:
+    """推送模式下等待持仓变化推送或超时，返回持仓发生变化的地址集合；非推送模式等同于 time.sleep。"""
+    timeout = max(0.0, timeout)
+    if not (STATE_STREAM and STATE_STREAM_STATE["thread"] is not None):
+        time.sleep(timeout)
+        return set()
+    if STREAM_EVENT.wait(timeout):
+        time.sleep(STATE_STREAM_DEBOUNCE)
+    with STREAM_LOCK:
+        dirty = set(STREAM_DIRTY)
+        STREAM_DIRTY.clear()
+        STREAM_EVENT.clear()
+    return dirty
+
+
+def collect_states(addresses: List[str], poll_due: bool = True, due: List[str] = None) -> Dict[str, Any]:
+    """获取本轮各地址的账户状态。
+
+    推送模式下优先使用推送来的状态，只对未订阅、推送不新鲜或到了对账时间的地址发起 RPC；
+    poll_due=False（被推送提前唤醒）时未订阅的地址复用上次的状态。失败的地址对应值为异常对象。
+    due 不为 None 时（自适应轮询）只拉取其中的地址，其余复用上次的状态，从未拉取过的地址不出现在结果中。
+    """
+    now = time.time()
+    out: Dict[str, Any] = {}
+    need = []
+    due = set(due) if due is not None else None
+    for addr in addresses:
+        pushed = get_stream_state(addr)
+        if pushed is not None and now - LAST_RECONCILE.get(addr, 0) < STATE_RECONCILE_INTERVAL:
+            out[addr] = pushed
+        elif due is not None:
+            if addr in due:
+                need.append(addr)
+            elif addr in LAST_STATES:
+                out[addr] = LAST_STATES[addr]
+        elif poll_due or addr not in LAST_STATES:
+            need.append(addr)
+        else:
+            out[addr] = LAST_STATES[addr]
+    for addr, state in fetch_states(need).items():
+        if not isinstance(state, Exception):
+            LAST_RECONCILE[addr] = now
+        out[addr] = state
+    for addr, state in out.items():
+        if isinstance(state, dict):
+            LAST_STATES[addr] = state
+    return out
+
+
+# 自适应轮询调度：heap 为 (到期时间, address) 的优先队列，每个地址同一时刻只有一个条目；
+# wallets: address -> {"interval", "due", "fp": 上次的持仓指纹, "priority": 0 接近强平 / 1 最近有变化 / 2 其它}；
+# tokens/ts/rate 为全局拉取预算的令牌桶，polled/deferred 为上一轮拉取与顺延的地址数。
+POLL_SCHEDULE: Dict[str, Any] = {"heap": [], "wallets": {}, "tokens": 0.0, "ts": 0.0, "rate": 0.0, "polled": 0, "deferred": 0}
+
+
+def init_poll_schedule(addresses: List[str]) -> None:
+    """所有地址立即到期；预算默认等于固定间隔轮询的速率，令牌桶容量为一个 POLL_INTERVAL 的预算。"""
+    sched = POLL_SCHEDULE
+    now = time.time()
+    rate = POLL_BUDGET or len(addresses) / max(POLL_INTERVAL, 1)
+    sched.update(rate=rate, tokens=max(1.0, rate * POLL_INTERVAL), ts=now, polled=0, deferred=0)
+    sched["heap"] = [(now, addr) for addr in addresses]
+    heapq.heapify(sched["heap"])
+    sched["wallets"] = {addr: {"interval": float(POLL_INTERVAL), "due": now, "fp": None, "priority": 2} for addr in addresses}
+
+
+def due_wallets(now: float = None) -> List[str]:
+    """取出已到期的地址：按优先级、再按到期先后在预算内选取，超出预算的留在队列里下一轮再取。"""
+    sched = POLL_SCHEDULE
+    now = now or time.time()
+    cap = max(1.0, sched["rate"] * POLL_INTERVAL)
+    sched["tokens"] = min(cap, sched["tokens"] + sched["rate"] * (now - sched["ts"]))
+    sched["ts"] = now
+    heap, wallets = sched["heap"], sched["wallets"]
+    ready = []
+    while heap and heap[0][0] <= now:
+        ready.append(heapq.heappop(heap))
+    ready.sort(key=lambda e: (wallets[e[1]]["priority"], e[0]))
+    take = ready[:int(sched["tokens"])]
+    for entry in ready[len(take):]:
+        heapq.heappush(heap, entry)
+    sched["tokens"] -= len(take)
+    sched["polled"], sched["deferred"] = len(take), len(ready) - len(take)
+    if sched["deferred"]:
+        inc("polls_deferred", sched["deferred"])
+    return [addr for _, addr in take]
+
+
+def liquidation_distance(state: Dict[str, Any]) -> Any:
+    """账户各持仓中离强平价最近的相对距离 |标记价 - 强平价| / 标记价，标记价由 positionValue / |szi| 得到；没有强平价时返回 None。"""
+    best = None
+    for w in state.get("assetPositions") or []:
+        pos = w.get("position") or {}
+        liq = safe_float(pos.get("liquidationPx"))
+        size = safe_float(pos.get("szi"))
+        value = safe_float(pos.get("positionValue"))
+        if not liq or not size or not value:
+            continue
+        mark = value / abs(size)
+        dist = abs(mark - liq) / mark
+        best = dist if best is None else min(best, dist)
+    return best
+
+
+def reschedule_wallet(address: str, state: Any, now: float = None) -> None:
+    """按本次拉取结果安排地址的下次拉取时间；拉取失败时按 POLL_INTERVAL 重试。"""
+    sched = POLL_SCHEDULE
+    now = now or time.time()
+    w = sched["wallets"][address]
+    interval, priority = float(POLL_INTERVAL), 2
+    if isinstance(state, dict):
+        fp = snapshot_fingerprint(state)
+        dist = liquidation_distance(state)
+        if dist is not None and dist < POLL_LIQ_DISTANCE:
+            interval, priority = POLL_MIN_INTERVAL, 0
+        elif w["fp"] is not None and fp != w["fp"]:
+            interval, priority = POLL_MIN_INTERVAL, 1
+        elif w["fp"] is not None:
+            interval = min(max(w["interval"], POLL_MIN_INTERVAL) * 2, POLL_MAX_INTERVAL)
+        w["fp"] = fp
+    w.update(interval=interval, priority=priority, due=now + interval)
+    heapq.heappush(sched["heap"], (w["due"], address))
+
+
+def next_poll_due(now: float = None) -> float:
+    """下一个地址到期的时间；有地址因预算顺延时，为令牌桶攒够一次拉取的时间。"""
+    sched = POLL_SCHEDULE
+    now = now or time.time()
+    due = sched["heap"][0][0] if sched["heap"] else now + POLL_INTERVAL
+    if sched["tokens"] < 1 and sched["rate"] > 0:
+        due = max(due, now + (1 - sched["tokens"]) / sched["rate"])
+    return due
+
+
+def schedule_summary() -> str:
+    sched = POLL_SCHEDULE
+    if not sched["wallets"]:
+        return ""
+    fast = sum(1 for w in sched["wallets"].values() if w["priority"] < 2)
+    return f"调度: 本轮拉取 {sched['polled']} 顺延 {sched['deferred']} 高频 {fast} 预算 {sched['rate']:.2f}/s"
+
+
+def load_targets() -> List[str]:
+    """汇总 TARGET_ADDRESSES 与 TARGET_FILE 中的地址（小写、去重、保持顺序）；都为空时返回 [TARGET]。"""
+    raw = TARGET_ADDRESSES.split(",")
+    if TARGET_FILE:
+        try:
+            with open(TARGET_FILE, "r", encoding="utf-8") as f:
+                for ln in f:
+                    ln = ln.split("#", 1)[0].strip()
+                    if ln:
+                        raw.append(ln)
+        except Exception as e:
+            print(Fore.RED + f"[配置] 读取地址文件失败 {TARGET_FILE}: {e}")
+    out = []
+    seen = set()
+    for a in raw:
+        a = a.strip().lower()
+        if not a or a in seen:
+            continue
+        if not a.startswith("0x"):
+            print(Fore.YELLOW + f"[配置] 忽略非法地址: {a}")
+            continue
+        seen.add(a)
+        out.append(a)
+    return out or [TARGET]
+
+
+def fetch_states(addresses: List[str], fetch=None) -> Dict[str, Any]:
+    """使用有界线程池并发拉取多个地址的账户状态（或 fetch 指定的其它按地址请求）。
+
+    返回 address -> state（dict）；某个地址失败时对应值为该异常对象，不影响其它地址。
+    """
+    fetch = fetch or fetch_state
+    out: Dict[str, Any] = {}
+    if not addresses:
+        return out
+    if len(addresses) == 1:
+        try:
+            out[addresses[0]] = fetch(addresses[0])
+        except Exception as e:
+            out[addresses[0]] = e
+        return out
+    # 线程池常驻复用，请求经 RPC_SESSION 的连接池并发发出（连接数与 WALLET_WORKERS 对齐）
+    pool = _wallet_pool()
+    futures = {addr: pool.submit(fetch, addr) for addr in addresses}
+    for addr, fut in futures.items():
+        try:
+            out[addr] = fut.result()
+        except Exception as e:
+            out[addr] = e
+    return out
+
+
+WALLET_POOL: Dict[str, Any] = {"pool": None}
+
+
+def _wallet_pool() -> ThreadPoolExecutor:
+    if WALLET_POOL["pool"] is None:
+        WALLET_POOL["pool"] = ThreadPoolExecutor(max_workers=max(1, WALLET_WORKERS), thread_name_prefix="wallet")
+    return WALLET_POOL["pool"]
+
+
+# 成交游标：address -> {"time": 已处理的最新成交时间(ms), "tids": 该毫秒内已处理的成交 tid}。
+# startTime 是闭区间，同一毫秒的成交靠 tids 去重。
+FILLS_CURSORS: Dict[str, Dict[str, Any]] = {}
+FILLS_LOCK = threading.Lock()
+FILLS_STATE = {"loaded": False, "dirty": False}
+
+
+def _load_fills_cursors() -> None:
+    with FILLS_LOCK:
+        if FILLS_STATE["loaded"]:
+            return
+        FILLS_STATE["loaded"] = True
+        try:
+            with open(FILLS_CURSOR_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                FILLS_CURSORS.update({k.lower(): v for k, v in data.items() if isinstance(v, dict)})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(Fore.YELLOW + f"[成交] 读取游标文件失败，将从当前时间开始: {e}")
+
+
+def save_fills_cursors() -> None:
+    """游标有变化时写回 FILLS_CURSOR_FILE（先写临时文件再替换）。"""
+    with FILLS_LOCK:
+        if not FILLS_STATE["dirty"]:
+            return
+        data = json.dumps(FILLS_CURSORS)
+        FILLS_STATE["dirty"] = False
+    try:
+        tmp = FILLS_CURSOR_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, FILLS_CURSOR_FILE)
+    except Exception as e:
+        warn_once("fills_cursor_write_failed", f"[成交] 写入游标文件失败: {e}")
+
+
+def fetch_new_fills(address: str) -> List[Dict[str, Any]]:
+    """从游标起拉取该地址的新成交（按时间升序）；不推进游标，处理完后由 advance_fills_cursor 推进。
+
+    首次见到的地址没有游标，以当前时间为起点，不回放历史成交。
+    """
+    _load_fills_cursors()
+    addr = address.lower()
+    with FILLS_LOCK:
+        cur = FILLS_CURSORS.get(addr)
+        if cur is None:
+            FILLS_CURSORS[addr] = {"time": int(time.time() * 1000), "tids": []}
+            FILLS_STATE["dirty"] = True
+            return []
+        since, seen = int(cur.get("time", 0)), set(cur.get("tids") or [])
+    out = []
+    start = since
+    for _ in range(FILLS_MAX_PAGES):
+        page = rpc_info({"type": "userFillsByTime", "user": address, "startTime": start}) or []
+        for f in page:
+            t = int(f.get("time", 0))
+            if t < since or (t == since and f.get("tid") in seen):
+                continue
+            out.append(f)
+        if len(page) < FILLS_PAGE_LIMIT:
+            break
+        # 满页说明还有更多：从本页最后一条的时间继续（闭区间，重复的由下面的 tid 去重）
+        start = max(int(f.get("time", 0)) for f in page)
+    uniq = {}
+    for f in out:
+        uniq[(f.get("tid"), f.get("time"), f.get("hash"))] = f
+    return sorted(uniq.values(), key=lambda f: (int(f.get("time", 0)), f.get("tid") or 0))
+
+
+def advance_fills_cursor(address: str, fills: List[Dict[str, Any]]) -> None:
+    if not fills:
+        return
+    addr = address.lower()
+    last = max(int(f.get("time", 0)) for f in fills)
+    with FILLS_LOCK:
+        cur = FILLS_CURSORS.get(addr) or {"time": 0, "tids": []}
+        tids = [f.get("tid") for f in fills if int(f.get("time", 0)) == last]
+        if last == cur.get("time"):
+            tids = list(cur.get("tids") or []) + tids
+        elif last < cur.get("time", 0):
+            return
+        FILLS_CURSORS[addr] = {"time": last, "tids": tids}
+        FILLS_STATE["dirty"] = True
+
+
+def collect_fills(addresses: List[str]) -> Dict[str, Any]:
+    """并发拉取各地址的新成交；失败的地址对应值为异常对象（游标不推进，下一轮补上）。"""
+    return fetch_states(addresses, fetch=fetch_new_fills)
+
+
+def is_perp_coin(coin: Any) -> bool:
+    """userFills 也包含现货成交（coin 形如 "@107" 或 "PURR/USDC"），这里只处理永续合约。"""
+    return bool(coin) and not coin.startswith("@") and "/" not in coin
+
+
+def fills_state_due(addresses: List[str], fills: Dict[str, Any]) -> List[str]:
+    """成交增量模式下本轮需要拉取 clearinghouseState 的地址：有新的永续成交、成交拉取失败、从未拉取过或到了对账时间的地址。"""
+    now = time.time()
+    due = []
+    for addr in addresses:
+        got = fills.get(addr)
+        if (addr not in LAST_STATES or now - LAST_RECONCILE.get(addr, 0) >= STATE_RECONCILE_INTERVAL
+                or isinstance(got, Exception) or any(is_perp_coin(f.get("coin")) for f in got or [])):
+            due.append(addr)
+    return due
+
+
+def aggregate_fills(fills: List[Dict[str, Any]], prev: Dict[str, Dict[str, Any]], current: Dict[str, Dict[str, Any]], total_portfolio_value: float) -> Dict[str, Any]:
+    """把新成交按币种聚合为与 detect_changes 相同结构的 added/removed/changed，另附 fills: coin -> 成交列表。
+
+    持仓变化前的大小取该币种第一笔成交的 startPosition，之后按方向累加成交数量；
+    变化前后都有持仓（包括先开后平、净额为 0）的归入 changed。价值按成交均价计算。
+    """
+    by_coin: Dict[str, List[Dict[str, Any]]] = {}
+    for f in fills:
+        if is_perp_coin(f.get("coin")):
+            by_coin.setdefault(f.get("coin"), []).append(f)
+    added, removed, changed = [], [], []
+    eps = 1e-9
+    for coin, items in by_coin.items():
+        start = safe_float(items[0].get("startPosition")) or 0.0
+        qty = notional = delta_size = 0.0
+        for f in items:
+            sz = safe_float(f.get("sz")) or 0.0
+            px = safe_float(f.get("px")) or 0.0
+            delta_size += sz if f.get("side") == "B" else -sz
+            qty += sz
+            notional += sz * px
+        end = start + delta_size
+        avg = notional / qty if qty else 0.0
+        delta_value = delta_size * avg
+        prev_sum = prev.get(coin) or {"size": start, "entry": None, "unreal": 0.0, "value": abs(start * avg), "roi": None}
+        cur_sum = current.get(coin) or {"size": end, "entry": None, "unreal": 0.0, "value": abs(end * avg), "roi": None}
+        if abs(end) > eps:
+            ratio_within = abs(delta_size) / abs(end)
+        elif abs(start) > eps:
+            ratio_within = abs(delta_size) / abs(start)
+        else:
+            ratio_within = None
+        ratio_total = (abs(delta_value) / total_portfolio_value) if total_portfolio_value else None
+        if abs(start) <= eps and abs(end) > eps:
+            added.append((coin, None, cur_sum, delta_size, delta_value, ratio_within, ratio_total))
+        elif abs(start) > eps and abs(end) <= eps:
+            removed.append((coin, prev_sum, None, delta_size, delta_value, ratio_within, ratio_total))
+        else:
+            changed.append((coin, prev_sum, cur_sum, delta_size, delta_value, ratio_within, ratio_total))
+    return {"added": added, "removed": removed, "changed": changed, "fills": by_coin}
+
+
+def format_fill_lines(fills: List[Dict[str, Any]], limit: int = 20) -> List[str]:
+    """成交明细：时间 方向 数量@价格（以及非零的已实现盈亏），超过 limit 条时只列最近的。"""
+    lines = []
+    shown = fills[-limit:]
+    if len(fills) > len(shown):
+        lines.append(f"    ...（省略较早的 {len(fills) - len(shown)} 笔成交）")
+    for f in shown:
+        ts = datetime.datetime.fromtimestamp(int(f.get("time", 0)) / 1000).strftime("%Y-%m-%d %H:%M:%S")
+        side = f.get("dir") or ("买入" if f.get("side") == "B" else "卖出")
+        line = f"    成交 {ts} {side} {f.get('sz')}@{f.get('px')}"
+        pnl = safe_float(f.get("closedPnl"))
+        if pnl:
+            line += f" 已实现盈亏={pnl:.2f}"
+        lines.append(line)
+    return lines
 
 
 # ---- Binance 数据获取（公共接口，无需 API Key） ----
 BINANCE_API = "https://api.binance.com/api/v3"
 
 # 全量 ticker 缓存（减少对 /ticker/price 单个请求失败的影响）
-# 存储结构: { 'ts': <epoch>, 'data': { SYMBOL: price_float, ..  } }
-TICKER_CACHE = {"ts": 0, "data": {}}
+# 存储结构: { 'ts': <epoch>, 'table': (版本, {SYMBOL: 槽位}, (SYMBOL, ...), array('d', [price, ...])) }
+# 交易对 -> 槽位的索引只在上架交易对变化（新增/下架）时整体重建并换成新的 table 元组（版本 +1），
+# 平时的刷新与推送只按槽位原地改写 float 数组，不再每次生成 2000 多个条目的新字典与 float 对象。
+# 交易对名经 sys.intern 驻留，索引、解析结果共用同一份字符串。缺失的价格存为 NaN。
+TICKER_CACHE = {"ts": 0, "table": (0, {}, (), array("d"))}
+# 推送线程与 REST 刷新都会写 ticker 表：写入（读出 table、改写/重建、换上新 table）整体持有该锁，
+# 避免写进即将被替换的旧数组而丢失，或两次并发重建互相覆盖而丢交易对；读取方只取 table 元组，不加锁。
+TICKER_LOCK = threading.Lock()
 TICKER_TTL = 30  # seconds
 BINANCE_BAN_UNTIL = 0  # epoch seconds, 如果被 ban 则设置为解封时间
+
+# 币种 -> 交易对解析索引：只在 ticker 表版本变化（上架交易对新增/下架）时按全部 XXXUSDT 交易对重建，解析只是一次字典查找。
+# Hyperliquid 的 k 前缀币种按 1000 倍计价（kPEPE = 1000 PEPE），优先映射到 1000XXXUSDT，
+# 没有该交易对时映射到 XXXUSDT 并把价格乘以 1000。找不到的币种进入负缓存 SYMBOL_NEGATIVE_TTL 秒，
+# 期间不再做任何解析或刷新。SYMBOL_ALIASES 可手动补充映射，格式 "COIN:PAIR[:倍数],..."，例如 "UBTC:BTCUSDT"。
+SYMBOL_NEGATIVE_TTL = float(os.getenv("SYMBOL_NEGATIVE_TTL", "600"))
+SYMBOL_ALIASES = os.getenv("SYMBOL_ALIASES", "")
+# key 为 ticker 表的版本，只有上架交易对变化时才重建
+SYMBOL_INDEX: Dict[str, Any] = {"key": None, "pairs": {}}
+SYMBOL_NEGATIVE: Dict[str, float] = {}
+
+# 推送行情模式：TICKER_STREAM=1 时后台线程订阅 Binance 全市场 mini-ticker 推送并原地更新 TICKER_CACHE，
+# 推送健康时 fetch_all_tickers 不再发起 REST 全量请求。BINANCE_WS_API 可指向本地替身服务器（bench.py 的 MockTickerStream）用于测试。
+# 需要安装 websocket-client。
+TICKER_STREAM = os.getenv("TICKER_STREAM", "0") == "1"
+BINANCE_WS_API = os.getenv("BINANCE_WS_API", "wss://stream.binance.com:9443")
+TICKER_STREAM_STALE = 10  # 超过该秒数未收到推送视为断流，fetch_all_tickers 回退到 REST
+TICKER_STREAM_STATE = {"thread": None, "connected": False, "last_msg": 0.0, "reconnects": 0}
 # 记录上一次在哪个轮次打印过被封通知，避免在同一轮次重复打印
 BINANCE_BAN_PRINTED_ITER = 0
 # main loop 会将当前轮次写入这个全局变量，safe_get 以此判断是否要打印
@@ -153,62 +1111,583 @@ GLOBAL_ITERATION = 0
 LAST_PRINTED_BY_KEY: Dict[str, int] = {}
 
 
-def warn_once(key: str, msg: str, color=Fore.YELLOW):
-    """按 key+轮次只打印一次消息（用于避免同一轮次重复日志刷屏）。"""
+# 常驻后台线程的名字；它们的打印与主循环的轮次无关
+BACKGROUND_THREADS = {"ticker-stream", "state-stream", "email-dispatcher", "event-accept", "metrics"}
+
+
+def log_line(msg: str) -> None:
+    """打印一行诊断信息。常驻后台线程在事件输出占用标准输出、或终端画面正由 render_frame 增量重绘时改写到
+    标准错误，不混入 JSON 行事件流，也不落进主循环正在组装的画面缓冲。"""
+    if threading.current_thread().name in BACKGROUND_THREADS and (
+            EVENTS["sink"] is sys.__stdout__ or RENDER_STATE["lines"] is not None):
+        print(msg, file=sys.stderr, flush=True)
+    else:
+        print(msg)
+
+
+def warn_once(key: str, msg: str, color=Fore.YELLOW):
+    """按 key+轮次只打印一次消息（用于避免同一轮次重复日志刷屏）。"""
+    try:
+        global LAST_PRINTED_BY_KEY, GLOBAL_ITERATION
+        last = LAST_PRINTED_BY_KEY.get(key)
+        if last != GLOBAL_ITERATION:
+            log_line((color or "") + msg)
+            LAST_PRINTED_BY_KEY[key] = GLOBAL_ITERATION
+    except Exception:
+        # 回退到直接打印，确保至少有输出
+        print((color or "") + msg)
+
+
+# ---- 运行指标 ----
+# 各阶段（fetch_state、Binance 请求、ticker 刷新、邮件、历史读写、渲染等）的耗时直方图与计数器。
+# METRICS_PORT>0 时在 METRICS_HOST:METRICS_PORT/metrics 以 Prometheus 文本格式暴露；
+# TRACE_FILE 非空时每轮结束追加一行 JSON，记录该轮各阶段累计耗时与计数。
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_PREFIX = "wallet_tracker_"
+# key 为 (指标名, 排序后的 label 元组)；直方图值为 {"buckets": [...], "sum", "count"}
+METRICS: Dict[str, Dict[Tuple, Any]] = {"hist": {}, "counter": {}}
+# 本轮累计：stages 为 "指标名{label=...}" -> 秒，counts 为同样 key -> 次数/数值
+TICK_TRACE: Dict[str, Dict[str, float]] = {"stages": {}, "counts": {}}
+METRICS_LOCK = threading.Lock()
+METRICS_STATE = {"server": None}
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _trace_key(key: Tuple[str, Tuple]) -> str:
+    name, labels = key
+    return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """向直方图 name 记录一次耗时（秒）。"""
+    key = _metric_key(name, labels)
+    with METRICS_LOCK:
+        h = METRICS["hist"].get(key)
+        if h is None:
+            h = METRICS["hist"][key] = {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0}
+        for i, b in enumerate(METRIC_BUCKETS):
+            if seconds <= b:
+                h["buckets"][i] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+        tk = _trace_key(key)
+        TICK_TRACE["stages"][tk] = TICK_TRACE["stages"].get(tk, 0.0) + seconds
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """计数器 name 增加 value。"""
+    key = _metric_key(name, labels)
+    with METRICS_LOCK:
+        METRICS["counter"][key] = METRICS["counter"].get(key, 0) + value
+        tk = _trace_key(key)
+        TICK_TRACE["counts"][tk] = TICK_TRACE["counts"].get(tk, 0) + value
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    """with timed("stage", stage="fetch_state"): ... —— 无论是否抛异常都记录耗时。"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+def _fmt_labels(labels: Tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_metrics() -> str:
+    """把当前指标渲染为 Prometheus 文本格式（含抓取时计算的调度器 / 邮件队列等瞬时值）。"""
+    lines = []
+    with METRICS_LOCK:
+        hists = sorted(METRICS["hist"].items())
+        counters = sorted(METRICS["counter"].items())
+    seen = set()
+    for (name, labels), h in hists:
+        full = f"{METRICS_PREFIX}{name}_seconds"
+        if full not in seen:
+            lines.append(f"# TYPE {full} histogram")
+            seen.add(full)
+        for b, c in zip(METRIC_BUCKETS, h["buckets"]):
+            le = 'le="%s"' % b
+            lines.append(f"{full}_bucket{_fmt_labels(labels, le)} {c}")
+        le = 'le="+Inf"'
+        lines.append(f"{full}_bucket{_fmt_labels(labels, le)} {h['count']}")
+        lines.append(f"{full}_sum{_fmt_labels(labels)} {h['sum']:.6f}")
+        lines.append(f"{full}_count{_fmt_labels(labels)} {h['count']}")
+    for (name, labels), v in counters:
+        full = f"{METRICS_PREFIX}{name}_total"
+        if full not in seen:
+            lines.append(f"# TYPE {full} counter")
+            seen.add(full)
+        lines.append(f"{full}{_fmt_labels(labels)} {v}")
+    gauges = {}
+    try:
+        gov = governor_status()
+        gauges["binance_weight_budget"] = gov["budget"]
+        gauges["binance_weight_used"] = gov["server_used"]
+        gauges["binance_governor_queue_depth"] = gov["queue"]
+        gauges["email_queue_depth"] = EMAIL_QUEUE.unfinished_tasks
+        if EMAIL_STATS["last_send"] is not None:
+            gauges["email_last_send_seconds"] = EMAIL_STATS["last_send"]
+        gauges["iteration"] = GLOBAL_ITERATION
+        if RPC_STATS["ewma"] is not None:
+            gauges["rpc_latency_ewma_seconds"] = round(RPC_STATS["ewma"], 6)
+        now = time.time()
+        for url, st in list(RPC_ENDPOINT_STATS.items()):
+            gauges[f'rpc_endpoint_up{{url="{url}"}}'] = int(st["ejected_until"] <= now)
+            if st["ewma"] is not None:
+                gauges[f'rpc_endpoint_latency_ewma_seconds{{url="{url}"}}'] = round(st["ewma"], 6)
+        for stream, st in (("ticker", TICKER_STREAM_STATE), ("state", STATE_STREAM_STATE)):
+            gauges[f'stream_connected{{stream="{stream}"}}'] = int(bool(st["connected"]))
+            gauges[f'stream_reconnects{{stream="{stream}"}}'] = st["reconnects"]
+    except Exception:
+        pass
+    for name, v in gauges.items():
+        base = name.split("{", 1)[0]
+        if base not in seen:
+            lines.append(f"# TYPE {METRICS_PREFIX}{base} gauge")
+            seen.add(base)
+        lines.append(f"{METRICS_PREFIX}{name} {v}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server() -> None:
+    """METRICS_PORT>0 时在后台线程启动 /metrics 服务（只启动一次）。"""
+    if METRICS_PORT <= 0 or METRICS_STATE["server"] is not None:
+        return
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+        server.daemon_threads = True
+    except Exception as e:
+        print(Fore.RED + f"[指标] 无法监听 {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    METRICS_STATE["server"] = server
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def write_tick_trace(iteration: int, **extra) -> None:
+    """结束一轮：TRACE_FILE 非空时把本轮累计的阶段耗时与计数写成一行 JSON，然后清空本轮累计。
+
+    开启了事件输出时同一份数据作为 type=tick 记录输出。
+    """
+    with METRICS_LOCK:
+        trace = {"stages": TICK_TRACE["stages"], "counts": TICK_TRACE["counts"]}
+        TICK_TRACE["stages"] = {}
+        TICK_TRACE["counts"] = {}
+    if not TRACE_FILE and EVENTS["kind"] is None:
+        return
+    record = {"ts": time.time(), "iteration": iteration}
+    record.update(extra)
+    record["stages"] = {k: round(v, 6) for k, v in trace["stages"].items()}
+    record["counts"] = trace["counts"]
+    emit_event({"type": "tick", **record})
+    if not TRACE_FILE:
+        return
+    try:
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except Exception as e:
+        warn_once("trace_write_failed", f"[指标] 写入 trace 文件失败: {e}")
+
+
+# ---- 事件输出（JSON 行） ----
+# EVENTS_OUTPUT 为 "-"（标准输出）、文件路径（追加写入）或 "unix:/path/to.sock"（本进程监听该 Unix 套接字，
+# 向所有已连接的消费者广播，发送超时或断开的消费者被移除）。每轮一条 type=tick 记录，每个变更的币种一条
+# type=change 记录，每条触发的 position 规则一条 type=alert 记录，均为一行紧凑 JSON。
+# HEADLESS=1 为无界面模式：不做终端格式化与刷屏，只计算变更并输出事件（默认输出到标准输出，此时其它日志改写到标准错误）；
+# 终端界面模式下也可以同时把事件输出到文件或套接字。
+HEADLESS = os.getenv("HEADLESS", "0") == "1"
+EVENTS_OUTPUT = os.getenv("EVENTS_OUTPUT", "-" if HEADLESS else "")
+EVENTS_SEND_TIMEOUT = 1.0  # 秒，Unix 套接字消费者的发送超时
+# kind: None / "stream" / "unix"；sink: 文件对象或监听套接字；clients: 已连接的套接字消费者
+EVENTS: Dict[str, Any] = {"kind": None, "sink": None, "clients": [], "lock": threading.Lock()}
+
+
+def _event_accept_loop(server: socket.socket) -> None:
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        conn.settimeout(EVENTS_SEND_TIMEOUT)
+        with EVENTS["lock"]:
+            EVENTS["clients"].append(conn)
+
+
+def start_event_output(target: str = None) -> None:
+    """按 EVENTS_OUTPUT 打开事件输出（只打开一次）；无界面模式输出到标准输出时，其它打印改写到标准错误。"""
+    target = EVENTS_OUTPUT if target is None else target
+    if not target or EVENTS["kind"] is not None:
+        return
+    try:
+        if target == "-":
+            if not HEADLESS:
+                print(Fore.YELLOW + "[事件] 终端界面模式下不能把事件输出到标准输出，已忽略 EVENTS_OUTPUT=-")
+                return
+            # 直接写原始标准输出，绕过 colorama 的 ANSI 处理包装
+            EVENTS.update(kind="stream", sink=sys.__stdout__)
+            sys.stdout = sys.stderr
+        elif target.startswith("unix:"):
+            path = target[len("unix:"):]
+            # 只清理上次遗留的套接字文件；同名的普通文件等不是套接字的路径拒绝覆盖
+            if os.path.lexists(path):
+                if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                    print(Fore.RED + f"[事件] {path} 已存在且不是套接字，未打开事件输出")
+                    return
+                os.unlink(path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(16)
+            EVENTS.update(kind="unix", sink=server)
+            threading.Thread(target=_event_accept_loop, args=(server,), name="event-accept", daemon=True).start()
+        else:
+            EVENTS.update(kind="stream", sink=open(target, "a", encoding="utf-8"))
+    except Exception as e:
+        print(Fore.RED + f"[事件] 打开事件输出失败 {target}: {e}")
+
+
+def emit_event(record: Dict[str, Any]) -> None:
+    """输出一条事件记录；未开启事件输出时什么也不做。"""
+    kind = EVENTS["kind"]
+    if kind is None:
+        return
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+    with EVENTS["lock"]:
+        if kind == "unix":
+            data = line.encode("utf-8")
+            for conn in list(EVENTS["clients"]):
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    EVENTS["clients"].remove(conn)
+                    conn.close()
+                    inc("events_dropped")
+        else:
+            try:
+                EVENTS["sink"].write(line)
+                EVENTS["sink"].flush()
+            except Exception as e:
+                warn_once("event_write_failed", f"[事件] 写入事件失败: {e}")
+                return
+    inc("events", type=record.get("type"))
+
+
+def emit_change_events(address: str, diffs: Dict[str, Any], quotes: Dict[str, Tuple[Any, Any]], rule_hits: Dict[str, List[str]] = None) -> None:
+    """每个变更的币种输出一条 type=change 记录；rules 为命中的 change 规则，notified 表示是否发送了邮件。"""
+    if EVENTS["kind"] is None:
+        return
+    now = time.time()
+    fills = diffs.get("fills") or {}
+    for kind in ("added", "removed", "changed"):
+        for coin, prev, cur, delta_size, delta_value, ratio_within, ratio_total in diffs[kind]:
+            cur, prev = cur or {}, prev or {}
+            emit_event({
+                "type": "change", "ts": now, "iteration": GLOBAL_ITERATION, "wallet": address, "coin": coin, "kind": kind,
+                "size": _num(cur.get("size", 0.0)), "prev_size": _num(prev.get("size", 0.0)),
+                "delta_size": _num(delta_size), "delta_value": _num(delta_value),
+                "value": _num(cur.get("value")), "entry": _num(cur.get("entry") or prev.get("entry")), "roi": _num(cur.get("roi")),
+                "ratio_within": _num(ratio_within), "ratio_total": _num(ratio_total),
+                "price": _num(quotes.get(coin, (None, None))[0]), "fills": len(fills.get(coin) or []),
+                "rules": (rule_hits or {}).get(coin, []), "notified": rule_hits is None or bool(rule_hits),
+            })
+
+
+# 历史持仓变更记录文件（每行一条 JSON）。
+# 位于当前工作目录，便于审计和快速查看历史通知。
+HISTORY_FILE = os.path.join(os.getcwd(), "position_changes.log")
+# 历史存储后端：log（默认，JSON 行文件）或 sqlite（HISTORY_DB，带时间/地址/币种索引，适合长期运行与范围查询）。
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "log")
+HISTORY_DB = os.getenv("HISTORY_DB", os.path.join(os.getcwd(), "position_changes.db"))
+# append_history 先写入内存批次，攒满 HISTORY_BATCH_SIZE 条、读取历史或每轮结束时（flush_history）一次性落盘。
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+# log 后端：文件超过 HISTORY_MAX_BYTES 时轮转为 .1/.2/...，最多保留 HISTORY_KEEP 个旧文件。
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(50 * 1024 * 1024)))
+HISTORY_KEEP = int(os.getenv("HISTORY_KEEP", "5"))
+# sqlite 后端：保留最近 HISTORY_RETENTION_DAYS 天的记录（0 表示不清理），每天最多压缩一次。
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+
+HISTORY_PENDING: List[Dict[str, Any]] = []
+HISTORY_LOCK = threading.RLock()
+# 每次落盘后递增，read_last_history 据此复用上次读取结果，无新记录的轮次不再读盘
+HISTORY_STATE = {"version": 0, "tail_key": None, "tail": [], "db": None, "compacted": 0.0}
+
+
+def append_history(iteration: int, subject: str, body: str, wallet: str = None, coins: List[str] = None) -> None:
+    """将一次持仓变更加入待写批次（每条记录为一个 JSON 对象），批次满时落盘。"""
+    try:
+        now = time.time()
+        record = {
+            "ts": datetime.datetime.fromtimestamp(now).isoformat(),
+            "epoch": now,
+            "iteration": iteration,
+            "wallet": wallet.lower() if wallet else None,
+            "coins": list(coins or []),
+            "subject": subject,
+            "body": body,
+        }
+        with HISTORY_LOCK:
+            HISTORY_PENDING.append(record)
+            full = len(HISTORY_PENDING) >= HISTORY_BATCH_SIZE
+        if full:
+            flush_history()
+    except Exception as e:
+        warn_once("history_write_failed", f"[历史] 写入持仓变更文件失败: {e}")
+
+
+def flush_history() -> None:
+    """把待写批次一次性写入历史存储（log 单次追加写 / sqlite 单个事务）。"""
+    with HISTORY_LOCK:
+        if not HISTORY_PENDING:
+            return
+        batch = list(HISTORY_PENDING)
+        HISTORY_PENDING.clear()
+        try:
+            with timed("stage", stage="history_flush"):
+                if HISTORY_BACKEND == "sqlite":
+                    _history_db_insert(batch)
+                else:
+                    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in batch))
+                    _rotate_history_log()
+            inc("history_records", len(batch), backend=HISTORY_BACKEND)
+            HISTORY_STATE["version"] += 1
+        except Exception as e:
+            warn_once("history_write_failed", f"[历史] 写入持仓变更文件失败: {e}")
+
+
+atexit.register(flush_history)
+
+
+def _rotate_history_log() -> None:
+    if HISTORY_MAX_BYTES <= 0 or not os.path.exists(HISTORY_FILE) or os.path.getsize(HISTORY_FILE) < HISTORY_MAX_BYTES:
+        return
+    for i in range(HISTORY_KEEP, 0, -1):
+        src = f"{HISTORY_FILE}.{i}"
+        if not os.path.exists(src):
+            continue
+        if i == HISTORY_KEEP:
+            os.remove(src)
+        else:
+            os.replace(src, f"{HISTORY_FILE}.{i + 1}")
+    if HISTORY_KEEP > 0:
+        os.replace(HISTORY_FILE, f"{HISTORY_FILE}.1")
+    else:
+        os.remove(HISTORY_FILE)
+
+
+def _history_db():
+    """返回（必要时创建）sqlite 连接；调用方需持有 HISTORY_LOCK。"""
+    conn = HISTORY_STATE["db"]
+    if conn is None:
+        conn = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY, epoch REAL, ts TEXT, iteration INTEGER, wallet TEXT, subject TEXT, body TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_epoch ON history(epoch);
+            CREATE INDEX IF NOT EXISTS idx_history_wallet ON history(wallet, epoch);
+            CREATE TABLE IF NOT EXISTS history_coin (history_id INTEGER, coin TEXT, epoch REAL);
+            CREATE INDEX IF NOT EXISTS idx_history_coin ON history_coin(coin, epoch);
+            """
+        )
+        HISTORY_STATE["db"] = conn
+    return conn
+
+
+def _history_db_insert(batch: List[Dict[str, Any]]) -> None:
+    conn = _history_db()
+    with conn:
+        for rec in batch:
+            cur = conn.execute(
+                "INSERT INTO history (epoch, ts, iteration, wallet, subject, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (rec["epoch"], rec["ts"], rec["iteration"], rec["wallet"], rec["subject"], rec["body"]),
+            )
+            conn.executemany(
+                "INSERT INTO history_coin (history_id, coin, epoch) VALUES (?, ?, ?)",
+                [(cur.lastrowid, c, rec["epoch"]) for c in rec["coins"]],
+            )
+    if HISTORY_RETENTION_DAYS > 0 and time.time() - HISTORY_STATE["compacted"] > 86400:
+        compact_history()
+
+
+def compact_history() -> None:
+    """sqlite 后端：删除超过 HISTORY_RETENTION_DAYS 的记录并 VACUUM；log 后端：按大小轮转。"""
+    with HISTORY_LOCK:
+        try:
+            if HISTORY_BACKEND != "sqlite":
+                _rotate_history_log()
+                return
+            if HISTORY_RETENTION_DAYS <= 0:
+                return
+            cutoff = time.time() - HISTORY_RETENTION_DAYS * 86400
+            conn = _history_db()
+            with conn:
+                conn.execute("DELETE FROM history_coin WHERE epoch < ?", (cutoff,))
+                conn.execute("DELETE FROM history WHERE epoch < ?", (cutoff,))
+            conn.execute("VACUUM")
+            HISTORY_STATE["compacted"] = time.time()
+            HISTORY_STATE["version"] += 1
+        except Exception as e:
+            warn_once("history_compact_failed", f"[历史] 压缩历史记录失败: {e}")
+
+
+def _parse_history_line(ln: str) -> Dict[str, Any]:
     try:
-        global LAST_PRINTED_BY_KEY, GLOBAL_ITERATION
-        last = LAST_PRINTED_BY_KEY.get(key)
-        if last != GLOBAL_ITERATION:
-            print((color or "") + msg)
-            LAST_PRINTED_BY_KEY[key] = GLOBAL_ITERATION
+        return json.loads(ln)
     except Exception:
-        # 回退到直接打印，确保至少有输出
-        print((color or "") + msg)
+        # 如果解析失败，将原始行作为 body 返回
+        return {"ts": None, "iteration": None, "subject": None, "body": ln}
 
 
-# 历史持仓变更记录文件（每行一条 JSON）。
-# 位于当前工作目录，便于审计和快速查看历史通知。
-HISTORY_FILE = os.path.join(os.getcwd(), "position_changes.log")
+def _tail_lines(path: str, n: int) -> List[str]:
+    """从文件末尾按块向前读取最后 n 行（按文件顺序），读取量与文件大小无关。"""
+    if n <= 0 or not os.path.exists(path):
+        return []
+    block = 8192
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = [ln for ln in data.decode("utf-8", errors="replace").splitlines() if ln.strip()]
+    return lines[-n:]
 
 
-def append_history(iteration: int, subject: str, body: str) -> None:
-    """将一次持仓变更写入 HISTORY_FILE，每行一条 JSON 记录。"""
-    try:
-        record = {
-            "ts": datetime.datetime.now().isoformat(),
-            "iteration": iteration,
-            "subject": subject,
-            "body": body,
-        }
-        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    except Exception as e:
-        warn_once("history_write_failed", f"[历史] 写入持仓变更文件失败: {e}")
+def _row_to_record(row) -> Dict[str, Any]:
+    return {"id": row[0], "epoch": row[1], "ts": row[2], "iteration": row[3], "wallet": row[4], "subject": row[5], "body": row[6]}
 
 
 def read_last_history(n: int = 3):
-    """读取 HISTORY_FILE 最后 n 条记录，返回解析后的列表（按时间倒序）。"""
+    """读取最后 n 条历史记录，返回解析后的列表（按时间倒序）。
+
+    log 后端只从文件尾部按块读取（必要时接着读轮转出的 .1），sqlite 后端走主键索引；
+    自上次读取后没有新记录落盘时直接复用上次结果。
+    """
     out = []
     try:
-        if not os.path.exists(HISTORY_FILE):
-            return out
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            lines = f.read().strip().splitlines()
-        if not lines:
-            return out
-        selected = lines[-n:]
-        for ln in reversed(selected):
-            try:
-                rec = json.loads(ln)
-                out.append(rec)
-            except Exception:
-                # 如果解析失败，将原始行作为 body 返回
-                out.append({"ts": None, "iteration": None, "subject": None, "body": ln})
+        flush_history()
+        with HISTORY_LOCK:
+            key = (n, HISTORY_STATE["version"])
+            if HISTORY_STATE["tail_key"] == key:
+                return list(HISTORY_STATE["tail"])
+            with timed("stage", stage="history_read"):
+                if HISTORY_BACKEND == "sqlite":
+                    rows = _history_db().execute(
+                        "SELECT id, epoch, ts, iteration, wallet, subject, body FROM history ORDER BY id DESC LIMIT ?", (n,)
+                    ).fetchall()
+                    out = [_row_to_record(r) for r in rows]
+                else:
+                    lines = _tail_lines(HISTORY_FILE, n)
+                    if len(lines) < n:
+                        lines = _tail_lines(f"{HISTORY_FILE}.1", n - len(lines)) + lines
+                    out = [_parse_history_line(ln) for ln in reversed(lines)]
+            HISTORY_STATE["tail_key"] = key
+            HISTORY_STATE["tail"] = list(out)
         return out
     except Exception as e:
         warn_once("history_read_failed", f"[历史] 读取持仓变更文件失败: {e}")
         return out
 
+
+def _record_epoch(rec: Dict[str, Any]) -> float:
+    if rec.get("epoch") is not None:
+        return rec["epoch"]
+    try:
+        return datetime.datetime.fromisoformat(rec.get("ts")).timestamp()
+    except Exception:
+        return None
+
+
+def query_history(wallet: str = None, coin: str = None, since: float = None, until: float = None, limit: int = 100):
+    """按地址 / 币种 / 时间范围（epoch 秒）查询历史记录，按时间倒序返回最多 limit 条。
+
+    sqlite 后端走索引；log 后端按从新到旧顺序扫描当前文件与轮转文件（适合偶尔的审计查询）。
+    """
+    out = []
+    try:
+        flush_history()
+        with HISTORY_LOCK:
+            if HISTORY_BACKEND == "sqlite":
+                sql = "SELECT h.id, h.epoch, h.ts, h.iteration, h.wallet, h.subject, h.body FROM history h"
+                where, args = [], []
+                if coin:
+                    sql += " JOIN history_coin c ON c.history_id = h.id"
+                    where.append("c.coin = ?")
+                    args.append(coin)
+                if wallet:
+                    where.append("h.wallet = ?")
+                    args.append(wallet.lower())
+                if since is not None:
+                    where.append("h.epoch >= ?")
+                    args.append(since)
+                if until is not None:
+                    where.append("h.epoch < ?")
+                    args.append(until)
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+                sql += " ORDER BY h.id DESC LIMIT ?"
+                args.append(limit)
+                return [_row_to_record(r) for r in _history_db().execute(sql, args).fetchall()]
+            # 从新到旧依次扫描当前文件与轮转出的 .1/.2/...，凑够 limit 条即停止
+            for path in [HISTORY_FILE] + [f"{HISTORY_FILE}.{i}" for i in range(1, HISTORY_KEEP + 1)]:
+                if len(out) >= limit:
+                    break
+                if not os.path.exists(path):
+                    continue
+                matched = []
+                with open(path, "r", encoding="utf-8") as f:
+                    for ln in f:
+                        rec = _parse_history_line(ln)
+                        ep = _record_epoch(rec)
+                        if wallet and (rec.get("wallet") or "").lower() != wallet.lower():
+                            continue
+                        if coin and coin not in (rec.get("coins") or []):
+                            continue
+                        if since is not None and (ep is None or ep < since):
+                            continue
+                        if until is not None and (ep is None or ep >= until):
+                            continue
+                        matched.append(rec)
+                matched.reverse()
+                out.extend(matched)
+            return out[:limit]
+    except Exception as e:
+        warn_once("history_query_failed", f"[历史] 查询历史记录失败: {e}")
+        return out
+
 # 全局 HTTP 会话与安全的 GET 封装说明：
 # - 使用全局 Session 复用连接
 # - 对 418/429/5xx 等异常状态进行指数退避重试
@@ -219,11 +1698,111 @@ SESSION.headers.update({
     "Accept": "application/json, text/plain, */*",
 })
 
+# Binance 请求权重调度（令牌桶）：
+# - 每个请求按接口计权重（全量 ticker/price=4，单个 ticker/price=2，klines=2，其它=1），先从桶中扣除再发出；
+# - 桶容量为每分钟上限 BINANCE_WEIGHT_LIMIT 的 BINANCE_WEIGHT_SAFETY 比例，按分钟匀速回填；
+# - 每次响应用 X-MBX-USED-WEIGHT-1M 头（服务端统计的本分钟已用权重）校正桶内余量；
+# - 预算不足时最多等待 BINANCE_MAX_DEFER 秒，仍不足则直接丢弃该请求（safe_get 返回 None），不阻塞主循环。
+BINANCE_WEIGHT_LIMIT = int(os.getenv("BINANCE_WEIGHT_LIMIT", "6000"))
+BINANCE_WEIGHT_SAFETY = 0.8
+BINANCE_MAX_DEFER = 2.0
+_GOVERNOR_CAPACITY = BINANCE_WEIGHT_LIMIT * BINANCE_WEIGHT_SAFETY
+GOVERNOR = {
+    "tokens": _GOVERNOR_CAPACITY,
+    "updated": time.time(),
+    "server_used": 0,  # 最近一次响应头报告的本分钟已用权重
+    "queue": 0,  # 正在等待预算的请求数
+    "deferred": 0,  # 累计被延后的请求数
+    "dropped": 0,  # 累计因预算不足被丢弃的请求数
+}
+GOVERNOR_COND = threading.Condition()
+
+
+def binance_request_weight(url: str, params: Dict[str, Any] = None) -> int:
+    """按 Binance 文档估算单个请求的权重。"""
+    if "/ticker/price" in url:
+        return 2 if params and params.get("symbol") else 4
+    if "/klines" in url:
+        return 2
+    return 1
+
+
+def _governor_refill(now: float) -> None:
+    # 调用方需持有 GOVERNOR_COND
+    rate = _GOVERNOR_CAPACITY / 60.0
+    GOVERNOR["tokens"] = min(_GOVERNOR_CAPACITY, GOVERNOR["tokens"] + (now - GOVERNOR["updated"]) * rate)
+    GOVERNOR["updated"] = now
+
+
+def governor_acquire(weight: int, max_wait: float = BINANCE_MAX_DEFER) -> bool:
+    """从令牌桶扣除 weight，预算不足时最多等待 max_wait 秒；返回 False 表示应丢弃该请求。"""
+    deadline = time.time() + max_wait
+    deferred = False
+    with GOVERNOR_COND:
+        GOVERNOR["queue"] += 1
+        try:
+            while True:
+                now = time.time()
+                _governor_refill(now)
+                if GOVERNOR["tokens"] >= weight:
+                    GOVERNOR["tokens"] -= weight
+                    return True
+                wait = (weight - GOVERNOR["tokens"]) / (_GOVERNOR_CAPACITY / 60.0)
+                if now + wait > deadline:
+                    GOVERNOR["dropped"] += 1
+                    return False
+                if not deferred:
+                    GOVERNOR["deferred"] += 1
+                    deferred = True
+                GOVERNOR_COND.wait(wait)
+        finally:
+            GOVERNOR["queue"] -= 1
+
+
+def governor_observe(resp) -> None:
+    """用响应头中的服务端已用权重校正令牌桶余量。"""
+    used = safe_float(resp.headers.get("X-MBX-USED-WEIGHT-1M")) if resp is not None else None
+    if used is None:
+        return
+    with GOVERNOR_COND:
+        GOVERNOR["server_used"] = int(used)
+        _governor_refill(time.time())
+        GOVERNOR["tokens"] = max(0.0, min(GOVERNOR["tokens"], _GOVERNOR_CAPACITY - used))
+        GOVERNOR_COND.notify_all()
+
+
+def governor_status() -> Dict[str, Any]:
+    """当前预算快照：剩余权重、容量、服务端已用权重、排队数及累计延后/丢弃次数。"""
+    with GOVERNOR_COND:
+        _governor_refill(time.time())
+        return {
+            "budget": int(GOVERNOR["tokens"]),
+            "capacity": int(_GOVERNOR_CAPACITY),
+            "server_used": GOVERNOR["server_used"],
+            "limit": BINANCE_WEIGHT_LIMIT,
+            "queue": GOVERNOR["queue"],
+            "deferred": GOVERNOR["deferred"],
+            "dropped": GOVERNOR["dropped"],
+        }
+
+
+def governor_summary() -> str:
+    st = governor_status()
+    return f"Binance 权重: {st['server_used']}/{st['limit']} 余量 {st['budget']} 排队 {st['queue']} 丢弃 {st['dropped']}"
+
+
+def _set_binance_backoff(seconds: float) -> None:
+    """在 seconds 秒内暂停所有 Binance 请求（复用 BINANCE_BAN_UNTIL），替代在请求路径上 sleep。"""
+    global BINANCE_BAN_UNTIL
+    BINANCE_BAN_UNTIL = max(BINANCE_BAN_UNTIL, time.time() + seconds)
+
 
 def safe_get(url: str, params: Dict[str, Any] = None, timeout: float = 6.0, retries: int = 1):
-    """使用全局 Session 发起 GET 请求，带指数退避。
+    """使用全局 Session 发起 GET 请求，带指数退避与请求权重调度。
 
-    - 对 418/429/5xx 做退避重试；遇到 418 时记录响应片段并适当延长 ticker 缓存以减少后续压力。
+    - 发出前经 governor_acquire 扣除权重，预算不足且等待超过 BINANCE_MAX_DEFER 时直接放弃。
+    - 418/429 不在此处 sleep，而是按 Retry-After 设置暂停窗口，后续请求在窗口内直接跳过；
+      5xx/网络异常仅在还有剩余重试次数时才退避等待。
     - 返回 requests.Response 或 None（失败）。
     """
     global BINANCE_BAN_UNTIL, TICKER_TTL
@@ -235,23 +1814,41 @@ def safe_get(url: str, params: Dict[str, Any] = None, timeout: float = 6.0, retr
         global BINANCE_BAN_PRINTED_ITER, GLOBAL_ITERATION
         try:
             if BINANCE_BAN_PRINTED_ITER != GLOBAL_ITERATION:
-                print(Fore.YELLOW + f"[HTTP] 当前已被 Binance 限制，跳过请求 {url}，剩余秒: {remain}")
+                log_line(Fore.YELLOW + f"[HTTP] 当前已被 Binance 限制，跳过请求 {url}，剩余秒: {remain}")
                 BINANCE_BAN_PRINTED_ITER = GLOBAL_ITERATION
         except Exception:
             # 回退：如果任何问题，仍然安全地打印一次
-            print(Fore.YELLOW + f"[HTTP] 当前已被 Binance 限制，跳过请求 {url}，剩余秒: {remain}")
+            log_line(Fore.YELLOW + f"[HTTP] 当前已被 Binance 限制，跳过请求 {url}，剩余秒: {remain}")
+        inc("http_dropped", service="binance", reason="ban")
         return None
-    
+
+    weight = binance_request_weight(url, params)
+    endpoint = urllib.parse.urlparse(url).path
     delay = 1.0
     for attempt in range(retries):
+        last_attempt = attempt == retries - 1
+        with timed("governor_wait", service="binance"):
+            acquired = governor_acquire(weight)
+        if not acquired:
+            inc("http_dropped", service="binance", reason="budget")
+            warn_once("governor_drop", f"[HTTP] 请求权重预算不足，丢弃请求 {url}（{governor_summary()}）")
+            return None
+        if attempt:
+            inc("http_retries", service="binance", endpoint=endpoint)
         try:
-            resp = SESSION.get(url, params=params, timeout=timeout)
+            with timed("http_request", service="binance", endpoint=endpoint):
+                resp = SESSION.get(url, params=params, timeout=timeout)
         except Exception as e:
-            print(Fore.YELLOW + f"[HTTP] 请求异常 {url}: {e}")
-            time.sleep(delay)
-            delay *= 2
+            inc("http_requests", service="binance", endpoint=endpoint, status="error")
+            log_line(Fore.YELLOW + f"[HTTP] 请求异常 {url}: {e}")
+            if not last_attempt:
+                inc("http_backoff_seconds", delay, service="binance")
+                time.sleep(delay)
+                delay *= 2
             continue
 
+        inc("http_requests", service="binance", endpoint=endpoint, status=resp.status_code)
+        governor_observe(resp)
         if resp.status_code == 200:
             return resp
 
@@ -272,33 +1869,33 @@ def safe_get(url: str, params: Dict[str, Any] = None, timeout: float = 6.0, retr
                         now2 = time.time()
                         remain = max(0, ban_until - now2)
                         TICKER_TTL = max(TICKER_TTL, remain + 60)
-                        print(Fore.RED + f"[HTTP] 发现 Binance 限制(code -1003)，IP 被封至 {ban_until} (剩余秒: {int(remain)})，已延长本地 ticker 缓存 {TICKER_TTL}s")
+                        log_line(Fore.RED + f"[HTTP] 发现 Binance 限制(code -1003)，IP 被封至 {ban_until} (剩余秒: {int(remain)})，已延长本地 ticker 缓存 {TICKER_TTL}s")
                         return None
         except Exception:
             pass
 
-        # 处理特殊状态
+        # 处理特殊状态：按 Retry-After 暂停后续请求，不在渲染路径上 sleep
+        retry_after = safe_float(resp.headers.get("Retry-After"))
         if resp.status_code == 418:
             snippet = resp.text[:800]
-            print(Fore.YELLOW + f"[HTTP] 418 拒绝 {url}，响应片段: {snippet}")
+            log_line(Fore.YELLOW + f"[HTTP] 418 拒绝 {url}，响应片段: {snippet}")
             # 当全量 ticker 被拒绝时，延长本地缓存以减少压力
             if "/ticker/price" in url:
                 TICKER_CACHE["ts"] = time.time()
-            # 指数退避并重试
-            time.sleep(max(10.0, delay))
-            delay *= 2
-            continue
+            _set_binance_backoff(retry_after or max(10.0, delay))
+            return None
 
         if resp.status_code == 429:
             print(Fore.YELLOW + f"[HTTP] 429 限流 {url}")
-            time.sleep(delay)
-            delay *= 2
-            continue
+            _set_binance_backoff(retry_after or delay)
+            return None
 
         if 500 <= resp.status_code < 600:
             print(Fore.YELLOW + f"[HTTP] 5xx 错误 {resp.status_code} for {url}")
-            time.sleep(delay)
-            delay *= 2
+            if not last_attempt:
+                inc("http_backoff_seconds", delay, service="binance")
+                time.sleep(delay)
+                delay *= 2
             continue
 
         # 对于其它非 200 状态，记录并不再重试
@@ -308,63 +1905,208 @@ def safe_get(url: str, params: Dict[str, Any] = None, timeout: float = 6.0, retr
     return None
 
 
-def fetch_all_tickers(force: bool = False) -> Dict[str, float]:
-    """一次性拉取 Binance /api/v3/ticker/price 的全部数据并缓存，返回 symbol->price 的字典。
+class TickerTable(Mapping):
+    """ticker 表的只读视图：symbol -> price 的映射接口，读取直接落到共享的 float 数组上，不复制数据。
+
+    视图绑定创建时的 table 版本：之后的价格刷新会反映到视图里，上架交易对变化则需要重新调用
+    fetch_all_tickers 取新视图。prices 为只读 memoryview，配合 slot() 可按槽位批量读取。
+    """
+
+    __slots__ = ("version", "symbols", "prices", "_slots", "_array")
+
+    def __init__(self, table):
+        self.version, self._slots, self.symbols, self._array = table
+        self.prices = memoryview(self._array).toreadonly()
+
+    def slot(self, symbol: str) -> Any:
+        return self._slots.get(symbol)
+
+    def __getitem__(self, symbol: str) -> Any:
+        px = self._array[self._slots[symbol]]
+        return None if px != px else px
+
+    def get(self, symbol: str, default: Any = None) -> Any:
+        i = self._slots.get(symbol)
+        if i is None:
+            return default
+        px = self._array[i]
+        return None if px != px else px
+
+    def __contains__(self, symbol: object) -> bool:
+        return symbol in self._slots
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+
+def ticker_table() -> TickerTable:
+    """当前 ticker 表的零拷贝视图，不触发刷新。"""
+    return TickerTable(TICKER_CACHE["table"])
+
+
+def store_tickers(items, full: bool = False) -> bool:
+    """把 (symbol, price) 写入 ticker 表；已有交易对按槽位原地更新，返回是否重建了索引。
+
+    出现新交易对、或全量刷新（full=True）时缺少原有交易对，才按新的上架列表重建索引与数组并整体替换。
+    推送线程与 REST 刷新可能同时调用，整个读-改-换过程持有 TICKER_LOCK。
+    """
+    with TICKER_LOCK:
+        return _store_tickers_locked(items, full)
+
+
+def _store_tickers_locked(items, full: bool) -> bool:
+    version, slots, symbols, prices = TICKER_CACHE["table"]
+    nan = float("nan")
+    fresh = []
+    seen = 0
+    for sym, px in items:
+        i = slots.get(sym)
+        if i is None:
+            fresh.append((sym, px))
+            continue
+        prices[i] = nan if px is None else px
+        seen += 1
+    if not fresh and (not full or seen == len(symbols)):
+        return False
+    if full:
+        listing = [sym for sym, _ in items]
+    else:
+        listing = list(symbols) + [sym for sym, _ in fresh]
+    values = dict(zip(symbols, prices))
+    values.update((sym, nan if px is None else px) for sym, px in fresh)
+    listing = tuple(sys.intern(sym) for sym in dict.fromkeys(listing))
+    table = (version + 1, {sym: i for i, sym in enumerate(listing)}, listing,
+             array("d", (values.get(sym, nan) for sym in listing)))
+    TICKER_CACHE["table"] = table
+    inc("ticker_table_rebuilds")
+    return True
+
+
+def fetch_all_tickers(force: bool = False) -> TickerTable:
+    """一次性拉取 Binance /api/v3/ticker/price 的全部数据并缓存，返回 symbol->price 的只读视图。
 
     使用 TTL 缓存以减少请求频率。若 force=True 将强制刷新。
+    推送行情模式下只要推送健康就直接返回当前 ticker 表（即使 force=True），不产生 REST 请求。
     """
+    if ticker_stream_healthy():
+        return ticker_table()
     now = time.time()
-    if not force and TICKER_CACHE["data"] and (now - TICKER_CACHE["ts"] < TICKER_TTL):
-        return TICKER_CACHE["data"]
+    if not force and TICKER_CACHE["table"][2] and (now - TICKER_CACHE["ts"] < TICKER_TTL):
+        return ticker_table()
+    with timed("stage", stage="ticker_refresh"):
+        return _refresh_tickers_rest()
 
+
+def _refresh_tickers_rest() -> TickerTable:
+    """通过 REST 全量刷新 ticker 表，失败时返回旧数据。"""
+    now = time.time()
     try:
         url = f"{BINANCE_API}/ticker/price"
         r = safe_get(url, timeout=6, retries=1)
         if not r:
             warn_once("ticker_pull_failed", f"[币安] 全量 ticker 拉取失败（safe_get）")
-            return TICKER_CACHE["data"]
+            return ticker_table()
         arr = r.json()
-        mapping = {}
         if isinstance(arr, list):
+            # item 示例: {"symbol":"BTCUSDT","price":"30000.00"}
+            items = []
             for item in arr:
-                # item 示例: {"symbol":"BTCUSDT","price":"30000.00"}
                 sym = item.get("symbol")
-                price = safe_float(item.get("price"))
                 if sym:
-                    mapping[sym.upper()] = price
-        TICKER_CACHE["data"] = mapping
+                    items.append((sym if sym.isupper() else sym.upper(), safe_float(item.get("price"))))
+            store_tickers(items, full=True)
         TICKER_CACHE["ts"] = now
-        return mapping
+        return ticker_table()
     except Exception as e:
         warn_once("ticker_pull_exception", f"[币安] 拉取全量 ticker 异常: {e}")
-        return TICKER_CACHE["data"]
+        return ticker_table()
 
 
-def get_symbol_for_coin(coin: str) -> str:
-    """根据 coin 名称尝试构建交易对符号（优先 USDT）"""
-    if not coin:
-        return None
-    sym = coin.upper()
-    # 常见直接映射
-    candidates = [f"{sym}USDT", f"{sym}USD", f"{sym}BTC"]
-    # 优先 USDT
-    return candidates[0]
+def ticker_stream_healthy() -> bool:
+    """推送行情模式已连接且最近 TICKER_STREAM_STALE 秒内收到过推送。"""
+    st = TICKER_STREAM_STATE
+    return bool(TICKER_STREAM and st["connected"] and TICKER_CACHE["table"][2] and time.time() - st["last_msg"] < TICKER_STREAM_STALE)
 
 
-def fetch_current_price(symbol: str) -> float:
-    """从 Binance 获取当前标记价格（ticker/price），返回 float 或 None"""
-    if not symbol:
-        return None
-    try:
-        url = f"{BINANCE_API}/ticker/price"
-        r = safe_get(url, params={"symbol": symbol}, timeout=5, retries=1)
-        if not r:
-            return None
-        data = r.json()
-        return safe_float(data.get("price"))
-    except Exception as e:
-        print(Fore.YELLOW + f"[币安] 获取现价异常: {symbol} -> {e}")
-        return None
+def _ticker_stream_loop() -> None:
+    """后台线程：订阅 !miniTicker@arr，断线后指数退避重连；每次（重）连接后用一次 REST 全量补齐断线期间的缺口。"""
+    st = TICKER_STREAM_STATE
+    url = f"{BINANCE_WS_API.rstrip('/')}/ws/!miniTicker@arr"
+    delay = 1.0
+    while True:
+        ws = None
+        try:
+            ws = websocket.create_connection(url, timeout=TICKER_STREAM_STALE)
+            delay = 1.0
+            # 先补齐缺口再标记为已连接，避免用残缺数据判断交易对不存在
+            _refresh_tickers_rest()
+            st["connected"] = True
+            st["last_msg"] = time.time()
+            while True:
+                # recv 超时（长时间无推送）会抛异常并触发重连
+                msg = ws.recv()
+                if not msg:
+                    continue
+                payload = json.loads(msg)
+                # 兼容组合流格式 {"stream": ..., "data": [...]}
+                if isinstance(payload, dict):
+                    payload = payload.get("data")
+                if not isinstance(payload, list):
+                    continue
+                store_tickers([(item.get("s"), safe_float(item.get("c"))) for item in payload
+                               if item.get("s") and item.get("c") is not None])
+                now = time.time()
+                st["last_msg"] = now
+                TICKER_CACHE["ts"] = now
+        except Exception as e:
+            warn_once("ticker_stream_error", f"[币安] 行情推送断开，{delay:.0f}s 后重连: {e}")
+        finally:
+            st["connected"] = False
+            if ws is not None:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+        st["reconnects"] += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)
+
+
+def start_ticker_stream() -> None:
+    """在 TICKER_STREAM 开启时启动后台行情推送线程（只启动一次）。"""
+    global TICKER_STREAM
+    if not TICKER_STREAM or TICKER_STREAM_STATE["thread"] is not None:
+        return
+    if websocket is None:
+        print(Fore.YELLOW + "[币安] 未安装 websocket-client，推送行情模式不可用，继续使用 REST 轮询")
+        TICKER_STREAM = False
+        return
+    t = threading.Thread(target=_ticker_stream_loop, name="ticker-stream", daemon=True)
+    TICKER_STREAM_STATE["thread"] = t
+    t.start()
+
+
+# K 线缓存：key=(symbol, interval)，value={"close": 最近一根已收盘 K 线的收盘价, "expires": 下一根 K 线的收盘时间(epoch 秒)}。
+# 已收盘的 K 线不会再变化，所以条目一直有效到下一根 K 线收盘，而不是固定 TTL；
+# 作为 1m 缓冲覆盖不到时的回退，由 get_timeframe_closes 统一调用。
+KLINE_CACHE: Dict[Tuple[str, str], Dict[str, Any]] = {}
+KLINE_CACHE_LOCK = threading.Lock()
+INTERVAL_SECONDS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600, "4h": 14400, "1d": 86400}
+
+
+# 每个交易对一份已收盘 1m K 线的环形缓冲：symbol -> deque[(open_time_ms, close)]。
+# 首次使用时从上一个 UTC 日界前一分钟开始播种，之后每次只用 startTime 增量拉取新收盘的分钟线；
+# 5m/15m/1h/4h/1d 的上一根收盘价即为各周期边界前最后一根 1m K 线的收盘价，全部在内存中计算。
+# 容量需覆盖 1d 周期的上一个边界，因此保留 1440 分钟 + 余量。设置 KLINE_1M=0 可退回按周期请求 K 线。
+KLINE_1M_ENABLED = os.getenv("KLINE_1M", "1") == "1"
+KLINE_1M_MAXLEN = 1440 + 120
+KLINE_1M_BATCH = 1000  # Binance /klines 单次最多返回 1000 根
+KLINE_1M_BUFFERS: Dict[str, deque] = {}
+KLINE_1M_LOCKS: Dict[str, Any] = {}  # 每个交易对一把锁，避免不同交易对的增量拉取互相阻塞
+KLINE_1M_LOCK = threading.Lock()  # 仅保护上面两个字典的创建
 
 
 def fetch_klines(symbol: str, interval: str, limit: int = 2):
@@ -383,6 +2125,128 @@ def fetch_klines(symbol: str, interval: str, limit: int = 2):
         return None
 
 
+def sync_1m_klines(symbol: str) -> deque:
+    """把 symbol 的 1m 环形缓冲补齐到最近一根已收盘分钟线，返回缓冲（可能为空）。
+
+    只有出现新的已收盘分钟线时才会请求，因此同一分钟内的重复调用不产生网络请求。
+    """
+    now_ms = int(time.time() * 1000)
+    open_minute = now_ms // 60000 * 60000  # 当前尚未收盘的分钟线开盘时间
+    seed_start = now_ms // 86400000 * 86400000 - 60000  # 上一根 1d K 线的最后一分钟
+    with KLINE_1M_LOCK:
+        buf = KLINE_1M_BUFFERS.get(symbol)
+        if buf is None:
+            buf = KLINE_1M_BUFFERS[symbol] = deque(maxlen=KLINE_1M_MAXLEN)
+            KLINE_1M_LOCKS[symbol] = threading.Lock()
+        lock = KLINE_1M_LOCKS[symbol]
+    with lock:
+        if buf and buf[-1][0] >= open_minute - 60000:
+            return buf
+        start = buf[-1][0] + 60000 if buf else seed_start
+        if start < seed_start:
+            # 断档超过一天，旧数据已无用，重新播种
+            buf.clear()
+            start = seed_start
+        while start < open_minute:
+            try:
+                url = f"{BINANCE_API}/klines"
+                r = safe_get(url, params={"symbol": symbol, "interval": "1m", "startTime": start, "limit": KLINE_1M_BATCH}, timeout=8, retries=1)
+                data = r.json() if r else None
+            except Exception as e:
+                warn_once(f"kline1m_exception:{symbol}", f"[币安] 1m K 线增量拉取异常: {symbol} -> {e}")
+                data = None
+            if not isinstance(data, list) or not data:
+                break
+            for k in data:
+                ot = int(k[0])
+                if ot >= open_minute:
+                    break
+                if buf and ot <= buf[-1][0]:
+                    continue
+                close = safe_float(k[4])
+                if close is not None:
+                    buf.append((ot, close))
+            if len(data) < KLINE_1M_BATCH:
+                break
+            start = int(data[-1][0]) + 60000
+        return buf
+
+
+def closes_from_1m(symbol: str, intervals) -> Dict[str, float]:
+    """从 1m 环形缓冲推导各周期上一根已收盘 K 线的收盘价；缓冲覆盖不到的周期返回 None。"""
+    out = {iv: None for iv in intervals}
+    buf = sync_1m_klines(symbol)
+    if not buf:
+        return out
+    now_ms = int(time.time() * 1000)
+    with KLINE_1M_LOCKS[symbol]:
+        if not buf:
+            return out
+        last_open = buf[-1][0]
+        first_open = buf[0][0]
+        n = len(buf)
+        for iv in intervals:
+            sec = INTERVAL_SECONDS.get(iv)
+            if not sec:
+                continue
+            target = now_ms // (sec * 1000) * (sec * 1000) - 60000  # 周期边界前最后一分钟
+            if target > last_open or target < first_open:
+                continue
+            # 缓冲通常是连续的分钟线，直接按偏移定位；遇到缺失分钟时向前找最近一根
+            idx = n - 1 - (last_open - target) // 60000
+            if idx < 0 or buf[idx][0] != target:
+                idx = n - 1
+                while idx >= 0 and buf[idx][0] > target:
+                    idx -= 1
+                if idx < 0:
+                    continue
+            out[iv] = buf[idx][1]
+    return out
+
+
+def get_timeframe_closes(symbol: str, intervals) -> Dict[str, float]:
+    """各周期上一根已收盘价：优先由 1m 缓冲本地推导，缺失的周期回退到 KLINE_CACHE 按周期请求。"""
+    out = closes_from_1m(symbol, intervals) if KLINE_1M_ENABLED else {iv: None for iv in intervals}
+    for iv in intervals:
+        if out.get(iv) is None:
+            out[iv] = get_last_closed_close(symbol, iv)
+    return out
+
+
+def get_last_closed_close(symbol: str, interval: str) -> float:
+    """返回 symbol 在 interval 周期上最近一根已收盘 K 线的收盘价，优先读 KLINE_CACHE，失败返回 None。"""
+    if not symbol or interval not in INTERVAL_SECONDS:
+        return None
+    key = (symbol, interval)
+    now = time.time()
+    with KLINE_CACHE_LOCK:
+        hit = KLINE_CACHE.get(key)
+    if hit and now < hit["expires"]:
+        return hit["close"]
+
+    data = fetch_klines(symbol, interval, limit=2)
+    if not isinstance(data, list) or not data:
+        return None
+    try:
+        last = data[-1]
+        # index 6 为该 K 线的收盘时间（ms）；最后一根尚未收盘时取倒数第二根
+        last_close_time = last[6] / 1000.0
+        if last_close_time > now:
+            if len(data) < 2:
+                return None
+            close = safe_float(data[-2][4])
+            expires = last_close_time
+        else:
+            close = safe_float(last[4])
+            expires = last_close_time + INTERVAL_SECONDS[interval]
+    except Exception:
+        return None
+    if close is not None:
+        with KLINE_CACHE_LOCK:
+            KLINE_CACHE[key] = {"close": close, "expires": expires}
+    return close
+
+
 def compute_interval_changes(entry: float, current: float, past_close: float, leverage: float = 1.0):
     """基于 entry、当前价与区间过去收盘价计算：
     - unlevered_roi_now = (current-entry)/entry
@@ -413,37 +2277,169 @@ def compute_interval_changes(entry: float, current: float, past_close: float, le
 # ---- end Binance helper ----
 
 
+EMAIL_QUEUE: "queue.Queue" = queue.Queue()
+# 发送统计：sent/failed 为邮件封数，notifications 为已发出的通知条数；
+# last_send 为最近一次 SMTP 发送耗时，last_delay 为最近一封邮件从入队到发出的总延迟（秒）
+# status 为后台线程最近一次发送结果的提示，由主线程在标题行显示（后台线程不直接 print，避免混入正在缓冲的画面）
+EMAIL_STATS = {"thread": None, "sent": 0, "failed": 0, "retries": 0, "notifications": 0, "last_send": None, "last_delay": None, "last_error": None, "status": ""}
+SMTP_STATE = {"server": None, "last_used": 0.0}
+
+
+def _smtp_connect():
+    if SMTP_USE_SSL:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        server.ehlo()
+        server.starttls()
+    if SMTP_USER and SMTP_PASS:
+        server.login(SMTP_USER, SMTP_PASS)
+    return server
+
+
+def _smtp_close() -> None:
+    server = SMTP_STATE["server"]
+    SMTP_STATE["server"] = None
+    if server is not None:
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+
+def _smtp_send(msg: EmailMessage) -> None:
+    """复用已登录的连接发送；连接已被服务端断开时重连一次。"""
+    for attempt in range(2):
+        if SMTP_STATE["server"] is None:
+            SMTP_STATE["server"] = _smtp_connect()
+        try:
+            SMTP_STATE["server"].send_message(msg)
+            SMTP_STATE["last_used"] = time.time()
+            return
+        except smtplib.SMTPServerDisconnected:
+            _smtp_close()
+            if attempt:
+                raise
+
+
+def _smtp_keepalive() -> None:
+    """空闲时保活：超过 EMAIL_IDLE_CLOSE 主动断开，否则发 NOOP，失败则丢弃连接等下次重连。"""
+    if SMTP_STATE["server"] is None:
+        return
+    idle = time.time() - SMTP_STATE["last_used"]
+    if idle > EMAIL_IDLE_CLOSE:
+        _smtp_close()
+        return
+    try:
+        SMTP_STATE["server"].noop()
+    except Exception:
+        _smtp_close()
+
+
+def _build_digest(batch) -> Tuple[str, str]:
+    """把窗口内的多条通知合并为一封邮件；只有一条时保持原主题与正文。"""
+    if len(batch) == 1:
+        return batch[0][1], batch[0][2]
+    subject = f"[通知] {len(batch)} 条持仓变化汇总"
+    parts = []
+    for idx, (ts, subj, body) in enumerate(batch, 1):
+        when = datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+        parts.append(f"===== #{idx} {when} {subj} =====\n{body}")
+    return subject, "\n\n".join(parts)
+
+
+def _email_worker() -> None:
+    while True:
+        try:
+            item = EMAIL_QUEUE.get(timeout=EMAIL_KEEPALIVE)
+        except queue.Empty:
+            _smtp_keepalive()
+            continue
+        batch = [item]
+        deadline = item[0] + EMAIL_BATCH_WINDOW
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(EMAIL_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        subject, body = _build_digest(batch)
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = EMAIL_FROM
+        msg["To"] = EMAIL_TO
+        msg.set_content(body)
+
+        delay = 2.0
+        for attempt in range(EMAIL_MAX_RETRIES + 1):
+            t0 = time.time()
+            try:
+                with timed("stage", stage="email_send"):
+                    _smtp_send(msg)
+                inc("emails", status="sent")
+                EMAIL_STATS["sent"] += 1
+                EMAIL_STATS["notifications"] += len(batch)
+                EMAIL_STATS["last_send"] = time.time() - t0
+                EMAIL_STATS["last_delay"] = time.time() - batch[0][0]
+                EMAIL_STATS["last_error"] = None
+                EMAIL_STATS["status"] = f"已发送到 {EMAIL_TO}（合并 {len(batch)} 条）"
+                break
+            except Exception as e:
+                _smtp_close()
+                EMAIL_STATS["last_error"] = str(e)
+                if attempt >= EMAIL_MAX_RETRIES:
+                    inc("emails", status="failed")
+                    EMAIL_STATS["failed"] += 1
+                    EMAIL_STATS["status"] = f"发送失败: {e}"
+                    break
+                inc("emails", status="retry")
+                EMAIL_STATS["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 300.0)
+        for _ in batch:
+            EMAIL_QUEUE.task_done()
+
+
+def start_email_dispatcher() -> None:
+    """启动后台邮件发送线程（只启动一次）。"""
+    if EMAIL_STATS["thread"] is not None:
+        return
+    t = threading.Thread(target=_email_worker, name="email-dispatcher", daemon=True)
+    EMAIL_STATS["thread"] = t
+    t.start()
+
+
+def flush_email(timeout: float = 30.0) -> None:
+    """等待队列中的邮件发送完毕（最多 timeout 秒），用于退出前尽量不丢通知。"""
+    deadline = time.time() + timeout
+    while EMAIL_QUEUE.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.2)
+
+
+atexit.register(flush_email)
+
+
+def email_summary() -> str:
+    st = EMAIL_STATS
+    last = f"{st['last_send']:.1f}s" if st["last_send"] is not None else "N/A"
+    # unfinished_tasks 包含已出队但仍在合并窗口或重试中的通知
+    out = f"邮件队列: {EMAIL_QUEUE.unfinished_tasks} 上次发送: {last} 失败: {st['failed']}"
+    return f"{out} ({st['status']})" if st["status"] else out
+
+
 def send_email(subject: str, body: str) -> None:
-    """使用 SMTP 发送简单文本邮件。
+    """把一封文本邮件放入后台发送队列（立即返回，不阻塞轮询）。
 
     如果未配置 SMTP，将仅打印一条提示（不会抛错）。
     """
     if not (SMTP_HOST and SMTP_PORT and EMAIL_FROM and EMAIL_TO):
         print(Fore.YELLOW + "[邮件] SMTP 未配置完整，跳过发送邮件（请在代码中设置 SMTP_HOST/SMTP_PORT/EMAIL_FROM/EMAIL_TO）")
         return
-
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = EMAIL_FROM
-    msg["To"] = EMAIL_TO
-    msg.set_content(body)
-
-    try:
-        if SMTP_USE_SSL:
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT) as server:
-                if SMTP_USER and SMTP_PASS:
-                    server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls()
-                if SMTP_USER and SMTP_PASS:
-                    server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        print(Fore.GREEN + "[邮件] 已发送通知到:", EMAIL_TO)
-    except Exception as e:
-        print(Fore.RED + "[邮件] 发送失败:", str(e))
+    start_email_dispatcher()
+    EMAIL_QUEUE.put((time.time(), subject, body))
 
 
 def format_position(pos: Dict[str, Any]) -> str:
@@ -501,90 +2497,352 @@ def build_position_summary(pos: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def coin_to_symbol(coin: str) -> str:
-    """尝试把币种名转换为交易所的交易对，例如 BTC -> BTCUSDT"""
-    if not coin:
-        return None
-    c = coin.upper()
-    # 如果已经带有分隔符或是稳定币，简单处理
-    if c.endswith("USDT") or c.endswith("USD"):
-        return c
-    # 避免 USDTUSDT
-    if c == "USDT":
-        return None
-    return f"{c}USDT"
+# ---- 列式持仓计算 ----
+# 把一个或多个钱包的持仓展开为按列存放的表（size/entry/unreal/leverage 各一列，缺失值为 NaN），
+# 仓位价值、ROI、杠杆 ROI、各周期 ROI 变动与价格变动在一次批量计算中得到，再交给渲染与变更检测。
+# 安装了 NumPy 时各列为 float64 数组，否则为 list 并逐元素计算，两者结果一致。
+POSITION_TIMEFRAMES = ("5m", "15m", "1h", "4h", "1d")
+NAN = float("nan")
 
 
-def get_working_symbol(s: str) -> Any:
-    """仅尝试将输入转换为 XXXUSDT 并在本地 ticker 缓存中查找，找不到就返回 None。"""
-    if not s:
-        return None
-    # 规范化输入并移除分隔符
-    s_up = s.strip().upper().replace('/', '').replace('-', '')
-    # 若包含非字母数字字符（如地址 0x...），直接返回 None
-    if not s_up.isalnum():
-        warn_once(f"invalid_input:{s_up}", f"[币安] 输入币名包含非法字符，跳过: {s}")
+def _col(values: List[float]):
+    return np.asarray(values, dtype=np.float64) if np is not None else values
+
+
+def _num(x) -> float:
+    """把 NaN 转回 None，供显示与 summary 使用。"""
+    if x is None:
         return None
+    x = float(x)
+    return None if math.isnan(x) else x
+
+
+def _position_fingerprint(pos: Dict[str, Any]) -> Tuple:
+    """单个持仓的归一化指纹 (coin, szi, entryPx, leverage)，直接使用原始字符串，不做数值解析。"""
+    lev = pos.get("leverage")
+    if isinstance(lev, dict):
+        lev = (lev.get("type"), lev.get("value"))
+    return (pos.get("coin") or pos.get("symbol"), pos.get("szi") or pos.get("size"), pos.get("entryPx") or pos.get("price"), lev)
+
+
+def snapshot_fingerprint(state: Dict[str, Any]) -> Tuple:
+    """整个持仓集合的指纹（与顺序无关），浮动盈亏、保证金等每轮都会变的字段不参与。"""
+    fps = [_position_fingerprint(w.get("position") or {}) for w in state.get("assetPositions") or []]
+    return tuple(sorted(fps, key=str))
+
+
+# 地址 -> {"fp": 上一轮的持仓集合指纹, "blocks": coin -> (打印块 key, 打印文本)}
+SNAPSHOT_CACHE: Dict[str, Dict[str, Any]] = {}
+# 持仓指纹 -> 解析后的 (coin, size, entry, leverage)；每次建表后只保留本次用到的条目
+POSITION_ROW_CACHE: Dict[Tuple, Tuple[str, float, float, float]] = {}
+
+
+def build_position_table(items: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """把 [(wallet, pos), ...] 转为列式持仓表。
+
+    指纹未变的持仓直接复用上次解析的数值列，只有浮动盈亏每轮重新读取。
+    """
+    global POSITION_ROW_CACHE
+    wallets, coins, fps, size, entry, unreal, lev = [], [], [], [], [], [], []
+    rows = {}
+    for wallet, pos in items:
+        fp = _position_fingerprint(pos)
+        row = POSITION_ROW_CACHE.get(fp)
+        if row is None:
+            e = safe_float(pos.get("entryPx") or pos.get("price"))
+            lv = safe_float(pos["leverage"].get("value")) if isinstance(pos.get("leverage"), dict) else None
+            row = (
+                pos.get("coin") or pos.get("symbol") or str(pos.get("szi")),
+                safe_float(pos.get("szi") or pos.get("size") or 0) or 0.0,
+                NAN if e is None else e,
+                lv if lv else NAN,
+            )
+        rows[fp] = row
+        wallets.append(wallet)
+        fps.append(fp)
+        coins.append(row[0])
+        size.append(row[1])
+        entry.append(row[2])
+        unreal.append(safe_float(pos.get("unrealizedPnl")) or 0.0)
+        lev.append(row[3])
+    POSITION_ROW_CACHE = rows
+    return {
+        "wallet": wallets,
+        "coin": coins,
+        "fp": fps,
+        "size": _col(size),
+        "entry": _col(entry),
+        "unreal": _col(unreal),
+        "leverage": _col(lev),
+    }
+
+
+def compute_position_metrics(table: Dict[str, Any], prices: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """批量计算持仓指标。
+
+    prices: coin -> 行情快照条目（见 fetch_position_prices：current 与各周期上一根收盘价）。
+    返回各列：current, value, roi, lev_roi, 以及 roi_delta[tf]（当前相对该周期收盘时的 ROI 变化，按持仓方向、未加杠杆）
+    和 price_change[tf]（现价相对该周期收盘价的涨跌幅）。
+    """
+    coins = table["coin"]
+
+    def price_col(key):
+        out = []
+        for c in coins:
+            v = (prices.get(c) or {}).get(key)
+            out.append(NAN if v is None else v)
+        return _col(out)
+
+    current = price_col("current")
+    closes = {tf: price_col(tf) for tf in POSITION_TIMEFRAMES}
+    size, entry, unreal, lev = table["size"], table["entry"], table["unreal"], table["leverage"]
+
+    if np is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = np.abs(size * entry)
+            value = np.where(np.isnan(value), 0.0, value)
+            roi = np.where(value != 0, unreal / value, np.nan)
+            lev_roi = roi * lev
+            # 空头仓位价格下跌时 ROI 上升，因此按持仓方向取符号
+            side_entry = entry * np.sign(size)
+            side_entry = np.where(side_entry != 0, side_entry, np.nan)
+            roi_delta = {tf: (current - c) / side_entry for tf, c in closes.items()}
+            price_change = {tf: np.where(c != 0, (current - c) / c, np.nan) for tf, c in closes.items()}
+        return {"current": current, "value": value, "roi": roi, "lev_roi": lev_roi, "roi_delta": roi_delta, "price_change": price_change}
+
+    n = len(coins)
+    value, roi, lev_roi = [0.0] * n, [NAN] * n, [NAN] * n
+    roi_delta = {tf: [NAN] * n for tf in closes}
+    price_change = {tf: [NAN] * n for tf in closes}
+    for i in range(n):
+        v = abs(size[i] * entry[i])
+        value[i] = 0.0 if math.isnan(v) else v
+        if value[i] != 0:
+            roi[i] = unreal[i] / value[i]
+            lev_roi[i] = roi[i] * lev[i]
+        for tf, c in closes.items():
+            if entry[i] and size[i] and not math.isnan(entry[i]):
+                roi_delta[tf][i] = (current[i] - c[i]) / entry[i] * (1.0 if size[i] > 0 else -1.0)
+            if c[i]:
+                price_change[tf][i] = (current[i] - c[i]) / c[i]
+    return {"current": current, "value": value, "roi": roi, "lev_roi": lev_roi, "roi_delta": roi_delta, "price_change": price_change}
+
+
+def position_summaries(table: Dict[str, Any], metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """从列式结果生成与 build_position_summary 相同结构的 summary 列表（供 detect_changes 与邮件使用）。"""
+    out = []
+    for i in range(len(table["coin"])):
+        out.append({
+            "size": float(table["size"][i]),
+            "entry": _num(table["entry"][i]),
+            "unreal": float(table["unreal"][i]),
+            "value": float(metrics["value"][i]),
+            "roi": _num(metrics["roi"][i]),
+            "leverage": _num(table["leverage"][i]),
+        })
+    return out
+
+
+MARKET_POOL: Dict[str, Any] = {"pool": None}
+
+
+def _market_pool() -> ThreadPoolExecutor:
+    if MARKET_POOL["pool"] is None:
+        MARKET_POOL["pool"] = ThreadPoolExecutor(max_workers=max(1, MARKET_WORKERS), thread_name_prefix="market")
+    return MARKET_POOL["pool"]
+
+
+def plan_market_requests(coins: List[str]) -> Tuple[Dict[str, Tuple[str, float]], List[Tuple[str, Any]]]:
+    """规划本轮行情请求：返回 coin -> (交易对, 价格倍数) 与去重后的请求单元 [(交易对, 周期)]。
+
+    启用 1m 缓冲时每个交易对一个单元（周期为 None，一次同步推导全部周期），否则每个 (交易对, 周期) 一个单元。
+    """
+    pairs = {}
+    units = []
+    seen = set()
+    for coin in coins:
+        pair, mult = resolve_pair(coin)
+        if not pair:
+            continue
+        pairs[coin] = (pair, mult)
+        for iv in ([None] if KLINE_1M_ENABLED else POSITION_TIMEFRAMES):
+            if (pair, iv) not in seen:
+                seen.add((pair, iv))
+                units.append((pair, iv))
+    return pairs, units
+
+
+def _fetch_market_unit(source: str, key: str, interval: Any) -> Dict[str, float]:
+    if source == "hyperliquid":
+        return {interval: get_hl_last_closed_close(key, interval)}
+    if interval is None:
+        return get_timeframe_closes(key, POSITION_TIMEFRAMES)
+    return {interval: get_last_closed_close(key, interval)}
+
+
+def fetch_position_prices(coins: List[str]) -> types.MappingProxyType:
+    """为本轮涉及的全部币种构建一份只读行情快照：coin -> {current, 各周期收盘价, pair, mult, source}。
+
+    PRICE_SOURCE=hyperliquid 时有中间价的币种现价取 allMids、收盘价取 candleSnapshot（同源，涨跌幅不含两个交易所的价差）；
+    其余币种整体使用 Binance ticker 与 K 线，只有存在这类币种时才拉取 Binance 全量 ticker。
+    各收盘价请求去重后并发拉取，本轮耗时取决于最慢的单个请求而不是所有请求之和。
+    """
+    coins = list(dict.fromkeys(c for c in coins if c))
+    pool = _market_pool()
+    with timed("stage", stage="market_plan"):
+        mids = fetch_hl_mids() if PRICE_SOURCE == "hyperliquid" else {}
+        units = [("hyperliquid", coin, tf) for coin in coins if coin in mids for tf in POSITION_TIMEFRAMES]
+        fallback = [coin for coin in coins if coin not in mids]
+        pairs, binance_units = plan_market_requests(fallback) if fallback else ({}, [])
+        units += [("binance", pair, iv) for pair, iv in binance_units]
+        tickers = fetch_all_tickers() if pairs else None
+    inc("market_units", len(units))
+    closes: Dict[Tuple[str, str], Dict[str, float]] = {}
+    with timed("stage", stage="market_fetch"):
+        futures = {unit: pool.submit(_fetch_market_unit, *unit) for unit in units}
+        for (source, key, _), fut in futures.items():
+            try:
+                closes.setdefault((source, key), {}).update(fut.result())
+            except Exception as e:
+                warn_once(f"market_unit_failed:{key}", f"[行情] 行情拉取异常 {source} {key}: {e}")
+    snapshot = {}
+    for coin in coins:
+        entry = {"current": None, "pair": None, "mult": 1.0, "source": None}
+        entry.update({tf: None for tf in POSITION_TIMEFRAMES})
+        if coin in mids:
+            entry.update({"pair": coin, "source": "hyperliquid", "current": mids[coin]})
+            entry.update(closes.get(("hyperliquid", coin), {}))
+        elif coin in pairs:
+            pair, mult = pairs[coin]
+            px = tickers.get(pair)
+            entry.update({"pair": pair, "mult": mult, "source": "binance", "current": px * mult if px is not None else None})
+            for tf, close in closes.get(("binance", pair), {}).items():
+                entry[tf] = close * mult if close is not None else None
+        snapshot[coin] = types.MappingProxyType(entry)
+    return types.MappingProxyType(snapshot)
+
+
+def market_entry(market: Any, coin: str) -> Any:
+    """行情快照中该币种的条目；快照中没有该币种时为它单独规划一次，仍取不到返回 None。"""
+    entry = market.get(coin) if market is not None else None
+    if entry is None:
+        entry = fetch_position_prices([coin]).get(coin)
+    return entry
+
+
+def price_and_changes(market: Any, coin: str):
+    """从行情快照取 (现价, {"5m": 涨跌幅, ...})，快照中没有该币种时为它单独规划一次。"""
+    entry = market_entry(market, coin)
+    if entry is None:
+        return None, {}
+    current = entry["current"]
+    if not entry["pair"]:
+        return current, {}
+    changes = {}
+    for label in ("5m", "15m", "1h", "4h"):
+        prev_close = entry.get(label)
+        changes[label] = (current - prev_close) / prev_close if prev_close and current else None
+    return current, changes
+
+
+def analyze_positions(states: Dict[str, Any], extra_coins: List[str] = ()) -> Dict[str, Tuple[Dict[str, Any], Dict[str, Any], Any]]:
+    """多地址模式：把所有地址的持仓合并成一张表做一次批量计算，返回 address -> (table, metrics, market) 的切片。
+
+    market 为全部地址共用的只读行情快照；extra_coins（如上一轮持有、可能已平仓的币种）一并规划，供变更通知使用。
+    """
+    items = []
+    spans = {}
+    for addr, state in states.items():
+        if not isinstance(state, dict):
+            continue
+        start = len(items)
+        for w in state.get("assetPositions") or []:
+            items.append((addr, w.get("position", {})))
+        spans[addr] = (start, len(items))
+    if not spans:
+        return {}
+    table = build_position_table(items)
+    market = fetch_position_prices(list(table["coin"]) + list(extra_coins))
+    metrics = compute_position_metrics(table, market)
+
+    def cut(col, a, b):
+        if isinstance(col, dict):
+            return {k: cut(v, a, b) for k, v in col.items()}
+        return col[a:b]
+
+    return {addr: (cut(table, a, b), cut(metrics, a, b), market) for addr, (a, b) in spans.items()}
+
+
+def _parse_symbol_aliases(spec: str) -> Dict[str, Tuple[str, float]]:
+    out = {}
+    for item in spec.split(","):
+        parts = [x.strip() for x in item.split(":")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        mult = safe_float(parts[2]) if len(parts) > 2 else None
+        out[parts[0]] = (parts[1].upper(), mult or 1.0)
+    return out
+
+
+def _build_symbol_index(tickers: TickerTable) -> Dict[str, Tuple[str, float]]:
+    """由全部 XXXUSDT 交易对生成 名称 -> (交易对, 价格倍数) 的索引。"""
+    pairs: Dict[str, Tuple[str, float]] = {}
+    multiplied = []
+    for sym in tickers:
+        if not sym.endswith("USDT") or len(sym) <= 4:
+            continue
+        base = sym[:-4]
+        pairs[sym] = (sym, 1.0)
+        pairs[base] = (sym, 1.0)
+        if base.startswith("1000") and len(base) > 4:
+            # 1000PEPEUSDT 本身就是按 1000 倍计价，与 kPEPE 同单位
+            pairs["k" + base[4:]] = (sym, 1.0)
+        else:
+            multiplied.append((base, sym))
+    for base, sym in multiplied:
+        pairs.setdefault("k" + base, (sym, 1000.0))
+    for coin, target in _parse_symbol_aliases(SYMBOL_ALIASES).items():
+        pairs[coin] = target
+    return pairs
 
-    # 若已经以 USDT 结尾，则直接检查
-    if s_up.endswith('USDT'):
-        tickers = fetch_all_tickers()
-        if s_up in tickers:
-            return s_up
-        # 强制刷新再试一次
-        tickers = fetch_all_tickers(force=True)
-        if s_up in tickers:
-            return s_up
-        warn_once(f"not_found:{s_up}", f"[币安] 未找到交易对: {s_up}")
-        return None
 
-    # 否则仅尝试添加 USDT 后缀
-    cand = s_up + 'USDT'
+def _symbol_index() -> Dict[str, Tuple[str, float]]:
     tickers = fetch_all_tickers()
-    if cand in tickers:
-        return cand
-    tickers = fetch_all_tickers(force=True)
-    if cand in tickers:
-        return cand
-
-    warn_once(f"not_found:{cand}", f"[币安] 未找到交易对: {cand}")
-    return None
+    key = tickers.version
+    if SYMBOL_INDEX["key"] != key:
+        SYMBOL_INDEX["pairs"] = _build_symbol_index(tickers)
+        SYMBOL_INDEX["key"] = key
+        inc("symbol_index_rebuilds")
+    return SYMBOL_INDEX["pairs"]
 
 
-def fetch_binance_prices(symbol: str) -> Dict[str, Any]:
-    """使用 Binance API 获取当前价和各 timeframe 的最近已收盘价（近似）
+def resolve_pair(coin: str) -> Tuple[Any, float]:
+    """把 Hyperliquid 币种名（或交易对名）解析为 (Binance 交易对, 价格倍数)，找不到时返回 (None, 1.0)。
 
-    返回 dict: { 'current': float, '5m': float, '15m': float, '1h': float, '4h': float, '1d': float }
-    若无法获取则对应值为 None。
+    价格倍数用于把交易对价格换算到币种的计价单位，例如 kPEPE 映射到 PEPEUSDT 时为 1000。
+    未命中不会触发全量 ticker 强制刷新；新上线的交易对会在下一次正常刷新重建索引后出现。
     """
-    out = {"current": None, "5m": None, "15m": None, "1h": None, "4h": None, "1d": None}
-    if not symbol:
-        return out
-
-    # 先从全量 ticker 缓存中查找当前价，避免对 /ticker/price 单独请求失败
-    tickers = fetch_all_tickers()
-    working = get_working_symbol(symbol)
-    if not working:
-        return out
-    out["current"] = tickers.get(working)
-
-    # 然后针对各 timeframe 仍需请求 klines（没有全量 K 线缓存），保持原有逻辑
-    base = "https://api.binance.com"
-    intervals = {"5m": "5m", "15m": "15m", "1h": "1h", "4h": "4h", "1d": "1d"}
-    for k, v in intervals.items():
-        try:
-            kr = safe_get(f"{base}/api/v3/klines", params={"symbol": working, "interval": v, "limit": 2}, timeout=5, retries=1)
-            if not kr:
-                out[k] = None
-                continue
-            data = kr.json()
-            if isinstance(data, list) and len(data) >= 1:
-                idx = 0 if len(data) >= 2 else 0
-                close = safe_float(data[idx][4])
-                out[k] = close
-        except Exception:
-            out[k] = None
-    return out
+    if not coin:
+        return None, 1.0
+    pairs = _symbol_index()
+    hit = pairs.get(coin)
+    if hit is not None:
+        return hit
+    now = time.time()
+    if SYMBOL_NEGATIVE.get(coin, 0) > now:
+        return None, 1.0
+    # 慢路径：规范化后再查一次（去掉分隔符、大写），命中则记入索引，下次直接命中
+    norm = coin.strip().replace("/", "").replace("-", "")
+    hit = (pairs.get(norm) or pairs.get(norm.upper())) if norm.isalnum() else None
+    if hit is not None:
+        pairs[coin] = hit
+        return hit
+    if pairs:
+        # 索引为空（ticker 尚未拉取成功）时不记负缓存，避免把所有币种都误判为不存在
+        SYMBOL_NEGATIVE[coin] = now + SYMBOL_NEGATIVE_TTL
+        inc("symbol_misses")
+        warn_once(f"not_found:{coin}", f"[币安] 未找到交易对: {coin}")
+    return None, 1.0
 
 
 def arrow_and_pct(delta: float) -> str:
@@ -595,49 +2853,6 @@ def arrow_and_pct(delta: float) -> str:
     return f"{sign}{abs(delta)*100:.2f}%"
 
 
-def get_price_and_changes_binance(coin_symbol: str, timeout: float = 5.0):
-    """尝试使用 Binance 公共 API 获取现价与 5m/15m/1h/4h 的变动百分比。
-
-    约定：尝试用 SYMBOL + 'USDT' 作为交易对，例如 BTC -> BTCUSDT。返回 (current_price, {"5m": pct, ...})
-    如果获取失败，返回 (None, {})
-    """
-    # 尝试找到可用的交易对并使用全量 ticker 缓存获取当前价
-    pair = get_working_symbol(coin_symbol)
-    if not pair:
-        warn_once(f"no_pair:{coin_symbol}", f"[币安] 未找到可用交易对用于: {coin_symbol}")
-        return None, {}
-
-    tickers = fetch_all_tickers()
-    current_price = tickers.get(pair)
-
-    intervals = {"5m": "5m", "15m": "15m", "1h": "1h", "4h": "4h"}
-    changes = {}
-    base = "https://api.binance.com"
-    for label, interval in intervals.items():
-        try:
-            url_klines = f"{base}/api/v3/klines"
-            r = safe_get(url_klines, params={"symbol": pair, "interval": interval, "limit": 2}, timeout=timeout, retries=1)
-            if not r:
-                changes[label] = None
-                continue
-            k = r.json()
-            if not k or len(k) < 2:
-                changes[label] = None
-                continue
-            prev_close = safe_float(k[-2][4])
-            last_close = safe_float(k[-1][4])
-            if prev_close and last_close:
-                pct = (last_close - prev_close) / prev_close
-                changes[label] = pct
-            else:
-                changes[label] = None
-        except Exception as e:
-            print(Fore.YELLOW + f"[币安] klines 请求异常 for {pair} {interval}: {e}")
-            changes[label] = None
-
-    return current_price, changes
-
-
 def format_change_icons(pct: float) -> str:
     """根据百分比变化返回 4 个箭头图标（用颜色）以及百分比字符串。这里只返回单个时间窗口的图标+数字。
 
@@ -720,8 +2935,522 @@ def detect_changes(prev: Dict[str, Dict[str, Any]], current: Dict[str, Dict[str,
     return {"added": added, "removed": removed, "changed": changed}
 
 
-def parse_and_print(data: Dict[str, Any], prev_positions_map: Dict[str, str], iteration: int) -> Dict[str, str]:
-    print(Style.BRIGHT + Fore.CYAN + f"=== 清算所账户快照: {TARGET} ===")
+# ---- 告警规则引擎 ----
+# change 规则在持仓变更事件上求值（新增/平仓/变动），命中时才发送变更邮件；
+# position 规则每轮在持仓上求值，结果由假变真时（边沿触发）单独发送告警，例如杠杆 ROI 跌破 -50%。
+# 可用变量见 ALERT_POSITION_VARS / ALERT_CHANGE_VARS；缺失的数值（如无现价）使比较结果为假。
+ALERT_POSITION_VARS = frozenset({
+    "size", "entry", "value", "roi", "lev_roi", "leverage", "unreal", "price", "side",
+    "change_5m", "change_15m", "change_1h", "change_4h", "change_1d",
+})
+ALERT_CHANGE_VARS = ALERT_POSITION_VARS | {"added", "removed", "changed", "delta_size", "delta_value", "ratio_within", "ratio_total"}
+_ALERT_FUNCS = {"abs": abs, "min": min, "max": max}
+_ALERT_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Compare, ast.Gt, ast.GtE,
+    ast.Lt, ast.LtE, ast.Eq, ast.NotEq, ast.Name, ast.Load, ast.Constant, ast.Call,
+)
+# rules: 全部规则；index: (wallet|"*", coin|"*") -> {"change": [...], "position": [...]}；
+# fired: (规则名, wallet, coin) -> 上次 position 规则结果；inputs: (wallet, coin) -> 上次求值时的输入 key
+ALERTS: Dict[str, Any] = {"loaded": False, "rules": [], "index": {}, "fired": {}, "inputs": {}}
+
+
+def compile_alert_expr(expr: str, kind: str = "change"):
+    """把规则表达式编译为代码对象；只允许比较、布尔与四则运算、abs/min/max 和该类规则可用的变量。"""
+    allowed = ALERT_CHANGE_VARS if kind == "change" else ALERT_POSITION_VARS
+    tree = ast.parse(expr, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALERT_NODES):
+            raise ValueError(f"不支持的语法: {type(node).__name__}")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in _ALERT_FUNCS and not node.keywords):
+            raise ValueError("只允许调用 abs/min/max")
+        if isinstance(node, ast.Name) and node.id not in allowed and node.id not in _ALERT_FUNCS:
+            raise ValueError(f"未知变量: {node.id}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"只允许数值常量: {node.value!r}")
+    return compile(tree, f"<rule {expr}>", "eval")
+
+
+def load_alert_rules(path: str = None) -> List[Dict[str, Any]]:
+    """读取并编译规则文件，重建 (wallet, coin) 索引；非法规则打印原因后跳过。"""
+    path = path or ALERT_RULES_FILE
+    rules, index = [], {}
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except Exception as e:
+            print(Fore.RED + f"[告警] 读取规则文件失败 {path}: {e}")
+            raw = []
+        for i, r in enumerate(raw if isinstance(raw, list) else []):
+            try:
+                kind = r.get("on", "change")
+                if kind not in ("change", "position"):
+                    raise ValueError(f"on 只能是 change 或 position: {kind}")
+                rule = {
+                    "name": r.get("name") or f"rule{i + 1}",
+                    "wallet": (r.get("wallet") or "*").lower(),
+                    "coin": r.get("coin") or "*",
+                    "on": kind,
+                    "when": r["when"],
+                    "code": compile_alert_expr(r["when"], kind),
+                }
+            except Exception as e:
+                print(Fore.RED + f"[告警] 忽略规则 #{i + 1} {r!r}: {e}")
+                continue
+            rules.append(rule)
+            index.setdefault((rule["wallet"], rule["coin"]), {"change": [], "position": []})[kind].append(rule)
+    ALERTS.update({"loaded": True, "rules": rules, "index": index, "fired": {}, "inputs": {}})
+    return rules
+
+
+def alerts_enabled() -> bool:
+    if not ALERTS["loaded"]:
+        load_alert_rules()
+    return bool(ALERTS["rules"])
+
+
+def _alert_rules_for(wallet: str, coin: str, kind: str) -> List[Dict[str, Any]]:
+    """只取与该 wallet/coin 相关的规则（精确匹配与通配共 4 个桶），与规则总数无关。"""
+    index = ALERTS["index"]
+    out = []
+    for key in ((wallet, coin), (wallet, "*"), ("*", coin), ("*", "*")):
+        bucket = index.get(key)
+        if bucket:
+            out.extend(bucket[kind])
+    return out
+
+
+def _eval_alert(rule: Dict[str, Any], env: Dict[str, Any]) -> bool:
+    try:
+        return bool(eval(rule["code"], {"__builtins__": {}}, {**_ALERT_FUNCS, **env}))
+    except (TypeError, ZeroDivisionError):
+        # 变量缺失（None）或除零时视为不满足
+        return False
+
+
+def alert_position_env(summary: Dict[str, Any], metrics: Dict[str, Any], i: int) -> Dict[str, Any]:
+    size = summary.get("size") or 0.0
+    env = {
+        "size": size, "entry": summary.get("entry"), "value": summary.get("value"), "roi": summary.get("roi"),
+        "lev_roi": _num(metrics["lev_roi"][i]), "leverage": summary.get("leverage"), "unreal": summary.get("unreal"),
+        "price": _num(metrics["current"][i]), "side": 1 if size > 0 else (-1 if size < 0 else 0),
+    }
+    for tf in POSITION_TIMEFRAMES:
+        env[f"change_{tf}"] = _num(metrics["price_change"][tf][i])
+    return env
+
+
+def evaluate_position_alerts(wallet: str, coin: str, env: Dict[str, Any], input_key: Tuple) -> List[str]:
+    """对该持仓的 position 规则求值，返回本轮由假变真的规则名；输入与上一轮相同时不求值。"""
+    wallet = wallet.lower()
+    rules = _alert_rules_for(wallet, coin, "position")
+    if not rules or ALERTS["inputs"].get((wallet, coin)) == input_key:
+        return []
+    ALERTS["inputs"][(wallet, coin)] = input_key
+    fired = []
+    for rule in rules:
+        key = (rule["name"], wallet, coin)
+        hit = _eval_alert(rule, env)
+        if hit and not ALERTS["fired"].get(key):
+            fired.append(rule["name"])
+        ALERTS["fired"][key] = hit
+    return fired
+
+
+def evaluate_change_alerts(wallet: str, diffs: Dict[str, Any], envs: Dict[str, Dict[str, Any]], market: Any = None) -> Dict[str, List[str]]:
+    """对变更事件求值 change 规则，返回 coin -> 命中的规则名。
+
+    envs 为 coin -> 持仓变量（平仓的币种可缺失）；缺失的 price/change_*/lev_roi/side 由行情快照 market 与变更前后的持仓摘要补齐，
+    平仓的币种也能使用行情变量。
+    """
+    wallet = wallet.lower()
+    out = {}
+    for kind in ("added", "removed", "changed"):
+        for coin, prev, cur, delta_size, delta_value, ratio_within, ratio_total in diffs[kind]:
+            rules = _alert_rules_for(wallet, coin, "change")
+            if not rules:
+                continue
+            base = envs.get(coin) or {}
+            summ = cur or prev or {}
+            env = {v: base.get(v) for v in ALERT_POSITION_VARS}
+            for v in ("size", "entry", "value", "roi", "leverage", "unreal"):
+                if env[v] is None:
+                    env[v] = summ.get(v)
+            quote = market_entry(market, coin) if env["price"] is None or any(env[f"change_{tf}"] is None for tf in POSITION_TIMEFRAMES) else None
+            if quote is not None:
+                px = quote.get("current")
+                if env["price"] is None:
+                    env["price"] = px
+                for tf in POSITION_TIMEFRAMES:
+                    close = quote.get(tf)
+                    if env[f"change_{tf}"] is None and px and close:
+                        env[f"change_{tf}"] = (px - close) / close
+            if env["lev_roi"] is None and env["roi"] is not None and env["leverage"]:
+                env["lev_roi"] = env["roi"] * env["leverage"]
+            if env["side"] is None and env["size"] is not None:
+                env["side"] = 1 if env["size"] > 0 else (-1 if env["size"] < 0 else 0)
+            env.update({
+                "added": kind == "added", "removed": kind == "removed", "changed": kind == "changed",
+                "delta_size": delta_size, "delta_value": delta_value,
+                "ratio_within": ratio_within, "ratio_total": ratio_total,
+            })
+            names = [r["name"] for r in rules if _eval_alert(r, env)]
+            if names:
+                out[coin] = names
+    return out
+
+
+# ---- 跨地址聚合敞口 ----
+# contrib: (wallet, coin) -> 带方向的名义价值（多为正、空为负，按开仓价计）；
+# coins: coin -> {"long", "short", "wallets_long", "wallets_short"}，由 contrib 的变化增量更新；
+# windows: 窗口标签 -> {"seconds", "events": deque[(ts, coin, wallet, 净流入, 是否加仓)], "net": coin -> 净流入, "adders": coin -> {wallet: 次数}}。
+# 每轮只处理发生变更的持仓（detect_changes 的输出），不重新汇总所有地址。
+EXPOSURE: Dict[str, Any] = {"contrib": {}, "coins": {}, "seeded": set(), "windows": {}}
+
+
+def _window_seconds(label: str) -> int:
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    label = label.strip().lower()
+    if label[-1:] in units:
+        return int(float(label[:-1]) * units[label[-1]])
+    return int(float(label))
+
+
+def _exposure_windows() -> Dict[str, Dict[str, Any]]:
+    windows = EXPOSURE["windows"]
+    if not windows:
+        for label in dict.fromkeys(EXPOSURE_WINDOWS + [EXPOSURE_WINDOW]):
+            windows[label] = {"seconds": _window_seconds(label), "events": deque(), "net": {}, "adders": {}}
+    return windows
+
+
+def _signed_notional(summary: Dict[str, Any]) -> float:
+    if not summary:
+        return 0.0
+    value = abs(summary.get("value") or 0.0)
+    return value if (summary.get("size") or 0.0) >= 0 else -value
+
+
+def _set_contribution(wallet: str, coin: str, new: float) -> float:
+    """更新单个 (wallet, coin) 的敞口贡献并增量调整该币种的汇总，返回变化量（净流入）。"""
+    old = EXPOSURE["contrib"].get((wallet, coin), 0.0)
+    if new == old:
+        return 0.0
+    agg = EXPOSURE["coins"].setdefault(coin, {"long": 0.0, "short": 0.0, "wallets_long": 0, "wallets_short": 0})
+    for amount, sign in ((old, -1), (new, 1)):
+        if amount > 0:
+            agg["long"] += sign * amount
+            agg["wallets_long"] += sign
+        elif amount < 0:
+            agg["short"] += sign * -amount
+            agg["wallets_short"] += sign
+    # 抵消累加误差：没有地址持有该方向时名义价值归零
+    if not agg["wallets_long"]:
+        agg["long"] = 0.0
+    if not agg["wallets_short"]:
+        agg["short"] = 0.0
+    if new:
+        EXPOSURE["contrib"][(wallet, coin)] = new
+    else:
+        EXPOSURE["contrib"].pop((wallet, coin), None)
+    return new - old
+
+
+def _record_flow(now: float, coin: str, wallet: str, flow: float, adding: bool) -> None:
+    for w in _exposure_windows().values():
+        w["events"].append((now, coin, wallet, flow, adding))
+        w["net"][coin] = w["net"].get(coin, 0.0) + flow
+        if adding:
+            adders = w["adders"].setdefault(coin, {})
+            adders[wallet] = adders.get(wallet, 0) + 1
+
+
+def _expire_flows(now: float) -> None:
+    for w in _exposure_windows().values():
+        events, cutoff = w["events"], now - w["seconds"]
+        while events and events[0][0] < cutoff:
+            _, coin, wallet, flow, adding = events.popleft()
+            net = w["net"].get(coin, 0.0) - flow
+            if abs(net) < 1e-9:
+                w["net"].pop(coin, None)
+            else:
+                w["net"][coin] = net
+            if adding:
+                adders = w["adders"].get(coin, {})
+                if adders.get(wallet, 0) <= 1:
+                    adders.pop(wallet, None)
+                    if not adders:
+                        w["adders"].pop(coin, None)
+                else:
+                    adders[wallet] -= 1
+
+
+def update_exposure(wallet: str, current: Dict[str, Dict[str, Any]], diffs: Dict[str, Any]) -> None:
+    """按本轮的持仓变更更新聚合敞口与滑动窗口净流入，代价与变更的持仓数成正比。
+
+    地址第一次出现时用其全部持仓建立初始敞口（不计入流入）；之后只处理 diffs 中的币种，
+    新值直接取自 current（平仓为 0），因此即使某轮拉取失败也会在下一次变更时自我校正。
+    """
+    wallet = wallet.lower()
+    now = time.time()
+    if wallet not in EXPOSURE["seeded"]:
+        EXPOSURE["seeded"].add(wallet)
+        for coin, summary in current.items():
+            _set_contribution(wallet, coin, _signed_notional(summary))
+        return
+    for kind in ("added", "removed", "changed"):
+        for d in diffs[kind]:
+            coin = d[0]
+            old = EXPOSURE["contrib"].get((wallet, coin), 0.0)
+            new = _signed_notional(current.get(coin))
+            flow = _set_contribution(wallet, coin, new)
+            if flow:
+                _record_flow(now, coin, wallet, flow, abs(new) > abs(old))
+    _expire_flows(now)
+
+
+def top_exposure_flows(window: str = None, n: int = None) -> List[Dict[str, Any]]:
+    """窗口内净流入绝对值最大的 n 个币种，附带当前多/空名义价值、持仓地址数与窗口内加仓的地址数。"""
+    window = window or EXPOSURE_WINDOW
+    n = EXPOSURE_TOP_N if n is None else n
+    _expire_flows(time.time())
+    w = _exposure_windows().get(window)
+    if w is None:
+        return []
+    ranked = sorted(((coin, net) for coin, net in w["net"].items() if abs(net) > 1e-9), key=lambda x: -abs(x[1]))[:n]
+    out = []
+    for coin, net in ranked:
+        agg = EXPOSURE["coins"].get(coin, {})
+        out.append({
+            "coin": coin,
+            "net_flow": net,
+            "adders": len(w["adders"].get(coin, {})),
+            "long": agg.get("long", 0.0),
+            "short": agg.get("short", 0.0),
+            "net": agg.get("long", 0.0) - agg.get("short", 0.0),
+            "wallets_long": agg.get("wallets_long", 0),
+            "wallets_short": agg.get("wallets_short", 0),
+        })
+    return out
+
+
+def print_exposure(window: str = None, n: int = None) -> None:
+    window = window or EXPOSURE_WINDOW
+    rows = top_exposure_flows(window, n)
+    print(Fore.CYAN + f"跨地址净流入（{window}，前 {len(rows)}）:")
+    if not rows:
+        print(Fore.GREEN + "    窗口内无持仓变动")
+        return
+    for r in rows:
+        col = Fore.RED if r["net_flow"] > 0 else Fore.GREEN
+        print_kv(
+            r["coin"],
+            col + f"净流入 {r['net_flow']:+,.0f}" + Style.RESET_ALL
+            + f" | 加仓地址 {r['adders']} | 多 {r['long']:,.0f} ({r['wallets_long']}) / 空 {r['short']:,.0f} ({r['wallets_short']}) | 净 {r['net']:+,.0f}",
+        )
+
+
+def print_recent_history(n: int = 3) -> None:
+    """打印最近 n 次历史持仓变化（若有）。"""
+    try:
+        last = read_last_history(n)
+        if last:
+            print(Fore.CYAN + f"最近历史持仓变化（最近 {n} 条）:")
+            idx = 0
+            for rec in last:
+                idx += 1
+                ts = rec.get("ts") or "N/A"
+                itr = rec.get("iteration") or "N/A"
+                subj = rec.get("subject") or ""
+                print_kv(f"历史#{idx}", f"{ts} (轮次 {itr})", indent=4, label_width=16, value_color=Fore.CYAN)
+                # 打印正文多行，逐行缩进
+                body_text = rec.get("body") or ""
+                for line in str(body_text).splitlines():
+                    print(" " * 8 + line)
+    except Exception:
+        # 读取/打印历史失败不影响主流程
+        pass
+
+
+def wallet_diffs(address: str, fingerprint: Tuple, prev_positions_map: Dict[str, Dict[str, Any]], current_map: Dict[str, Dict[str, Any]], total_portfolio_value: float, iteration: int, fills: Any = None) -> Dict[str, Any]:
+    """本轮的持仓变更，并记下本轮的持仓集合指纹。
+
+    成交增量模式下由本轮新成交聚合，拉取失败时本轮不做检测（游标未推进，下一轮补上）；
+    否则指纹与上一轮相同时直接返回空结果，不同才逐币种比对。
+    """
+    snap = SNAPSHOT_CACHE.setdefault(address.lower(), {"fp": None, "blocks": {}})
+    if FILLS_MODE:
+        if isinstance(fills, list):
+            diffs = aggregate_fills(fills, prev_positions_map, current_map, total_portfolio_value)
+        else:
+            print(Fore.YELLOW + f"[成交] 本轮成交拉取失败，跳过变更检测: {fills}")
+            diffs = {"added": [], "removed": [], "changed": []}
+    elif fingerprint == snap["fp"] and prev_positions_map.keys() == current_map.keys():
+        inc("snapshot_unchanged")
+        diffs = {"added": [], "removed": [], "changed": []}
+    else:
+        diffs = detect_changes(prev_positions_map, current_map, total_portfolio_value, iteration)
+    snap["fp"] = fingerprint
+    return diffs
+
+
+def report_position_alerts(address: str, position_alerts: List[Tuple[str, str]], alert_envs: Dict[str, Dict[str, Any]], iteration: int, echo: bool = True) -> None:
+    """打印本轮新触发的 position 规则（echo=False 时不打印），写入历史记录并单独发送一封告警邮件。"""
+    lines = [f"持仓告警 - 账户: {address}", ""]
+    for coin, name in position_alerts:
+        env = alert_envs.get(coin, {})
+        lev_roi = env.get("lev_roi")
+        lev_str = f"{lev_roi*100:.2f}%" if lev_roi is not None else "N/A"
+        line = f"{coin}: 规则 {name}，大小={env.get('size')}，仓位={env.get('value') or 0.0:.1f}，杠杆ROI={lev_str}，现价={env.get('price')}"
+        if echo:
+            print(Fore.RED + Style.BRIGHT + "触发告警 " + line)
+        lines.append("  " + line)
+        emit_event({
+            "type": "alert", "ts": time.time(), "iteration": GLOBAL_ITERATION, "wallet": address, "coin": coin, "rule": name,
+            "size": _num(env.get("size")), "value": _num(env.get("value")), "lev_roi": _num(lev_roi), "price": _num(env.get("price")),
+        })
+    subject = f"[告警] 账户 {address} 触发 {len(position_alerts)} 条规则"
+    body = "\n".join(lines)
+    try:
+        append_history(iteration, subject, body, wallet=address, coins=list(dict.fromkeys(c for c, _ in position_alerts)))
+    except Exception:
+        warn_once("history_append_fail", "[历史] 无法追加历史记录（内部错误）")
+    send_email(subject, body)
+
+
+def notify_changes(address: str, diffs: Dict[str, Any], total_portfolio_value: float, iteration: int, market: Any = None, alert_envs: Dict[str, Dict[str, Any]] = None) -> Any:
+    """持仓变更的数据与通知部分：求值 change 规则、输出事件、写入历史记录并发送通知邮件（配置了告警规则时只发命中的）。
+
+    不做终端打印（无界面模式直接调用）；没有变更时返回 None，否则返回 (quotes, rule_hits) 供 print_changes 打印。
+    market 为本轮的行情快照，缺失时为变更涉及的币种单独规划一次；alert_envs 为 coin -> 持仓变量。
+    """
+    if not (diffs["added"] or diffs["removed"] or diffs["changed"] and not iteration == 1):
+        return None
+    fill_details = diffs.get("fills") or {}
+    body_lines = [f"持仓变更通知 - 账户: {address}", f"总仓位(USD): {total_portfolio_value}", ""]
+    if market is None:
+        # 当前无持仓（全部平仓）时本轮还没有行情快照，为变更涉及的币种规划一次
+        market = fetch_position_prices([d[0] for k in ("added", "removed", "changed") for d in diffs[k]])
+    # 配置了告警规则时只有命中 change 规则的变更才发邮件（仍写入历史记录）
+    rule_hits = evaluate_change_alerts(address, diffs, alert_envs or {}, market) if alerts_enabled() else None
+    quotes = {d[0]: price_and_changes(market, d[0]) for k in ("added", "removed", "changed") for d in diffs[k]}
+    emit_change_events(address, diffs, quotes, rule_hits)
+    if rule_hits:
+        body_lines[2:2] = [f"触发规则: {coin}: {', '.join(names)}" for coin, names in rule_hits.items()] + [""]
+
+    if diffs["added"]:
+        body_lines.append("新增持仓:")
+        for coin, _, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["added"]:
+            roi_str = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
+            cp, ch = quotes[coin]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            body_lines.append(f"  {coin}: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
+            if ratio_within is not None:
+                body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
+            if ratio_total is not None:
+                body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
+            if ch:
+                body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
+            if coin in fill_details:
+                body_lines.extend(format_fill_lines(fill_details[coin]))
+
+    if diffs["removed"]:
+        body_lines.append("移除持仓:")
+        for coin, prev, _, delta_size, delta_value, ratio_within, ratio_total in diffs["removed"]:
+            roi_str = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
+            cp, ch = quotes[coin]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            body_lines.append(f"  {coin}: 原大小={prev.get('size')}, 原仓位={prev.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
+            if ratio_within is not None:
+                body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
+            if ratio_total is not None:
+                body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
+            if ch:
+                body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
+            if coin in fill_details:
+                body_lines.extend(format_fill_lines(fill_details[coin]))
+
+    if diffs["changed"]:
+        body_lines.append("变动持仓:")
+        for coin, prev, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["changed"]:
+            roi_old = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
+            roi_new = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
+            cp, ch = quotes[coin]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            body_lines.append(f"  {coin} 原: 大小={prev.get('size')}, 仓位={prev.get('value'):.1f}, ROI={roi_old}, 现价={price_str}")
+            body_lines.append(f"  {coin} 新: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_new}, 现价={price_str}")
+            body_lines.append(f"    变化: 数量 delta={delta_size}, 价值 delta={delta_value:.1f}")
+            if ratio_within is not None:
+                body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
+            if ratio_total is not None:
+                body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
+            if ch:
+                body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
+            if coin in fill_details:
+                body_lines.extend(format_fill_lines(fill_details[coin]))
+
+    # 发送邮件并写入历史记录文件
+    subject = f"[通知] 账户 {address} 持仓发生变化"
+    body = "\n".join(body_lines)
+    # 追加到本地历史记录（JSON 行格式）
+    try:
+        changed_coins = [d[0] for k in ("added", "removed", "changed") for d in diffs[k]]
+        append_history(iteration, subject, body, wallet=address, coins=changed_coins)
+    except Exception:
+        warn_once("history_append_fail", "[历史] 无法追加历史记录（内部错误）")
+    if rule_hits is None or rule_hits:
+        send_email(subject, body)
+    return quotes, rule_hits
+
+
+def print_changes(diffs: Dict[str, Any], quotes: Dict[str, Tuple[Any, Any]], rule_hits: Dict[str, List[str]] = None) -> None:
+    """在终端打印持仓变更详情；quotes/rule_hits 为 notify_changes 的返回值。"""
+    print(Fore.RED + Style.BRIGHT + "检测到持仓变更:")
+    for coin, names in (rule_hits or {}).items():
+        print(Fore.RED + f"  触发规则 {coin}: {', '.join(names)}")
+
+    if diffs["added"]:
+        print(Fore.GREEN + "  新增持仓:")
+        for coin, _, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["added"]:
+            roi_str = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
+            cp = quotes[coin][0]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            print(Fore.GREEN + f"    {coin}: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
+
+    if diffs["removed"]:
+        print(Fore.YELLOW + "  平仓/移除持仓:")
+        for coin, prev, _, delta_size, delta_value, ratio_within, ratio_total in diffs["removed"]:
+            roi_str = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
+            cp = quotes[coin][0]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            print(Fore.YELLOW + f"    {coin}: 原大小={prev.get('size')}, 原仓位={prev.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
+
+    if diffs["changed"]:
+        print(Fore.MAGENTA + "  持仓变动（详情）:")
+        for coin, prev, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["changed"]:
+            roi_old = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
+            roi_new = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
+            cp = quotes[coin][0]
+            price_str = f"{cp}" if cp is not None else "N/A"
+            print(Fore.MAGENTA + f"    {coin}:")
+            print(Fore.MAGENTA + f"      之前 - 大小={prev.get('size')}, 仓位={prev.get('value'):.1f}, ROI={roi_old}, 现价={price_str}")
+            print(Fore.MAGENTA + f"      现在 - 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_new}, 现价={price_str}")
+            print(Fore.MAGENTA + f"      变化 - 数量 delta={delta_size}, 价值 delta={delta_value:.1f}")
+
+
+def report_changes(address: str, diffs: Dict[str, Any], total_portfolio_value: float, iteration: int, market: Any = None, alert_envs: Dict[str, Dict[str, Any]] = None) -> bool:
+    """发送持仓变更通知（notify_changes）并在终端打印详情（print_changes），返回是否有变更。"""
+    notified = notify_changes(address, diffs, total_portfolio_value, iteration, market, alert_envs)
+    if notified is None:
+        return False
+    print_changes(diffs, *notified)
+    return True
+
+
+def parse_and_print(data: Dict[str, Any], prev_positions_map: Dict[str, str], iteration: int, address: str = None, show_history: bool = True, analysis: Tuple[Dict[str, Any], Dict[str, Any]] = None, fills: Any = None) -> Dict[str, str]:
+    address = address or TARGET
+    print(Style.BRIGHT + Fore.CYAN + f"=== 清算所账户快照: {address} ===")
 
     margin = data.get("marginSummary", {})
     print(Fore.CYAN + "账户摘要  :")
@@ -732,6 +3461,15 @@ def parse_and_print(data: Dict[str, Any], prev_positions_map: Dict[str, str], it
 
     positions = data.get("assetPositions", [])
     current_map: Dict[str, Dict[str, Any]] = {}
+    market = analysis[2] if analysis is not None else None
+    # 持仓集合指纹与上一轮相同时，持仓比对必然为空，跳过 detect_changes 与邮件路径，只做价格刷新
+    fingerprint = snapshot_fingerprint(data)
+    snap = SNAPSHOT_CACHE.setdefault(address.lower(), {"fp": None, "blocks": {}})
+    blocks: Dict[str, Tuple[Tuple, str]] = {}
+    # 告警规则：coin -> 持仓变量（供 change 规则使用），以及本轮新触发的 position 规则 (coin, 规则名)
+    use_alerts = alerts_enabled()
+    alert_envs: Dict[str, Dict[str, Any]] = {}
+    position_alerts: List[Tuple[str, str]] = []
 
     # 计算 total portfolio value，优先使用 marginSummary 中的 totalRawUsd（若可用），否则累加可计算的 pos value
     total_portfolio_value = 0.0
@@ -741,30 +3479,49 @@ def parse_and_print(data: Dict[str, Any], prev_positions_map: Dict[str, str], it
 
     if positions:
         print(Fore.CYAN + "持仓列表:")
-        for pos_wrapper in positions:
-            pos = pos_wrapper.get("position", {})
-            coin = pos.get("coin") or pos.get("symbol") or str(pos.get("szi"))
-            summary = build_position_summary(pos)
+        # 列式批量计算全部持仓的价值 / ROI / 各周期变动；多地址模式下由 analyze_positions 预先算好。
+        # 行情快照同时覆盖上一轮持有的币种，平仓通知无需再单独取价
+        if analysis is None:
+            table = build_position_table([(address, w.get("position", {})) for w in positions])
+            market = fetch_position_prices(list(table["coin"]) + list(prev_positions_map))
+            metrics = compute_position_metrics(table, market)
+        else:
+            table, metrics, market = analysis
+        summaries = position_summaries(table, metrics)
+        coin_fps = table["fp"]
+        for i, coin in enumerate(table["coin"]):
+            summary = summaries[i]
             current_map[coin] = summary
             # 如果没有从 marginSummary 读取到总仓位，则累加可计算的仓位价值
             if not margin_total_raw:
                 total_portfolio_value += summary.get("value", 0.0)
 
-            # 打印详情（包含 ROI 与仓位价值）
-            print(Fore.MAGENTA + f"  {coin}")
-            print_kv("大小      ", str(summary.get("size")), indent=8, value_color=Fore.YELLOW)
-            print_kv("开仓价    ", str(summary.get("entry")), indent=8, value_color=Fore.YELLOW)
+            # 打印详情（包含 ROI 与仓位价值）；持仓指纹、盈亏与价格都没变时直接复用上一轮的文本
+            current_price = _num(metrics["current"][i])
+            block_key = (
+                coin_fps[i], summary.get("unreal"), current_price,
+                tuple(_num(metrics["roi_delta"][tk][i]) for tk in POSITION_TIMEFRAMES),
+                tuple(_num(metrics["price_change"][tk][i]) for tk in POSITION_TIMEFRAMES),
+            )
+            if use_alerts:
+                alert_envs[coin] = alert_position_env(summary, metrics, i)
+                for name in evaluate_position_alerts(address, coin, alert_envs[coin], block_key):
+                    position_alerts.append((coin, name))
+            cached = snap["blocks"].get(coin)
+            if cached is not None and cached[0] == block_key:
+                sys.stdout.write(cached[1])
+                blocks[coin] = cached
+                continue
+            # 写入本地缓冲区而不是替换进程级的 sys.stdout，避免其它线程同时打印的内容混进缓存文本
+            out = io.StringIO()
+            print(Fore.MAGENTA + f"  {coin}", file=out)
+            print_kv("大小      ", str(summary.get("size")), indent=8, value_color=Fore.YELLOW, file=out)
+            print_kv("开仓价    ", str(summary.get("entry")), indent=8, value_color=Fore.YELLOW, file=out)
             roi = summary.get("roi")
-            leverage = pos_wrapper.get("position", {}).get("leverage") if isinstance(pos_wrapper.get("position", {}), dict) else None
-            lev_val = None
-            if isinstance(leverage, dict):
-                lev_val = safe_float(leverage.get("value")) or None
             # 当前收益率 a * b = c
-            a = roi if roi is not None else None
-            b = lev_val if lev_val is not None else None
-            c = None
-            if a is not None and b is not None:
-                c = a * b
+            a = roi
+            b = summary.get("leverage")
+            c = _num(metrics["lev_roi"][i])
 
             # 打印当前收益率形式 a*b=c
             a_str = f"{a*100:.2f}%" if a is not None else "N/A"
@@ -776,159 +3533,548 @@ def parse_and_print(data: Dict[str, Any], prev_positions_map: Dict[str, str], it
             else:
                 c_col = Fore.GREEN
 
-            print_kv("当前收益率", Fore.CYAN + f"{a_str} * {b_str} = " + c_col + f"{c_str}", indent=8)
-            print_kv("仓位价值", Fore.YELLOW + f"{summary.get('value', 0.0):.1f}", indent=8)
+            print_kv("当前收益率", Fore.CYAN + f"{a_str} * {b_str} = " + c_col + f"{c_str}", indent=8, file=out)
+            print_kv("仓位价值", Fore.YELLOW + f"{summary.get('value', 0.0):.1f}", indent=8, file=out)
             if summary.get("unreal") < 0:
-                print_kv("未实现盈亏", Fore.GREEN + str(roi * summary.get('value', 0.0)), indent=8)
+                print_kv("未实现盈亏", Fore.GREEN + str(roi * summary.get('value', 0.0)), indent=8, file=out)
             else:
-                print_kv("未实现盈亏", Fore.RED + str(summary.get("unreal")), indent=8)
+                print_kv("未实现盈亏", Fore.RED + str(summary.get("unreal")), indent=8, file=out)
 
-            # 查询现价与历史价，计算各 timeframe 的 ROI 变动（以 ROI 的提升为红色，下降为绿色）
-            coin_sym = coin_to_symbol(coin)
-            price_map = fetch_binance_prices(coin_sym) if coin_sym else {"current": None}
-            current_price = price_map.get("current")
             if current_price:
-                print_kv("现价      ", Fore.YELLOW + f"{current_price:.1f}", indent=8, value_color=Fore.YELLOW)
+                print_kv("现价      ", Fore.YELLOW + f"{current_price:.1f}", indent=8, value_color=Fore.YELLOW, file=out)
             else:
-                print_kv("现价      ", Fore.YELLOW + "N/A", indent=8, value_color=Fore.YELLOW)
+                print_kv("现价      ", Fore.YELLOW + "N/A", indent=8, value_color=Fore.YELLOW, file=out)
 
-            # 计算并打印 5m,15m,1h,4h,1d 的 ROI 变化
-            time_keys = ["5m", "15m", "1h", "4h", "1d"]
+            # 5m,15m,1h,4h,1d 的 ROI 变化（以 ROI 的提升为红色，下降为绿色）
             indicators = []
-            for tk in time_keys:
-                past_price = price_map.get(tk)
-                if past_price is None or summary.get("entry") is None:
-                    indicators.append("N/A")
-                    continue
-                # 过去该 timeframe 的 ROI（基于 entry）
-                past_roi = (past_price - summary.get("entry")) / summary.get("entry") if summary.get("entry") != 0 else None
-                cur_roi = (current_price - summary.get("entry")) / summary.get("entry") if summary.get("entry") != 0 else None
-                if past_roi is None or cur_roi is None:
+            for tk in POSITION_TIMEFRAMES:
+                delta = _num(metrics["roi_delta"][tk][i])
+                if delta is None:
                     indicators.append("N/A")
                     continue
-                delta = cur_roi - past_roi
-                # if ROI 提升 -> 红色; 否则绿色
                 col = Fore.RED if delta > 0 else Fore.GREEN
                 sym = "▲" if delta > 0 else ("▼" if delta < 0 else "—")
                 indicators.append(col + f"{sym}{abs(delta)*100:.2f}%")
+            print_kv("ROI变动", " | ".join(indicators), indent=8, file=out)
 
-            # 获取并打印现价与短期价格变化（5m/15m/1h/4h）
-            try:
-                current_price, changes = get_price_and_changes_binance(coin)
-                if current_price is not None:
-                    print_kv("现价      ", Fore.GREEN + f"{current_price}", indent=8, value_color=Fore.GREEN)
-                    order = ["5m", "15m", "1h", "4h"]
-                    change_strs = [format_change_icons(changes.get(o)) for o in order]
-                    print_kv("价格变动", Fore.CYAN + " | ".join(change_strs), indent=8)
-                else:
-                    print_kv("现价      ", Fore.YELLOW + "N/A", indent=8, value_color=Fore.YELLOW)
-            except Exception:
-                print("    现价      : ", Fore.YELLOW + "N/A")
+            # 短期价格变化（5m/15m/1h/4h）
+            if current_price is not None:
+                order = ["5m", "15m", "1h", "4h"]
+                change_strs = [format_change_icons(_num(metrics["price_change"][o][i])) for o in order]
+                print_kv("价格变动", Fore.CYAN + " | ".join(change_strs), indent=8, file=out)
+            blocks[coin] = (block_key, out.getvalue())
+            sys.stdout.write(blocks[coin][1])
     else:
         print(Fore.CYAN + "当前无持仓")
 
+    snap["blocks"] = blocks
+
     # 比对持仓变化并在有变化时发送邮件
-    diffs = detect_changes(prev_positions_map, current_map, total_portfolio_value, iteration)
-    if diffs["added"] or diffs["removed"] or diffs["changed"] and not iteration == 1:
-        print(Fore.RED + Style.BRIGHT + "检测到持仓变更:")
-        body_lines = [f"持仓变更通知 - 账户: {TARGET}", f"总仓位(USD): {total_portfolio_value}", ""]
-
-        if diffs["added"]:
-            print(Fore.GREEN + "  新增持仓:")
-            body_lines.append("新增持仓:")
-            for coin, _, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["added"]:
-                roi_str = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
-                cp, ch = get_price_and_changes_binance(coin)
-                price_str = f"{cp}" if cp is not None else "N/A"
-                print(Fore.GREEN + f"    {coin}: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
-                body_lines.append(f"  {coin}: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
-                if ratio_within is not None:
-                    body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
-                if ratio_total is not None:
-                    body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
-                if ch:
-                    body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
-
-        if diffs["removed"]:
-            print(Fore.YELLOW + "  平仓/移除持仓:")
-            body_lines.append("移除持仓:")
-            for coin, prev, _, delta_size, delta_value, ratio_within, ratio_total in diffs["removed"]:
-                roi_str = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
-                cp, ch = get_price_and_changes_binance(coin)
-                price_str = f"{cp}" if cp is not None else "N/A"
-                print(Fore.YELLOW + f"    {coin}: 原大小={prev.get('size')}, 原仓位={prev.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
-                body_lines.append(f"  {coin}: 原大小={prev.get('size')}, 原仓位={prev.get('value'):.1f}, ROI={roi_str}, 现价={price_str}")
-                if ratio_within is not None:
-                    body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
-                if ratio_total is not None:
-                    body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
-                if ch:
-                    body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
-
-        if diffs["changed"]:
-            print(Fore.MAGENTA + "  持仓变动（详情）:")
-            body_lines.append("变动持仓:")
-            for coin, prev, cur, delta_size, delta_value, ratio_within, ratio_total in diffs["changed"]:
-                roi_old = f"{(prev.get('roi')*100):.2f}%" if prev.get("roi") is not None else "N/A"
-                roi_new = f"{(cur.get('roi')*100):.2f}%" if cur.get("roi") is not None else "N/A"
-                cp, ch = get_price_and_changes_binance(coin)
-                price_str = f"{cp}" if cp is not None else "N/A"
-                print(Fore.MAGENTA + f"    {coin}:")
-                print(Fore.MAGENTA + f"      之前 - 大小={prev.get('size')}, 仓位={prev.get('value'):.1f}, ROI={roi_old}, 现价={price_str}")
-                print(Fore.MAGENTA + f"      现在 - 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_new}, 现价={price_str}")
-                print(Fore.MAGENTA + f"      变化 - 数量 delta={delta_size}, 价值 delta={delta_value:.1f}")
-                body_lines.append(f"  {coin} 原: 大小={prev.get('size')}, 仓位={prev.get('value'):.1f}, ROI={roi_old}, 现价={price_str}")
-                body_lines.append(f"  {coin} 新: 大小={cur.get('size')}, 仓位={cur.get('value'):.1f}, ROI={roi_new}, 现价={price_str}")
-                body_lines.append(f"    变化: 数量 delta={delta_size}, 价值 delta={delta_value:.1f}")
-                if ratio_within is not None:
-                    body_lines.append(f"    占该币种比例: {ratio_within*100:.2f}%")
-                if ratio_total is not None:
-                    body_lines.append(f"    占全仓比例: {ratio_total*100:.2f}%")
-                if ch:
-                    body_lines.append("    价格变动(5m,15m,1h,4h): " + " | ".join([format_change_icons(ch.get(o)) for o in ["5m", "15m", "1h", "4h"]]))
-
-        # 发送邮件并写入历史记录文件
-        subject = f"[通知] 账户 {TARGET} 持仓发生变化"
-        body = "\n".join(body_lines)
-        # 追加到本地历史记录（JSON 行格式）
+    diffs = wallet_diffs(address, fingerprint, prev_positions_map, current_map, total_portfolio_value, iteration, fills)
+    update_exposure(address, current_map, diffs)
+    if not report_changes(address, diffs, total_portfolio_value, iteration, market, alert_envs):
+        print(Fore.GREEN + "未检测到持仓变化。")
+
+    if position_alerts:
+        report_position_alerts(address, position_alerts, alert_envs, iteration)
+
+    if show_history:
+        print_recent_history(3)
+
+    return current_map
+
+
+def main_multi(targets: List[str]):
+    """多地址模式：每轮并发拉取全部地址的状态，再按地址依次解析打印；每个地址维护独立的 prev_positions。"""
+    start_event_output()
+    start_metrics_server()
+    if alerts_enabled():
+        print(Fore.CYAN + f"已加载告警规则 {len(ALERTS['rules'])} 条（{ALERT_RULES_FILE}）")
+    start_ticker_stream()
+    start_state_stream(targets)
+    print(Fore.CYAN + f"启动监控，地址数: {len(targets)}")
+    if POLL_ADAPTIVE:
+        init_poll_schedule(targets)
+    prev_by_wallet: Dict[str, Dict[str, Any]] = {}
+    # 每个地址成功解析的轮次（用于 detect_changes 的首轮判断，拉取失败的地址不会被误判为全部新增）
+    rounds_by_wallet: Dict[str, int] = {}
+    iteration = 0
+    last_success_time = None
+    next_poll = 0.0
+    while True:
+        iteration += 1
+        global GLOBAL_ITERATION
+        GLOBAL_ITERATION = iteration
+        started = time.time()
+        # 到了轮询时间才对非推送地址发起 RPC；被推送提前唤醒时只复用已有状态。
+        # 自适应轮询时只拉取调度器选出的到期地址
+        due = None
+        if POLL_ADAPTIVE:
+            due = due_wallets(started)
+            poll_due = bool(due)
+        else:
+            poll_due = started >= next_poll
+            if poll_due:
+                next_poll = started + POLL_INTERVAL
+        ok = 0
         try:
-            append_history(iteration, subject, body)
-        except Exception:
-            warn_once("history_append_fail", "[历史] 无法追加历史记录（内部错误）")
-        send_email(subject, body)
+            buf = io.StringIO()
+            old_stdout = sys.stdout
+            try:
+                sys.stdout = buf
+                state_due = due
+                if FILLS_MODE:
+                    # 先拉成交：只有出现新成交（或到了对账时间）的地址才重新拉取账户状态
+                    with timed("stage", stage="fetch_fills"):
+                        fills = collect_fills(targets if due is None else due)
+                    state_due = fills_state_due(targets if due is None else due, fills)
+                with timed("stage", stage="fetch_state"):
+                    states = collect_states(targets, poll_due, state_due)
+                if due is not None:
+                    for addr in due:
+                        reschedule_wallet(addr, states.get(addr))
+                # 所有地址的持仓合并为一张列式表，一次批量算出各项指标
+                with timed("stage", stage="analytics"):
+                    analyses = analyze_positions(states, [c for prev in prev_by_wallet.values() for c in prev])
+                for addr in targets:
+                    if due is not None and addr not in states:
+                        # 自适应轮询下尚未轮到首次拉取的地址
+                        continue
+                    state = states.get(addr)
+                    if isinstance(state, Exception) or state is None:
+                        print(Fore.RED + f"[{addr}] 获取状态出错: {state}")
+                        continue
+                    try:
+                        rounds_by_wallet[addr] = rounds_by_wallet.get(addr, 0) + 1
+                        wallet_fills = None
+                        if FILLS_MODE:
+                            # 本轮没有轮到拉取的地址视为没有新成交
+                            wallet_fills = fills.get(addr, [] if due is not None else None)
+                        with timed("stage", stage="parse_and_print"):
+                            prev_by_wallet[addr] = parse_and_print(state, prev_by_wallet.get(addr, {}), rounds_by_wallet[addr], address=addr, show_history=False, analysis=analyses.get(addr), fills=wallet_fills)
+                        if isinstance(wallet_fills, list):
+                            advance_fills_cursor(addr, wallet_fills)
+                        ok += 1
+                    except Exception as e:
+                        print(Fore.RED + f"[{addr}] 解析状态出错: {e}")
+                print_exposure()
+                print_recent_history(3)
+                flush_history()
+                save_fills_cursors()
+                if ok:
+                    last_success_time = datetime.datetime.now()
+            finally:
+                sys.stdout = old_stdout
+
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            last_str = last_success_time.strftime("%Y-%m-%d %H:%M:%S") if last_success_time else "N/A"
+            elapsed = time.time() - started
+            header = f"轮次: {iteration}    时间: {now}    上次成功更新时间: {last_str}    监控地址数: {len(targets)} (成功 {ok})    本轮耗时: {elapsed:.1f}s    {governor_summary()}    {email_summary()}"
+            if POLL_ADAPTIVE:
+                header += f"    {schedule_summary()}"
+            with timed("stage", stage="render"):
+                render_frame(Style.BRIGHT + Fore.WHITE + header + Style.RESET_ALL + "\n" + buf.getvalue())
+        except Exception as e:
+            print(Fore.RED + "获取状态出错:", str(e))
+        observe("stage", time.time() - started, stage="tick")
+        write_tick_trace(iteration, wallets=len(targets), ok=ok, polled=len(due) if due is not None else poll_due)
+        if POLL_ADAPTIVE:
+            # 下一个地址到期就醒来，但至少每 POLL_INTERVAL 刷新一次画面
+            next_poll = max(min(next_poll_due(), started + POLL_INTERVAL), started + 1.0)
+        # 等到下次轮询时间（推送模式下持仓一变化就提前唤醒）
+        wait_next_tick(next_poll - time.time())
+
+
+def _shard_diff(state: Dict[str, Any], prev: Dict[str, Dict[str, Any]], fp: Tuple, rounds: int) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Any], float, Tuple]:
+    """分片子进程内单个地址的比对：逐个持仓生成 summary，指纹未变时跳过 detect_changes。"""
+    current: Dict[str, Dict[str, Any]] = {}
+    for w in state.get("assetPositions") or []:
+        pos = w.get("position") or {}
+        coin = pos.get("coin")
+        if coin:
+            current[coin] = build_position_summary(pos)
+    total = safe_float((state.get("marginSummary") or {}).get("totalRawUsd")) or sum(v["value"] for v in current.values())
+    fingerprint = snapshot_fingerprint(state)
+    if fingerprint == fp and prev.keys() == current.keys():
+        diffs = {"added": [], "removed": [], "changed": []}
     else:
-        print(Fore.GREEN + "未检测到持仓变化。")
+        diffs = detect_changes(prev, current, total, rounds)
+    return current, diffs, total, fingerprint
 
-    # 打印最近三次历史持仓变化（若有）
-    try:
-        last = read_last_history(3)
-        if last:
-            print(Fore.CYAN + "最近历史持仓变化（最近 3 条）:")
-            idx = 0
-            for rec in last:
-                idx += 1
-                ts = rec.get("ts") or "N/A"
-                itr = rec.get("iteration") or "N/A"
-                subj = rec.get("subject") or ""
-                print_kv(f"历史#{idx}", f"{ts} (轮次 {itr})", indent=4, label_width=16, value_color=Fore.CYAN)
-                # 打印正文多行，逐行缩进
-                body_text = rec.get("body") or ""
-                for line in str(body_text).splitlines():
-                    print(" " * 8 + line)
-    except Exception:
-        # 读取/打印历史失败不影响主流程
-        pass
 
+def _shard_worker(conn, addresses: List[str], seed: Dict[str, Dict[str, Dict[str, Any]]] = None) -> None:
+    """分片子进程主循环：收到轮次号后拉取并比对本分片的全部地址，回传 {"iteration", "elapsed", "results", "log"}。
+
+    results 为 address -> 错误字符串，或 (该地址的比对次数, 总仓位, 持仓数, diffs, current)；current 只在地址首次成功时
+    给出全部持仓（供协调者建立初始敞口），之后只含发生变更的币种。持仓状态留在子进程内，不随每轮回传。
+    上一轮处理超时期间积压的轮次号只取最新的一个，每个回复（包括迟到的）都会被协调者合并，变更不会丢失。
+    seed 为重启分片时协调者记录的各地址最近持仓，子进程从这里继续比对，而不是把重启当成首次出现。
+    """
+    prev_by_wallet: Dict[str, Dict[str, Dict[str, Any]]] = dict(seed or {})
+    fps: Dict[str, Tuple] = {}
+    rounds: Dict[str, int] = {addr: 1 for addr in prev_by_wallet}
+    # 子进程继承了主进程的原始标准输出；事件写到标准输出时，本轮收集范围之外的打印改写到标准错误
+    if EVENTS_OUTPUT == "-":
+        sys.stdout = sys.stderr
+    global GLOBAL_ITERATION
+    while True:
+        try:
+            iteration = conn.recv()
+        except (EOFError, OSError):
+            return
+        if iteration is None:
+            return
+        try:
+            while conn.poll():
+                iteration = conn.recv()
+                if iteration is None:
+                    return
+        except (EOFError, OSError):
+            return
+        GLOBAL_ITERATION = iteration
+        started = time.time()
+        results: Dict[str, Any] = {}
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            for addr, state in fetch_states(addresses).items():
+                if not isinstance(state, dict):
+                    results[addr] = str(state)
+                    continue
+                try:
+                    rounds[addr] = rounds.get(addr, 0) + 1
+                    current, diffs, total, fps[addr] = _shard_diff(state, prev_by_wallet.get(addr, {}), fps.get(addr), rounds[addr])
+                except Exception as e:
+                    results[addr] = f"解析状态出错: {e}"
+                    continue
+                if addr not in prev_by_wallet:
+                    delta = current
+                else:
+                    delta = {d[0]: current[d[0]] for k in ("added", "removed", "changed") for d in diffs[k] if d[0] in current}
+                results[addr] = (rounds[addr], total, len(current), diffs, delta)
+                prev_by_wallet[addr] = current
+        try:
+            conn.send({"iteration": iteration, "elapsed": time.time() - started, "results": results, "log": log.getvalue()[-4000:]})
+        except (EOFError, OSError):
+            return
+
+
+def _start_shard(ctx, addresses: List[str], seed: Dict[str, Dict[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_shard_worker, args=(child, addresses, seed), name="shard", daemon=True)
+    proc.start()
+    child.close()
+    return {"proc": proc, "conn": parent, "addresses": addresses}
+
+
+def collect_shards(shards: List[Dict[str, Any]], iteration: int, positions: Dict[str, Dict[str, Dict[str, Any]]] = None) -> Tuple[Dict[str, List[Tuple]], Dict[str, str], List[str]]:
+    """向所有分片下发本轮轮次并等待回复，返回 (address -> 比对结果列表（按先后）, address -> 错误, 子进程日志行)。
+
+    超时的分片本轮记为失败；它迟到的回复在之后的轮次收到时照常合并进结果列表（子进程已据此推进了持仓状态，
+    丢弃会丢失变更）。子进程退出时重启该分片，并用 positions（协调者记录的各地址最近持仓）播种，
+    重启期间发生的变化照常作为变更上报，聚合敞口不会从空开始。
+    """
+    pending = {}
+    dead = []
+    for shard in shards:
+        try:
+            shard["conn"].send(iteration)
+            pending[shard["conn"]] = shard
+        except (EOFError, OSError):
+            dead.append(shard)
+    results: Dict[str, List[Tuple]] = {}
+    errors: Dict[str, str] = {}
+    logs: List[str] = []
+    deadline = time.time() + SHARD_TIMEOUT
+    while pending:
+        ready = connection_wait(list(pending), timeout=max(0.0, deadline - time.time()))
+        if not ready:
+            break
+        for conn in ready:
+            try:
+                reply = conn.recv()
+            except (EOFError, OSError):
+                dead.append(pending.pop(conn))
+                continue
+            late = reply.get("iteration") != iteration
+            if late:
+                inc("shard_late_replies")
+            else:
+                pending.pop(conn)
+                observe("stage", reply["elapsed"], stage="shard")
+            for addr, res in reply["results"].items():
+                if isinstance(res, str):
+                    # 迟到回复里的错误已被本轮取代，只保留本轮的
+                    if not late:
+                        errors[addr] = res
+                else:
+                    results.setdefault(addr, []).append(res)
+            logs.extend(ln for ln in reply["log"].splitlines() if ln.strip())
+    for shard in pending.values():
+        for addr in shard["addresses"]:
+            errors[addr] = f"分片超过 {SHARD_TIMEOUT:.0f}s 未回复"
+    for shard in dead:
+        inc("shard_restarts")
+        for addr in shard["addresses"]:
+            errors[addr] = "分片进程已退出，正在重启"
+        seed = {addr: positions[addr] for addr in shard["addresses"] if addr in (positions or {})}
+        shard.update(_start_shard(multiprocessing.get_context("spawn"), shard["addresses"], seed))
+    return results, errors, logs
+
+
+def merge_shard_results(results: Dict[str, List[Tuple]], targets: List[str], positions: Dict[str, Dict[str, Dict[str, Any]]], iteration: int, market: Any, echo: bool = True) -> int:
+    """按地址顺序合并分片结果：更新协调者侧的持仓副本 positions（重启分片时播种用）与聚合敞口，并发送变更通知。
+
+    echo=False（无界面模式）时只调用 notify_changes 输出事件、写历史、发邮件，不做终端打印。返回有变更的结果数。
+    """
+    changed = 0
+    for addr in targets:
+        items = results.get(addr, ())
+        if echo and any(any(res[3].values()) for res in items):
+            print(Style.BRIGHT + Fore.CYAN + f"=== {addr} ===")
+        for _, total, _, diffs, current in items:
+            known = positions.setdefault(addr, {})
+            known.update(current)
+            for d in diffs["removed"]:
+                known.pop(d[0], None)
+            update_exposure(addr, current, diffs)
+            # 分片不回传持仓指标，change 规则的行情变量由 notify_changes 从行情快照与持仓摘要补齐
+            if echo:
+                changed += int(report_changes(addr, diffs, total, iteration, market))
+            else:
+                changed += int(notify_changes(addr, diffs, total, iteration, market) is not None)
+    return changed
+
+
+def main_sharded(targets: List[str]):
+    """分片模式：地址分给 SHARD_WORKERS 个子进程拉取与比对，本进程只合并变更事件并渲染、发邮件、写历史。"""
+    if FILLS_MODE or STATE_STREAM:
+        print(Fore.YELLOW + "[分片] 分片模式不支持 FILLS_MODE / STATE_STREAM，已按快照轮询处理")
+    ctx = multiprocessing.get_context("spawn")
+    n = max(1, min(SHARD_WORKERS, len(targets)))
+    # 子进程先于指标服务、推送线程等启动，避免继承本进程的线程与连接
+    shards = [_start_shard(ctx, targets[i::n]) for i in range(n)]
+    start_event_output()
+    start_metrics_server()
+    if alerts_enabled():
+        print(Fore.CYAN + f"已加载告警规则 {len(ALERTS['rules'])} 条（{ALERT_RULES_FILE}）")
+    start_ticker_stream()
+    print(Fore.CYAN + f"启动监控，地址数: {len(targets)}，分片进程数: {n}")
+    iteration = 0
+    last_success_time = None
+    # 协调者侧的各地址最近持仓，由每轮合并的结果维护，分片重启时用来播种
+    positions: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    while True:
+        iteration += 1
+        global GLOBAL_ITERATION
+        GLOBAL_ITERATION = iteration
+        started = time.time()
+        next_poll = started + POLL_INTERVAL
+        ok = 0
+        changed = 0
+        if HEADLESS:
+            # 无界面模式与 main_headless 相同：只输出事件、写历史、发邮件，不格式化终端画面
+            try:
+                with timed("stage", stage="fetch_state"):
+                    results, errors, logs = collect_shards(shards, iteration, positions)
+                ok = len(set(results) - set(errors))
+                for addr, err in errors.items():
+                    emit_event({"type": "error", "ts": time.time(), "iteration": iteration, "wallet": addr, "error": err})
+                for ln in list(dict.fromkeys(logs))[:10]:
+                    print(ln, file=sys.stderr)
+                market = None
+                coins = [d[0] for items in results.values() for res in items for k in ("added", "removed", "changed") for d in res[3][k]]
+                if coins:
+                    with timed("stage", stage="market_plan"):
+                        market = fetch_position_prices(coins)
+                with timed("stage", stage="parse_and_print"):
+                    changed = merge_shard_results(results, targets, positions, iteration, market, echo=False)
+                flush_history()
+            except Exception as e:
+                print(f"[分片] 本轮处理出错: {e}", file=sys.stderr)
+            observe("stage", time.time() - started, stage="tick")
+            write_tick_trace(iteration, wallets=len(targets), ok=ok, errors=len(targets) - ok, changed=changed, shards=n)
+            wait_next_tick(next_poll - time.time())
+            continue
+        try:
+            buf = io.StringIO()
+            old_stdout = sys.stdout
+            try:
+                sys.stdout = buf
+                with timed("stage", stage="fetch_state"):
+                    results, errors, logs = collect_shards(shards, iteration, positions)
+                # 同一地址可能同时有迟到的上一轮结果与本轮结果，按先后逐个处理
+                events = {addr for addr, items in results.items() if any(any(res[3].values()) for res in items)}
+                ok = len(set(results) - set(errors))
+                errors = list(errors.items())
+                for ln in list(dict.fromkeys(logs))[:10]:
+                    print(ln)
+                print(Fore.CYAN + f"分片: {n} 个进程    成功 {ok}/{len(targets)}    本轮有变更的地址 {len(events)}")
+                for addr, err in errors[:10]:
+                    print(Fore.RED + f"[{addr}] 获取状态出错: {err}")
+                if len(errors) > 10:
+                    print(Fore.RED + f"... 另有 {len(errors) - 10} 个地址出错")
+                market = None
+                if events:
+                    with timed("stage", stage="market_plan"):
+                        market = fetch_position_prices([d[0] for addr in events for res in results[addr] for k in ("added", "removed", "changed") for d in res[3][k]])
+                with timed("stage", stage="parse_and_print"):
+                    changed = merge_shard_results(results, targets, positions, iteration, market)
+                print_exposure()
+                print_recent_history(3)
+                flush_history()
+                if ok:
+                    last_success_time = datetime.datetime.now()
+            finally:
+                sys.stdout = old_stdout
+
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            last_str = last_success_time.strftime("%Y-%m-%d %H:%M:%S") if last_success_time else "N/A"
+            elapsed = time.time() - started
+            header = f"轮次: {iteration}    时间: {now}    上次成功更新时间: {last_str}    监控地址数: {len(targets)} (成功 {ok})    本轮耗时: {elapsed:.1f}s    {governor_summary()}    {email_summary()}"
+            with timed("stage", stage="render"):
+                render_frame(Style.BRIGHT + Fore.WHITE + header + Style.RESET_ALL + "\n" + buf.getvalue())
+        except Exception as e:
+            print(Fore.RED + "获取状态出错:", str(e))
+        observe("stage", time.time() - started, stage="tick")
+        write_tick_trace(iteration, wallets=len(targets), ok=ok, errors=len(targets) - ok, changed=changed, shards=n)
+        wait_next_tick(next_poll - time.time())
+
+
+def track_wallet(data: Dict[str, Any], prev_positions_map: Dict[str, Dict[str, Any]], iteration: int, address: str, analysis: Tuple = None, fills: Any = None) -> Dict[str, Dict[str, Any]]:
+    """无界面模式下单个地址的一轮：计算持仓摘要与变更，输出事件、写历史记录、发邮件，不做任何终端格式化。
+
+    analysis 只在配置了 position 告警规则时提供（需要现价与各周期指标）；否则只用 build_position_summary，
+    本轮不取行情，变更涉及的币种由 report_changes 单独取价。返回 coin -> summary。
+    """
+    margin = data.get("marginSummary") or {}
+    current_map: Dict[str, Dict[str, Any]] = {}
+    alert_envs: Dict[str, Dict[str, Any]] = {}
+    position_alerts: List[Tuple[str, str]] = []
+    market = None
+    if analysis is not None:
+        table, metrics, market = analysis
+        for i, summary in enumerate(position_summaries(table, metrics)):
+            coin = table["coin"][i]
+            current_map[coin] = summary
+            env = alert_envs[coin] = alert_position_env(summary, metrics, i)
+            position_alerts.extend((coin, name) for name in evaluate_position_alerts(address, coin, env, tuple(env.values())))
+    else:
+        for w in data.get("assetPositions") or []:
+            pos = w.get("position") or {}
+            if pos.get("coin"):
+                current_map[pos["coin"]] = build_position_summary(pos)
+    total_portfolio_value = safe_float(margin.get("totalRawUsd")) or sum(v.get("value", 0.0) for v in current_map.values())
+    diffs = wallet_diffs(address, snapshot_fingerprint(data), prev_positions_map, current_map, total_portfolio_value, iteration, fills)
+    update_exposure(address, current_map, diffs)
+    # 只发送通知与事件，不做终端格式化；change 规则的行情变量由 notify_changes 从行情快照补齐
+    notify_changes(address, diffs, total_portfolio_value, iteration, market, alert_envs)
+    if position_alerts:
+        report_position_alerts(address, position_alerts, alert_envs, iteration, echo=False)
     return current_map
 
 
+def main_headless(targets: List[str]):
+    """无界面模式：单地址与多地址同一流程，每轮拉取、比对并输出事件记录，不渲染终端画面。"""
+    start_event_output()
+    start_metrics_server()
+    if alerts_enabled():
+        print(f"已加载告警规则 {len(ALERTS['rules'])} 条（{ALERT_RULES_FILE}）")
+    start_ticker_stream()
+    start_state_stream(targets)
+    print(f"启动无界面监控，地址数: {len(targets)}，事件输出: {EVENTS_OUTPUT}")
+    if POLL_ADAPTIVE:
+        init_poll_schedule(targets)
+    prev_by_wallet: Dict[str, Dict[str, Any]] = {}
+    rounds_by_wallet: Dict[str, int] = {}
+    iteration = 0
+    next_poll = 0.0
+    global GLOBAL_ITERATION
+    while True:
+        iteration += 1
+        GLOBAL_ITERATION = iteration
+        started = time.time()
+        due = None
+        if POLL_ADAPTIVE:
+            due = due_wallets(started)
+            poll_due = bool(due)
+        else:
+            poll_due = started >= next_poll
+            if poll_due:
+                next_poll = started + POLL_INTERVAL
+        ok = 0
+        errors = 0
+        try:
+            fills = {}
+            state_due = due
+            if FILLS_MODE:
+                with timed("stage", stage="fetch_fills"):
+                    fills = collect_fills(targets if due is None else due)
+                state_due = fills_state_due(targets if due is None else due, fills)
+            with timed("stage", stage="fetch_state"):
+                states = collect_states(targets, poll_due, state_due)
+            if due is not None:
+                for addr in due:
+                    reschedule_wallet(addr, states.get(addr))
+            # 只有 position 规则需要每轮的行情与指标
+            analyses = {}
+            if any(r["on"] == "position" for r in ALERTS["rules"]):
+                with timed("stage", stage="analytics"):
+                    analyses = analyze_positions(states)
+            for addr in targets:
+                state = states.get(addr)
+                if state is None and due is not None:
+                    continue
+                if not isinstance(state, dict):
+                    errors += 1
+                    emit_event({"type": "error", "ts": time.time(), "iteration": iteration, "wallet": addr, "error": str(state)})
+                    continue
+                try:
+                    rounds_by_wallet[addr] = rounds_by_wallet.get(addr, 0) + 1
+                    wallet_fills = fills.get(addr, [] if due is not None else None) if FILLS_MODE else None
+                    with timed("stage", stage="parse_and_print"):
+                        prev_by_wallet[addr] = track_wallet(state, prev_by_wallet.get(addr, {}), rounds_by_wallet[addr], addr, analyses.get(addr), wallet_fills)
+                    if isinstance(wallet_fills, list):
+                        advance_fills_cursor(addr, wallet_fills)
+                    ok += 1
+                except Exception as e:
+                    errors += 1
+                    emit_event({"type": "error", "ts": time.time(), "iteration": iteration, "wallet": addr, "error": f"解析状态出错: {e}"})
+            flush_history()
+            save_fills_cursors()
+        except Exception as e:
+            print("获取状态出错:", str(e))
+        observe("stage", time.time() - started, stage="tick")
+        write_tick_trace(iteration, wallets=len(targets), ok=ok, errors=errors, polled=len(due) if due is not None else poll_due)
+        if POLL_ADAPTIVE:
+            next_poll = max(min(next_poll_due(), started + POLL_INTERVAL), started + 1.0)
+        wait_next_tick(next_poll - time.time())
+
+
 def main():
-    print(Fore.CYAN + "启动监控，账户:", TARGET)
+    targets = load_targets()
+    if HEADLESS and not (len(targets) > 1 and SHARD_WORKERS > 1):
+        return main_headless(targets)
+    if len(targets) > 1:
+        if SHARD_WORKERS > 1:
+            return main_sharded(targets)
+        return main_multi(targets)
+    start_event_output()
+    start_metrics_server()
+    if alerts_enabled():
+        print(Fore.CYAN + f"已加载告警规则 {len(ALERTS['rules'])} 条（{ALERT_RULES_FILE}）")
+    start_ticker_stream()
+    start_state_stream(targets)
+    target = targets[0]
+    print(Fore.CYAN + "启动监控，账户:", target)
     prev_positions: Dict[str, str] = {}
     iteration = 0
     last_success_time = None
+    next_poll = 0.0
     while True:
         iteration += 1
+        started = time.time()
+        poll_due = started >= next_poll
+        if poll_due:
+            next_poll = started + POLL_INTERVAL
         # 写入全局轮次，供 safe_get 等全局函数判断是否在本轮已打印过一次特定信息
         try:
             global GLOBAL_ITERATION
@@ -942,8 +4088,22 @@ def main():
             success = False
             try:
                 sys.stdout = buf
-                state = fetch_state(TARGET)
-                prev_positions = parse_and_print(state, prev_positions, iteration)
+                fills = None
+                state_due = None
+                if FILLS_MODE:
+                    with timed("stage", stage="fetch_fills"):
+                        fills = collect_fills([target])[target]
+                    state_due = fills_state_due([target], {target: fills})
+                with timed("stage", stage="fetch_state"):
+                    state = collect_states([target], poll_due, state_due)[target]
+                if isinstance(state, Exception):
+                    raise state
+                with timed("stage", stage="parse_and_print"):
+                    prev_positions = parse_and_print(state, prev_positions, iteration, address=target, fills=fills)
+                if isinstance(fills, list):
+                    advance_fills_cursor(target, fills)
+                    save_fills_cursors()
+                flush_history()
                 # 如果没有异常，记录成功时间
                 last_success_time = datetime.datetime.now()
                 success = True
@@ -953,19 +4113,17 @@ def main():
             finally:
                 sys.stdout = old_stdout
 
-            # 现在一次性清屏并打印 header + 缓冲内容，避免空屏
-            try:
-                os.system('clear')
-            except Exception:
-                pass
+            # 现在一次性输出 header + 缓冲内容（只重写变化的行），避免空屏与闪烁
             now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             last_str = last_success_time.strftime("%Y-%m-%d %H:%M:%S") if last_success_time else "N/A"
-            header = f"轮次: {iteration}    时间: {now}    上次成功更新时间: {last_str}    监控地址: {TARGET}"
-            print(Style.BRIGHT + Fore.WHITE + header)
-            print(buf.getvalue(), end="")
+            header = f"轮次: {iteration}    时间: {now}    上次成功更新时间: {last_str}    监控地址: {target}    {governor_summary()}    {email_summary()}"
+            with timed("stage", stage="render"):
+                render_frame(Style.BRIGHT + Fore.WHITE + header + Style.RESET_ALL + "\n" + buf.getvalue())
         except Exception as e:
             print(Fore.RED + "获取状态出错:", str(e))
-        time.sleep(POLL_INTERVAL)
+        observe("stage", time.time() - started, stage="tick")
+        write_tick_trace(iteration, wallets=1, ok=int(success), polled=poll_due)
+        wait_next_tick(next_poll - time.time())
 
 
 if __name__ == "__main__":